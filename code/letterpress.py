@@ -24,10 +24,23 @@ import os.path
 import urllib.parse
 import shutil
 import itertools
+import collections
+import queue
+import atexit
+import time
+import threading
+import functools
+import contextlib
+import http.server
+import multiprocessing
+import concurrent.futures
+import signal
 from functools import total_ordering
 import pyinotify
 import email.utils
 import html
+import json
+import hashlib
 
 #--- globals ---
 logger = logging.getLogger('Letterpress')
@@ -54,8 +67,71 @@ def extract_meta_data(text):
     return meta_data, text[m.end():]
 
 
+_meta_data_line_re = re.compile(r"""\w+:.*\n""", re.U)
+
+
+def read_meta_data(file_path):
+    """Read the meta data block at the start of a post file, line by line.
+
+    Accepts the same block extract_meta_data() does but stops reading at the
+    post body. Returns the meta data and the byte offset the body starts at.
+    """
+    meta_data = {}
+    lines = []
+    # 0: leading blank lines, 1: meta data lines, 2: blank lines after them.
+    state = 0
+    offset = 0
+    with open(file_path, 'rb') as f:
+        for raw_line in f:
+            line = raw_line.decode('utf-8')
+            is_blank = line.endswith('\n') and not line.strip()
+            if is_blank:
+                if state == 1:
+                    state = 2
+            elif state < 2 and _meta_data_line_re.match(line):
+                lines.append(line)
+                state = 1
+            else:
+                break
+            offset += len(raw_line)
+    if state != 2:
+        logger.error('No meta data')
+        return meta_data, 0
+
+    for line in lines:
+        k, v = line.split(':', 1)
+        v = v.strip()
+        if v:
+            meta_data[k] = v
+
+    return meta_data, offset
+
+
+def read_body(file_path, offset):
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read().decode('utf-8')
+
+
 _template_re = re.compile(r'{{([^{}]+)}}')
 
+# path -> ((mtime, size), template), shared by all sites.
+_templates = {}
+
+
+def read_template(templates_dir, name):
+    """Read a template, from the cache unless the file changed since."""
+    path = os.path.join(templates_dir, name)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _templates.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    with codecs.open(path, 'r', 'utf-8') as f:
+        template = f.read()
+    _templates[path] = (version, template)
+    return template
+
 
 def format(template, **kwargs):
     # Add common replacements to all templates.
@@ -68,27 +144,30 @@ pygments_options = {'cssclass': 'code', 'classprefix': 'code-'}
 
 @total_ordering
 class Post(object):
+    # Letterpress keeps every post in memory for as long as it runs. Slots and
+    # interned tag names keep that small. The content HTML is not kept at all:
+    # it is read back from the written post file when the feed needs it.
+    __slots__ = ('meta_data', 'rest_text', 'file_path', 'title', 'date', 'pretty_date', 'iso_date',
+                 'excerpt', 'tags', 'lang', 'path', 'permalink', 'html', 'content_span', 'render_error')
 
-    def __new__(cls, file_path, base_url, templates_dir, date_format, math_delimiter):
+    def __new__(cls, file_path, base_url, templates_dir, date_format, math_delimiter, render=True):
         file_name = os.path.basename(file_path)
         logger.debug('Post: %s', file_name)
-        text = ""
-        with codecs.open(file_path, 'r', 'utf-8') as f:
-            text = f.read()
-        meta_data, rest_text = extract_meta_data(text)
-        logger.debug('Meta: %s', meta_data)
-        if not meta_data.get('title'):
-            logger.error('Missing title')
-            return None
-        if not meta_data.get('date'):
-            logger.error('Missing date')
-            return None
-        self = super(Post, cls).__new__(cls)
-        self.meta_data = meta_data
-        self.rest_text = rest_text
+        with tracer.span('parse', file=file_path):
+            meta_data, body_offset = read_meta_data(file_path)
+            logger.debug('Meta: %s', meta_data)
+            if not meta_data.get('title'):
+                logger.error('Missing title')
+                return None
+            if not meta_data.get('date'):
+                logger.error('Missing date')
+                return None
+            self = super(Post, cls).__new__(cls)
+            self.meta_data = meta_data
+            self.rest_text = read_body(file_path, body_offset)
         return self
 
-    def __init__(self, file_path, base_url, templates_dir, date_format, math_delimiter):
+    def __init__(self, file_path, base_url, templates_dir, date_format, math_delimiter, render=True):
         meta_data = self.meta_data
         del self.meta_data
         rest_text = self.rest_text
@@ -97,6 +176,7 @@ class Post(object):
         self.title = html.escape(meta_data['title'])
         self.date = datetime.datetime.strptime(meta_data['date'], date_format)
         self.pretty_date = self.date.strftime('%B %d, %Y')
+        self.iso_date = self.date.strftime('%Y-%m-%d')
         self.excerpt = meta_data.get('excerpt')
         if not self.excerpt:
             if (len(rest_text) > 140):
@@ -105,33 +185,94 @@ class Post(object):
                 self.excerpt = rest_text
         self.excerpt = html.escape(self.excerpt)
         self.tags = []
-        is_math = False
         for tag_name in meta_data.get('tags', '').split(','):
             tag_name = tag_name.strip()
             if tag_name:
-                self.tags.append(tag_name)
-                if tag_name.lower() == 'math':
-                    is_math = True
+                self.tags.append(sys.intern(tag_name))
+        self.tags = tuple(self.tags)
         self.lang = meta_data.get('lang')
-        if self.lang == 'Chinese' or self.lang == '中文':
-            template_file_name = 'post_zh.html'
-        else:
-            template_file_name = 'post.html'
         base_name = os.path.splitext(os.path.basename(file_path))[0]
         self.path = '{year:04}/{month:02}/{base_name}.html'.format(
             year=self.date.year, month=self.date.month, base_name=base_name.lower().replace(' ', '-'))
         self.permalink = os.path.join(base_url, self.path)
-        with codecs.open(os.path.join(templates_dir, template_file_name), 'r', 'utf-8') as f:
-            template = f.read()
-        self.content = markdown2.markdown(rest_text, extras={
-                                          'code-friendly': True, 'fenced-code-blocks': pygments_options, 'footnotes': True, 'math_delimiter': math_delimiter if is_math else None})
-        # Process <code lang="programming-lang"></code> blocks or spans.
-        self.content = self._format_code_lang(self.content)
-        self.html = format(template, site_title=config["title"], title=self.title, date=self.date.strftime('%Y-%m-%d'), monthly_archive_url=os.path.dirname(self.permalink) + '/', year=self.date.strftime('%Y'), month=self.date.strftime(
-            '%B'), day=self.date.strftime('%d'), tags=', '.join('<a href="/tags/{tag}">{tag}</a>'.format(tag=tag) for tag in self.tags), permalink=self.permalink, excerpt=self.excerpt, content=self.content)
+        self.render_error = False
+        if render:
+            self.render(rest_text, templates_dir, math_delimiter)
+        else:
+            self.content_span = None
+
+    _record_date_format = '%Y-%m-%d %H:%M:%S'
+
+    @classmethod
+    def from_record(cls, file_path, record):
+        """Make a post from its metadata index record without reading or
+        rendering the post file. Call render() before writing it, unless it
+        is rendered already.
+        """
+        self = super(Post, cls).__new__(cls)
+        self.file_path = file_path
+        self.title = record['title']
+        self.date = datetime.datetime.strptime(
+            record['date'], cls._record_date_format)
+        self.pretty_date = record['pretty_date']
+        self.iso_date = record['iso_date']
+        self.excerpt = record['excerpt']
+        self.tags = tuple(sys.intern(tag_name)
+                          for tag_name in record['tags'])
+        self.lang = record['lang']
+        self.path = record['path']
+        self.permalink = record['permalink']
+        content_span = record.get('content_span')
+        self.content_span = tuple(content_span) if content_span else None
+        self.render_error = False
+        return self
+
+    @property
+    def record(self):
+        return {'title': self.title, 'date': self.date.strftime(self._record_date_format), 'pretty_date': self.pretty_date,
+                'iso_date': self.iso_date, 'excerpt': self.excerpt, 'tags': self.tags, 'lang': self.lang, 'path': self.path, 'permalink': self.permalink, 'content_span': self.content_span}
+
+    def render(self, rest_text, templates_dir, math_delimiter):
+        if rest_text is None:
+            with tracer.span('parse', file=self.file_path):
+                rest_text = read_body(
+                    self.file_path, read_meta_data(self.file_path)[1])
+        if self.lang == 'Chinese' or self.lang == '中文':
+            template_file_name = 'post_zh.html'
+        else:
+            template_file_name = 'post.html'
+        template = read_template(templates_dir, template_file_name)
+        self.render_error = False
+        content = self._render_content(rest_text, math_delimiter)
+        with tracer.span('template', file=self.file_path):
+            self._fill_template(template, content, math_delimiter)
+
+    def _fill_template(self, template, content, math_delimiter):
+        # Fill the template before and after its first content placeholder
+        # apart to learn where the content goes in the page.
+        match = next((match for match in _template_re.finditer(template)
+                      if match.group(1) == 'content'), None)
+        if match:
+            head_template, tail_template = template[:match.start()], template[match.end():]
+        else:
+            head_template, tail_template = template, ''
+        values = dict(site_title=config["title"], title=self.title, date=self.iso_date, monthly_archive_url=os.path.dirname(self.permalink) + '/', year=self.date.strftime('%Y'), month=self.date.strftime(
+            '%B'), day=self.date.strftime('%d'), tags=', '.join('<a href="/tags/{tag}">{tag}</a>'.format(tag=tag) for tag in self.tags), permalink=self.permalink, excerpt=self.excerpt, content=content)
+        head = self._add_math(format(head_template, **values), math_delimiter)
+        tail = self._add_math(format(tail_template, **values), math_delimiter)
+        self.html = head + content + tail if match else head
+        # Byte offset, length and digest of the content in the written post
+        # file. Without a placeholder it is not in the file, past its end, and
+        # load_content() renders it again.
+        content_bytes = content.encode('utf-8')
+        self.content_span = (len(head.encode('utf-8')), len(content_bytes),
+                             hashlib.md5(content_bytes).hexdigest())
+
+    def _add_math(self, html, math_delimiter):
         # Load MathJax for post with math tag.
-        if is_math:
-            self.html = self.html.replace('</head>', '''
+        if not self.is_math:
+            return html
+        return html.replace('</head>', '''
 <script type="text/x-mathjax-config">
 MathJax.Hub.Config({
   asciimath2jax: {
@@ -142,6 +283,61 @@ MathJax.Hub.Config({
 <script type="text/javascript" src="http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-MML-AM_HTMLorMML"></script>
 </head>''' % (math_delimiter, math_delimiter))
 
+    @property
+    def is_math(self):
+        return any(tag_name.lower() == 'math' for tag_name in self.tags)
+
+    def _render_content(self, rest_text, math_delimiter):
+        key = (rest_text, self.is_math, math_delimiter)
+        content = render_cache.get(key)
+        if content is not None:
+            return content
+        if not renderer:
+            content = render_content(
+                rest_text, self.is_math, math_delimiter, self.file_path)
+        else:
+            try:
+                content = renderer.render(
+                    rest_text, self.is_math, math_delimiter, self.file_path)
+            except RenderError as e:
+                # Serve the source text rather than nothing.
+                self.render_error = True
+                metrics.add_post_error()
+                logger.error('Can not render %s: %s', self.file_name, e)
+                return '<pre>' + html.escape(rest_text) + '</pre>\n'
+        render_cache.put(key, content)
+        return content
+
+    @property
+    def is_rendered(self):
+        return self.content_span is not None
+
+    def load_content(self, site_dir):
+        """Take the content HTML from the render cache, or read it back from
+        the post file written to site_dir.
+
+        Falls back to rendering the post source again if the post is not
+        rendered yet, or the written file is gone or no longer has the content
+        where it was written.
+        """
+        if self.is_rendered:
+            offset, length, digest = self.content_span
+            content = render_cache.get_by_digest(digest)
+            if content is not None:
+                return content
+            try:
+                with open(os.path.join(site_dir, self.path), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+                if len(data) == length and hashlib.md5(data).hexdigest() == digest:
+                    return data.decode('utf-8')
+            except (OSError, UnicodeDecodeError):
+                pass
+        logger.warning('Render content again: %s', self.file_name)
+        rest_text = read_body(
+            self.file_path, read_meta_data(self.file_path)[1])
+        return self._render_content(rest_text, config.get('math_delimiter', '$'))
+
     @property
     def file_name(self):
         return os.path.basename(self.file_path)
@@ -173,19 +369,23 @@ MathJax.Hub.Config({
     """,
                                re.X | re.M)
 
-    def _code_span_sub(self, match):
+    @classmethod
+    def _code_span_sub(cls, match):
         lang = match.group(2)
         code = match.group(3)
-        lexer = self._get_pygments_lexer(lang)
+        lexer = cls._get_pygments_lexer(lang)
         if lexer:
-            return self._color_with_pygments(code, lexer)
+            return cls._color_with_pygments(code, lexer)
         else:
             return match.group(0)
 
-    def _format_code_lang(self, text):
-        return self._code_span_re.sub(self._code_span_sub, text)
+    @classmethod
+    def _format_code_lang(cls, text):
+        return cls._code_span_re.sub(cls._code_span_sub, text)
 
-    def _get_pygments_lexer(self, lexer_name):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _get_pygments_lexer(lexer_name):
         try:
             from pygments import lexers, util
         except ImportError:
@@ -195,7 +395,8 @@ MathJax.Hub.Config({
         except util.ClassNotFound:
             return None
 
-    def _color_with_pygments(self, code, lexer):
+    @staticmethod
+    def _color_with_pygments(code, lexer):
         import pygments
         import pygments.formatters
 
@@ -218,32 +419,261 @@ MathJax.Hub.Config({
         return pygments.highlight(code, lexer, formatter)
 
 
+class TracedMarkdown(markdown2.Markdown):
+    """Markdown that records the phases of a conversion as spans while
+    tracing: the steps over the whole document, the block gamut, the span
+    gamut and the footnotes and unhashing at the end.
+    """
+
+    _span_gamut_depth = 0
+
+    def _prepare_text(self, text):
+        with tracer.span('markdown.prepare'):
+            return super(TracedMarkdown, self)._prepare_text(text)
+
+    def _run_block_steps(self, texts, effects=None):
+        with tracer.span('markdown.blocks'):
+            return super(TracedMarkdown, self)._run_block_steps(texts, effects)
+
+    def _form_paragraphs(self, text):
+        with tracer.span('markdown.paragraphs'):
+            return super(TracedMarkdown, self)._form_paragraphs(text)
+
+    def _run_span_gamut(self, text):
+        # Only the outermost of the span gamuts run within one another, e.g.
+        # for link text.
+        if self._span_gamut_depth or not tracer.enabled:
+            return super(TracedMarkdown, self)._run_span_gamut(text)
+        self._span_gamut_depth += 1
+        try:
+            with tracer.span('markdown.spans'):
+                return super(TracedMarkdown, self)._run_span_gamut(text)
+        finally:
+            self._span_gamut_depth -= 1
+
+    def _add_footnotes(self, text):
+        with tracer.span('markdown.footnotes'):
+            return super(TracedMarkdown, self)._add_footnotes(text)
+
+    def _finish_html(self, text):
+        with tracer.span('markdown.finish'):
+            return super(TracedMarkdown, self)._finish_html(text)
+
+
+# Markdown converters of the posts rendered last, by post file and math
+# options. A post saved again is converted again only where it changed.
+_converters = collections.OrderedDict()
+_converters_lock = threading.Lock()
+_MAX_CONVERTERS = 16
+
+
+def render_content(rest_text, is_math, math_delimiter, file_path=None):
+    extras = {'code-friendly': True, 'fenced-code-blocks': pygments_options, 'footnotes': True,
+              'fused-spans': True, 'math_delimiter': math_delimiter if is_math else None}
+    with tracer.span('markdown'):
+        if file_path is None:
+            content = TracedMarkdown(extras=extras).convert(rest_text)
+        else:
+            key = (file_path, is_math, math_delimiter)
+            # A converter is used by one thread at a time.
+            with _converters_lock:
+                converter = _converters.pop(key, None)
+            if converter is None:
+                converter = TracedMarkdown(extras=extras)
+            content = converter.convert_incremental(rest_text)
+            with _converters_lock:
+                _converters[key] = converter
+                while len(_converters) > _MAX_CONVERTERS:
+                    _converters.popitem(last=False)
+    # Process <code lang="programming-lang"></code> blocks or spans.
+    with tracer.span('highlight'):
+        return Post._format_code_lang(content)
+
+
+class RenderError(Exception):
+    pass
+
+
+# Render workers are forked from a fork server, a small process of its own,
+# rather than from the watcher process: a worker may be started from any
+# thread, and a fork of the watcher would inherit locks other threads hold.
+_render_context = multiprocessing.get_context('forkserver')
+
+
+def _render_worker(conn, memory_limit):
+    # Ctrl-C is for the watcher process. It stops us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit:
+        import resource
+        # On top of the address space the worker has to begin with.
+        with open('/proc/self/statm') as f:
+            limit = int(f.read().split()[0]) * resource.getpagesize() + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        try:
+            args, tracer.enabled = conn.recv()
+            conn.send((True, render_content(*args), tracer.take()))
+        except EOFError:
+            return
+        except MemoryError:
+            conn.send((False, 'out of memory', tracer.take()))
+        except Exception as e:
+            conn.send((False, repr(e), tracer.take()))
+
+
+class Renderer(object):
+    """Renders post content in a worker process within a wall-clock and
+    memory budget, so that one pathological post can not stall the site.
+    A worker that runs out of time is killed and replaced.
+    """
+
+    def __init__(self, timeout, memory_limit=0):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.process = None
+        self.conn = None
+
+    def _start(self):
+        self.conn, child_conn = _render_context.Pipe()
+        self.process = _render_context.Process(
+            target=_render_worker, args=(child_conn, self.memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        if self.process:
+            self.conn.close()
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def render(self, rest_text, is_math, math_delimiter, file_path=None):
+        if not self.process or not self.process.is_alive():
+            self._start()
+        try:
+            self.conn.send(
+                ((rest_text, is_math, math_delimiter, file_path), tracer.enabled))
+            if not self.conn.poll(self.timeout):
+                self.close()
+                raise RenderError(
+                    'took more than {0} seconds'.format(self.timeout))
+            ok, result, events = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.close()
+            raise RenderError('render process died: {0!r}'.format(e))
+        # Spans recorded in the worker process.
+        tracer.events.extend(events)
+        if not ok:
+            raise RenderError(result)
+        return result
+
+
+class RenderCache(object):
+    """Content rendered lately, keyed by the Markdown source and the render
+    options, up to max_size characters of source and content together. A
+    template change thus does not render every post again. Content can also
+    be looked up by its MD5 digest, as in Post.content_span.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        # content digest -> key, and back
+        self.keys = {}
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+            return content
+
+    def get_by_digest(self, digest):
+        with self.lock:
+            key = self.keys.get(digest)
+            if key is None:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, content):
+        size = len(key[0]) + len(content)
+        if size > self.max_size:
+            return
+        digest = hashlib.md5(content.encode('utf-8')).hexdigest()
+        with self.lock:
+            old_content = self.entries.pop(key, None)
+            if old_content is not None:
+                self._forget(key, old_content)
+            self.entries[key] = content
+            self.keys[digest] = key
+            self.digests[key] = digest
+            self.size += size
+            while self.size > self.max_size:
+                self._forget(*self.entries.popitem(last=False))
+
+    def _forget(self, key, content):
+        self.size -= len(key[0]) + len(content)
+        digest = self.digests.pop(key)
+        if self.keys.get(digest) == key:
+            del self.keys[digest]
+
+
+class RendererPool(object):
+    """Renderers shared by threads, each with a worker process of its own,
+    for rendering posts in parallel.
+    """
+
+    def __init__(self, size, timeout, memory_limit=0):
+        self.size = size
+        self.idle = queue.Queue()
+        for _ in range(size):
+            renderer = Renderer(timeout, memory_limit)
+            # Start now rather than when the first posts are waiting.
+            renderer._start()
+            self.idle.put(renderer)
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().close()
+
+    def render(self, rest_text, is_math, math_delimiter, file_path=None):
+        renderer = self.idle.get()
+        try:
+            return renderer.render(rest_text, is_math, math_delimiter, file_path)
+        finally:
+            self.idle.put(renderer)
+
+
 @total_ordering
 class Tag(object):
 
-    def __init__(self, name, posts):
+    def __init__(self, name, posts, posts_per_page):
         self.name = name
         self.posts = posts
         self.path = ('tags/' + name + '/')
         url_comps = urllib.parse.urlparse(posts[0].permalink)
         self.permalink = urllib.parse.urlunparse(
             url_comps[:2] + (self.path,) + (None,) * 3)
+        self.pages = [ArchivePage(self.path, index, page_posts) for index, page_posts in enumerate(
+            grouper(posts_per_page, sorted(posts, reverse=True)))]
 
-    def build_index(self, templates_dir):
-        with codecs.open(os.path.join(templates_dir, "tag_archive.html"), 'r', 'utf-8') as f:
-            template = f.read()
+    def build_index(self, templates_dir, page, prev_page=None, next_page=None):
+        template = read_template(templates_dir, "tag_archive.html")
         posts_match = _posts_re.search(template)
         post_template = posts_match.group(1)
         header_template = template[:posts_match.start()]
         header = format(header_template, site_title=config[
                         "title"], archive_title=self.name)
+        footer = format_page_nav(
+            template[posts_match.end():], prev_page, next_page)
         post_list = []
-        for post in sorted(self.posts, reverse=True):
-            if not post:
-                break
-            post_list.append(format(post_template, title=post.title, date=post.date.strftime(
-                '%Y-%m-%d'), pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
-        index = header + ''.join(post_list) + template[posts_match.end():]
+        for post in page.posts:
+            post_list.append(format(post_template, title=post.title, date=post.iso_date, pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
+        index = header + ''.join(post_list) + footer
         return index
 
     def __str__(self):
@@ -259,6 +689,37 @@ class Tag(object):
         return self.name.lower() < other.name.lower()
 
 
+@total_ordering
+class ArchivePage(object):
+
+    def __init__(self, base_path, index, posts, page_dir=''):
+        self.index = index
+        # Drop the fill values grouper() pads the last page with.
+        self.posts = [post for post in posts if post]
+        self.path = base_path + \
+            (page_dir + str(index) + '/' if index > 0 else '')
+        url_comps = urllib.parse.urlparse(self.posts[0].permalink)
+        self.permalink = urllib.parse.urlunparse(
+            url_comps[:2] + (self.path,) + (None,) * 3)
+
+    @property
+    def signature(self):
+        """What the page shows of its posts. Unchanged signature, unchanged page."""
+        return tuple((post.permalink, post.title, post.pretty_date, post.excerpt) for post in self.posts)
+
+    def __str__(self):
+        return '{path}\n{posts}'.format(path=self.path, posts=self.posts)
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, other):
+        return self.path == other.path and self.index == other.index
+
+    def __lt__(self, other):
+        return self.index < other.index
+
+
 @total_ordering
 class MonthlyArchive(object):
 
@@ -269,8 +730,7 @@ class MonthlyArchive(object):
         self.permalink = os.path.dirname(posts[0].permalink) + '/'
 
     def build_index(self, templates_dir, prev_archive=None, next_archive=None):
-        with codecs.open(os.path.join(templates_dir, "monthly_archive.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        template = read_template(templates_dir, "monthly_archive.html")
         posts_match = _posts_re.search(template)
         header_template = template[:posts_match.start()]
         prev_archive_title = ''
@@ -288,8 +748,7 @@ class MonthlyArchive(object):
         post_template = posts_match.group(1)
         post_list = []
         for post in self.posts:
-            post_list.append(format(post_template, title=post.title, date=post.date.strftime(
-                '%Y-%m-%d'), pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
+            post_list.append(format(post_template, title=post.title, date=post.iso_date, pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
         index = header + ''.join(post_list) + template[posts_match.end():]
         return index
 
@@ -317,8 +776,7 @@ class YearlyArchive(object):
             monthly_archives[0].permalink[:-1]) + '/'
 
     def build_index(self, templates_dir, prev_archive=None, next_archive=None):
-        with codecs.open(os.path.join(templates_dir, "yearly_archive.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        template = read_template(templates_dir, "yearly_archive.html")
         monthly_archives_match = _monthly_archives_re.search(template)
         header_template = template[:monthly_archives_match.start()]
         prev_archive_title = ''
@@ -342,8 +800,7 @@ class YearlyArchive(object):
         for monthly_archive in self.monthly_archives:
             post_list = []
             for post in monthly_archive.posts:
-                post_list.append(format(post_template, title=post.title, date=post.date.strftime(
-                    '%Y-%m-%d'), pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
+                post_list.append(format(post_template, title=post.title, date=post.iso_date, pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
             monthly_archive_list.append(format(monthly_archive_header, monthly_archive_title=monthly_archive.month.strftime(
                 '%B'), monthly_archive_url=monthly_archive.permalink) + ''.join(post_list) + monthly_archive_footer)
         index = header + ''.join(monthly_archive_list) + \
@@ -375,8 +832,7 @@ class TimelineArchive(object):
             url_comps[:2] + (self.path,) + (None,) * 3)
 
     def build_index(self, templates_dir, prev_archive=None, next_archive=None):
-        with codecs.open(os.path.join(templates_dir, "index.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        template = read_template(templates_dir, "index.html")
         posts_match = _posts_re.search(template)
         header_template = template[:posts_match.start()]
         header = format(header_template,
@@ -399,8 +855,7 @@ class TimelineArchive(object):
         for post in self.posts:
             if not post:
                 break
-            post_list.append(format(post_template, title=post.title, date=post.date.strftime(
-                '%Y-%m-%d'), pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
+            post_list.append(format(post_template, title=post.title, date=post.iso_date, pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
         index = header + ''.join(post_list) + footer
         return index
 
@@ -417,6 +872,616 @@ class TimelineArchive(object):
         return self.index < other.index
 
 
+class MetadataIndex(object):
+    """Post metadata persisted across runs, so that a restart does not have to
+    read and render every post before the indices can be built.
+
+    The index is a JSON lines file: a snapshot, rewritten by save(), and a
+    journal of the changes since, appended by flush(). The first line holds
+    the settings the records depend on; each following line is a post record
+    along with the name, mtime and size of its file, or a deletion. Later
+    lines win. A record also tells where the content is in the written post
+    page, if the page was written with the templates and config of
+    render_signature, so that a restart need not render the post again.
+    """
+
+    def __init__(self, file_path, root_dir, settings, render_signature=None):
+        self.file_path = file_path
+        self.root_dir = root_dir
+        self.settings = settings
+        self.render_signature = render_signature
+        self.entries = {}
+        self.pending = []
+        # Records in the file, snapshot and journal.
+        self.line_count = 0
+
+    def load(self):
+        self.entries.clear()
+        self.line_count = 0
+        try:
+            with codecs.open(self.file_path, 'r', 'utf-8') as f:
+                lines = iter(f)
+                if json.loads(next(lines, 'null')) != self.settings:
+                    logger.info('Metadata index out of date')
+                    return
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        if next(lines, None) is not None:
+                            raise
+                        # The last line is torn by a crash while flushing.
+                        # Keep the records before it, and drop it before
+                        # anything is appended after it.
+                        logger.warning('Metadata index %s ends in a torn record', self.file_path)
+                        self.save()
+                        return
+                    self.line_count += 1
+                    if entry.get('deleted'):
+                        self.entries.pop(entry['name'], None)
+                    else:
+                        self.entries[entry['name']] = entry
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            logger.exception('Can not load metadata index %s', self.file_path)
+            self.entries.clear()
+            # Start over, so that flush() does not append to it.
+            self.save()
+
+    def lookup(self, file_path, stat):
+        """Return the post recorded for file_path if the file is unchanged."""
+        entry = self.entries.get(self._name(file_path))
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            post = Post.from_record(file_path, entry)
+            if entry.get('rendered') != self.render_signature:
+                post.content_span = None
+            return post
+        return None
+
+    def _name(self, file_path):
+        return os.path.relpath(file_path, self.root_dir)
+
+    def add(self, post, stat):
+        entry = post.record
+        entry['name'] = self._name(post.file_path)
+        entry['mtime'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        if post.is_rendered and not post.render_error:
+            entry['rendered'] = self.render_signature
+        self.entries[entry['name']] = entry
+        self.pending.append(entry)
+
+    def set_rendered(self, post):
+        """Record that the post page is written."""
+        name = self._name(post.file_path)
+        entry = self.entries.get(name)
+        if not entry or post.render_error:
+            return
+        entry = dict(entry, content_span=post.content_span,
+                     rendered=self.render_signature)
+        self.entries[name] = entry
+        self.pending.append(entry)
+
+    def remove(self, file_path):
+        name = self._name(file_path)
+        if self.entries.pop(name, None):
+            self.pending.append({'name': name, 'deleted': True})
+
+    def retain(self, file_paths):
+        names = set(self._name(file_path) for file_path in file_paths)
+        for name in [name for name in self.entries if name not in names]:
+            del self.entries[name]
+
+    def flush(self):
+        """Append the changes since the last flush or save, or save a new
+        snapshot once the journal is longer than the snapshot.
+        """
+        if not self.pending:
+            return
+        if self.line_count + len(self.pending) > 2 * len(self.entries) + 1000:
+            self.save()
+            return
+        self.line_count += len(self.pending)
+        try:
+            with codecs.open(self.file_path, 'a', 'utf-8') as f:
+                for entry in self.pending:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        except OSError:
+            logger.exception('Can not update metadata index %s', self.file_path)
+        del self.pending[:]
+
+    def save(self):
+        """Rewrite the whole index compactly."""
+        temp_path = self.file_path + '.tmp'
+        try:
+            with codecs.open(temp_path, 'w', 'utf-8') as f:
+                f.write(json.dumps(self.settings) + '\n')
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.file_path)
+        except OSError:
+            logger.exception('Can not save metadata index %s', self.file_path)
+        del self.pending[:]
+        self.line_count = len(self.entries)
+
+
+class BuildQueue(object):
+    """Build work done in the background, one task at a time, whenever the
+    watcher has no events to process. Events thus always go first.
+    """
+
+    def __init__(self):
+        self.tasks = collections.deque()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task, *args):
+        self.tasks.append((task, args))
+
+    def clear(self):
+        self.tasks.clear()
+
+    def run_next(self):
+        task, args = self.tasks.popleft()
+        try:
+            task(*args)
+        except Exception:
+            logger.exception('Build task %s failed', task.__name__)
+
+
+class PollingWatcher(object):
+    """Watches folders by walking them with os.scandir and comparing the
+    (inode, size, mtime) of every entry with the last walk, for press folders
+    inotify can not watch: network mounts changed by other hosts, or trees
+    with more folders than max_user_watches allows.
+
+    Changes are handed to the event handlers as the inotify events the
+    handlers know. Every scan stats at most max_entries entries and goes on
+    where the last one stopped; scans come every interval seconds while
+    there are changes or a walk is under way, and less often up to
+    max_interval seconds while nothing changes. It has the part of the
+    pyinotify.Notifier interface the watch loop uses.
+
+    Folders that are new to it, the roots and folders created or moved in,
+    are listed by the scans like any other, within max_entries, but only to
+    learn what is there: nothing in them is reported until they are listed.
+    """
+
+    def __init__(self, interval=1.0, max_interval=30.0, max_entries=10000):
+        self.min_interval = interval
+        self.max_interval = max_interval
+        self.max_entries = max_entries
+        self.interval = interval
+        self.next_scan = time.monotonic()
+        # watched root -> event handler
+        self.roots = {}
+        # dir path -> {name: (inode, size, mtime_ns, is_dir)}
+        self.listings = {}
+        # Dirs left to list in the current walk, with whether to report
+        # what changed in them.
+        self.walk = collections.deque()
+        self.events = []
+
+    def add_watch(self, path, proc_fun):
+        path = os.path.normpath(path)
+        self.roots[path] = proc_fun
+        # Learn what is there without reporting it.
+        self.walk.append((path, False))
+
+    def _index(self, dir_path):
+        """List dir_path, new to the watcher, without reporting anything, and
+        queue the dirs in it to be listed the same way.
+        """
+        if dir_path not in self.roots and os.path.dirname(dir_path) not in self.listings:
+            # Its parent is gone since it was queued.
+            return 0
+        listing = self._list(dir_path)
+        if listing is None:
+            return 0
+        self.listings[dir_path] = listing
+        self.walk.extend((os.path.join(dir_path, name), False)
+                         for name, entry in listing.items() if entry[3])
+        return len(listing) + 1
+
+    def _list(self, dir_path):
+        listing = {}
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        listing[entry.name] = (stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                                               entry.is_dir(follow_symlinks=False))
+                    except FileNotFoundError:
+                        pass
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return listing
+
+    def _root(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+
+    def _add_event(self, dir_path, name, mask, is_dir):
+        event = Struct()
+        event.path = dir_path
+        event.name = name
+        event.pathname = os.path.join(dir_path, name)
+        event.dir = is_dir
+        event.mask = mask | (pyinotify.IN_ISDIR if is_dir else 0)
+        event.maskname = pyinotify.EventsCodes.maskname(event.mask)
+        event.proc_fun = self.roots[self._root(dir_path)]
+        self.events.append(event)
+
+    def _forget(self, dir_path):
+        for path in [path for path in self.listings if path == dir_path or path.startswith(dir_path + os.sep)]:
+            del self.listings[path]
+
+    def scan(self):
+        """List dirs of the current walk, or of a new one, until max_entries
+        entries are statted, and queue events for what changed.
+        """
+        if not self.walk:
+            self.walk.extend((root, True) for root in self.roots)
+        entry_count = 0
+        # Files changed in the last moment may still be being written. They
+        # are reported by a later scan.
+        settled = time.time_ns() - int(self.min_interval * 1e9)
+        while self.walk and entry_count < self.max_entries:
+            dir_path, report = self.walk.popleft()
+            if not report:
+                entry_count += self._index(dir_path)
+                continue
+            old_listing = self.listings.get(dir_path)
+            if old_listing is None:
+                # Gone since the walk started.
+                continue
+            listing = self._list(dir_path)
+            if listing is None:
+                # Reported by its parent.
+                continue
+            entry_count += len(listing) + 1
+            # Entries renamed within the dir, by inode.
+            gone = {entry[0]: name for name, entry in old_listing.items()
+                    if name not in listing}
+            for name, entry in list(listing.items()):
+                path = os.path.join(dir_path, name)
+                is_dir = entry[3]
+                old_entry = old_listing.get(name)
+                if old_entry and old_entry[3] != is_dir:
+                    # A file replaced a dir or the other way round.
+                    self._add_event(dir_path, name,
+                                    pyinotify.IN_DELETE, old_entry[3])
+                    self._forget(path)
+                    old_entry = None
+                if old_entry is None:
+                    old_name = gone.pop(entry[0], None)
+                    if old_name is not None:
+                        self._add_event(dir_path, old_name,
+                                        pyinotify.IN_MOVED_FROM, is_dir)
+                        self._forget(os.path.join(dir_path, old_name))
+                        self._add_event(
+                            dir_path, name, pyinotify.IN_MOVED_TO, is_dir)
+                    elif is_dir:
+                        self._add_event(
+                            dir_path, name, pyinotify.IN_CREATE, True)
+                    elif entry[2] < settled:
+                        self._add_event(
+                            dir_path, name, pyinotify.IN_CLOSE_WRITE, False)
+                    else:
+                        # Seen as new again by the next scan.
+                        del listing[name]
+                        continue
+                    if is_dir:
+                        # The handler copies the whole dir; what changes in
+                        # it once it is listed is reported.
+                        self.walk.append((path, False))
+                elif is_dir:
+                    self.walk.append((path, True))
+                elif old_entry != entry:
+                    if entry[2] < settled:
+                        self._add_event(
+                            dir_path, name, pyinotify.IN_CLOSE_WRITE, False)
+                    else:
+                        # Seen as changed again by the next scan.
+                        listing[name] = old_entry
+            for name in gone.values():
+                is_dir = old_listing[name][3]
+                self._add_event(dir_path, name, pyinotify.IN_DELETE, is_dir)
+                if is_dir:
+                    self._forget(os.path.join(dir_path, name))
+            self.listings[dir_path] = listing
+        return entry_count
+
+    def check_events(self, timeout=None):
+        if self.events:
+            return True
+        now = time.monotonic()
+        if timeout is not None and now + timeout < self.next_scan:
+            time.sleep(timeout)
+            return False
+        if self.next_scan > now:
+            time.sleep(self.next_scan - now)
+        self.scan()
+        if self.events or self.walk:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self.next_scan = time.monotonic() + self.interval
+        return bool(self.events)
+
+    def read_events(self):
+        pass
+
+    def process_events(self):
+        events = self.events
+        self.events = []
+        for event in events:
+            event.proc_fun(event)
+
+    def stop(self):
+        self.roots.clear()
+
+
+class Metrics(object):
+    """Run counts, total and max durations per build stage, plus files and
+    bytes written, exported in the Prometheus text format. Each series is
+    labelled with the site it was recorded for, if any: the active site.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (site, stage) -> [count, total seconds, max seconds]
+        self.stages = {}
+        # site -> count
+        self.written_files = collections.Counter()
+        self.written_bytes = collections.Counter()
+        self.post_errors = collections.Counter()
+        # (site, name) -> value
+        self.gauges = {}
+        # Bumped on every change, to write files only when needed.
+        self.version = 0
+        # file path -> version written
+        self.written_versions = {}
+        # port -> (server, sites served)
+        self.servers = {}
+
+    @staticmethod
+    def _site():
+        return active_site.published_dir if active_site else None
+
+    def add_duration(self, stage, duration):
+        with self.lock:
+            stats = self.stages.setdefault(
+                (self._site(), stage), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            self.version += 1
+
+    def add_bytes(self, count):
+        with self.lock:
+            site = self._site()
+            self.written_files[site] += 1
+            self.written_bytes[site] += count
+            self.version += 1
+
+    def add_post_error(self):
+        with self.lock:
+            self.post_errors[self._site()] += 1
+            self.version += 1
+
+    def set_gauge(self, name, value, site=None):
+        with self.lock:
+            if self.gauges.get((site, name)) != value:
+                self.gauges[(site, name)] = value
+                self.version += 1
+
+    @staticmethod
+    def _labels(site, **labels):
+        pairs = [('site', site)] if site is not None else []
+        pairs.extend(sorted(labels.items()))
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for name, value in pairs) + '}'
+
+    def text(self, sites=None):
+        """The metrics of the given sites, or of all, in the text format.
+        Series recorded with no site active, e.g. by render workers, are
+        always included.
+        """
+        def included(site):
+            return sites is None or site is None or site in sites
+
+        lines = []
+        with self.lock:
+            for name, kind, help, index in (('letterpress_stage_runs_total', 'counter', 'Times a build stage ran.', 0),
+                                            ('letterpress_stage_seconds_total', 'counter',
+                                             'Seconds spent in a build stage.', 1),
+                                            ('letterpress_stage_seconds_max', 'gauge', 'Longest run of a build stage in seconds.', 2)):
+                lines.append('# HELP {0} {1}'.format(name, help))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for (site, stage), stats in sorted(self.stages.items(), key=lambda item: (item[0][0] or '', item[0][1])):
+                    if included(site):
+                        lines.append('{0}{1} {2}'.format(
+                            name, self._labels(site, stage=stage), stats[index]))
+            for name, counts in (('letterpress_written_files_total', self.written_files),
+                                 ('letterpress_written_bytes_total', self.written_bytes),
+                                 ('letterpress_post_errors_total', self.post_errors)):
+                lines.append('# TYPE {0} counter'.format(name))
+                for site, count in sorted(counts.items(), key=lambda item: item[0] or ''):
+                    if included(site):
+                        lines.append('{0}{1} {2}'.format(
+                            name, self._labels(site), count))
+            for name in sorted(set(name for _, name in self.gauges)):
+                lines.append('# TYPE letterpress_{0} gauge'.format(name))
+                for (site, gauge_name), value in sorted(self.gauges.items(), key=lambda item: (item[0][0] or '', item[0][1])):
+                    if gauge_name == name and included(site):
+                        lines.append('letterpress_{0}{1} {2}'.format(
+                            name, self._labels(site), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Runs and seconds of every build stage, slowest first, as a table."""
+        with self.lock:
+            # Of all sites together.
+            totals = {}
+            for (_, stage), (count, total, longest) in self.stages.items():
+                stats = totals.setdefault(stage, [0, 0.0, 0.0])
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], longest)
+            stages = sorted(totals.items(),
+                            key=lambda item: item[1][1], reverse=True)
+        lines = ['{0:<10} {1:>8} {2:>10} {3:>10}'.format(
+            'stage', 'runs', 'seconds', 'max')]
+        for stage, (count, total, longest) in stages:
+            lines.append('{0:<10} {1:>8} {2:>10.3f} {3:>10.3f}'.format(
+                stage, count, total, longest))
+        return '\n'.join(lines)
+
+    def write(self, file_path, site=None):
+        """Write the metrics of site, or of all sites, to file_path atomically,
+        for node_exporter's textfile collector.
+        """
+        version = self.version
+        if self.written_versions.get(file_path) == version:
+            return
+        self.written_versions[file_path] = version
+        temp_path = file_path + '.tmp'
+        try:
+            with codecs.open(temp_path, 'w', 'utf-8') as f:
+                f.write(self.text(None if site is None else (site,)))
+            os.replace(temp_path, file_path)
+        except OSError:
+            logger.exception('Can not write metrics %s', file_path)
+
+    def serve(self, port, site=None):
+        """Serve the metrics of site, or of all sites, over HTTP on localhost
+        from a daemon thread. Sites that share a port share the page.
+        """
+        if port in self.servers:
+            server, sites = self.servers[port]
+            if sites is not None:
+                if site is None:
+                    self.servers[port] = (server, None)
+                else:
+                    sites.add(site)
+            return server
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                data = metrics.text(metrics.servers[port][1]).encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.servers[port] = (server, None if site is None else set([site]))
+        return server
+
+
+class Tracer(object):
+    """Records spans as Chrome trace events, to be opened in Perfetto or
+    chrome://tracing. Events are appended to the trace file on flush(), in the
+    JSON array format, whose closing bracket is optional.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.file_path = None
+        self.events = []
+        self.started_file = False
+
+    def start(self, file_path):
+        self.file_path = file_path
+        self.enabled = True
+
+    def add(self, name, started, ended, args=None):
+        self.events.append({'name': name, 'ph': 'X', 'ts': int(started * 1e6), 'dur': int((ended - started) * 1e6),
+                            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args or {}})
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.time(), args)
+
+    def take(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def flush(self, last=False):
+        if not self.file_path or not (self.events or last):
+            return
+        lines = [json.dumps(event, ensure_ascii=False)
+                 for event in self.take()]
+        try:
+            with codecs.open(self.file_path, 'a' if self.started_file else 'w', 'utf-8') as f:
+                for line in lines:
+                    f.write((',\n' if self.started_file else '[\n') + line)
+                    self.started_file = True
+                if last:
+                    f.write('\n]\n' if self.started_file else '[]\n')
+        except OSError:
+            logger.exception('Can not write trace %s', self.file_path)
+
+
+def timed(stage, describe=None):
+    """Decorator recording each call of a build stage in the metrics and, when
+    tracing, as a span. describe(*args) returns the span's arguments.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ended = time.time()
+                metrics.add_duration(stage, ended - started)
+                if tracer.enabled:
+                    tracer.add(stage, started, ended,
+                               describe(*args) if describe else None)
+        return wrapper
+    return decorator
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats log records as JSON lines. The site, and the build stage,
+    duration and file passed in a record's `extra`, are kept as fields of
+    their own.
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname,
+                 'message': record.getMessage()}
+        for key in ('site', 'stage', 'duration', 'file'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        return json.dumps(entry, ensure_ascii=False)
+
+
 class Struct(object):
     '''http://docs.python.org/3/tutorial/classes.html#odds-and-ends'''
     pass
@@ -445,62 +1510,136 @@ def grouper(n, iterable, fillvalue=None):
     return itertools.zip_longest(*args, fillvalue=fillvalue)
 
 
+def format_page_nav(template, prev_page=None, next_page=None):
+    prev_archive_title = ''
+    prev_archive_url = ''
+    if prev_page:
+        prev_archive_title = '<'
+        prev_archive_url = prev_page.permalink
+    next_archive_title = ''
+    next_archive_url = ''
+    if next_page:
+        next_archive_title = '>'
+        next_archive_url = next_page.permalink
+    return format(template, prev_archive_title=prev_archive_title, prev_archive_url=prev_archive_url,
+                  next_archive_title=next_archive_title, next_archive_url=next_archive_url)
+
+
 posts = {}
 timeline_archives = []
 monthly_archives = {}
 yearly_archives = {}
 tags = {}
-
-
-def main():
-    global published_dir
-
-    # Command line arguments parsing
-    cmdln_desc = 'A markdown based blog system.'
-    if argparse:
-        usage = " %(prog)s PUBLISHED_DIR"
-        version = "%(prog)s " + __version__
-        parser = argparse.ArgumentParser(
-            prog="letterpress", description=cmdln_desc, formatter_class=argparse.RawDescriptionHelpFormatter)
-        parser.add_argument("published_dir", metavar="PUBLISHED_DIR")
-        parser.add_argument("-v", "--verbose", dest="log_level",
-                                  action="store_const", const=logging.DEBUG,
-                                  help="more verbose output")
-        parser.add_argument("--version", action="version", version=version)
-        parser.set_defaults(log_level=logging.INFO)
-        options = parser.parse_args()
-        published_dir = options.published_dir
-    else:
-        usage = " %prog PUBLISHED_DIR"
-        version = "%prog " + __version__
-        parser = optparse.OptionParser(prog="letterpress", usage=usage,
-                                       version=version, description=cmdln_desc)
-        parser.add_option("-v", "--verbose", dest="log_level",
-                                action="store_const", const=logging.DEBUG,
-                                help="more verbose output")
-        parser.set_defaults(log_level=logging.INFO)
-        options, args = parser.parse_args()
-        if len(args) != 1:
-            parser.print_help()
+archive_pages = []
+# Signatures of the written tag and archive pages, keyed by page path.
+page_signatures = {}
+# Feed items of the rendered posts, with what they were made of, keyed by
+# post file.
+feed_items = {}
+metadata_index = None
+build_queue = BuildQueue()
+renderer = None
+render_cache = RenderCache(0)
+metrics = Metrics()
+tracer = Tracer()
+active_site = None
+
+
+def render_signature(config, templates_dir):
+    """Digest of what post pages depend on besides their posts: the config,
+    the templates, and the code that renders them.
+    """
+    try:
+        import pygments
+        pygments_version = pygments.__version__
+    except ImportError:
+        pygments_version = None
+    digest = hashlib.md5(json.dumps(
+        [__version__, markdown2.__version__, pygments_version, config], sort_keys=True).encode('utf-8'))
+    # The versions are not bumped with every change.
+    for module_path in (__file__, markdown2.__file__):
+        with open(module_path, 'rb') as f:
+            digest.update(f.read())
+    for name in sorted(os.listdir(templates_dir)):
+        path = os.path.join(templates_dir, name)
+        if os.path.isfile(path):
+            digest.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class Site(object):
+    """A press folder. The state of the site being built lives in the module
+    globals; activate() swaps in this site's, so that one process can host
+    several sites.
+    """
+
+    state_names = ('config', 'common_head', 'common_header', 'posts', 'timeline_archives', 'monthly_archives',
+                   'yearly_archives', 'tags', 'archive_pages', 'page_signatures', 'feed_items', 'metadata_index', 'build_queue')
+
+    def __init__(self, published_dir):
+        self.published_dir = published_dir
+        self.config = {}
+        self.common_head = ''
+        self.common_header = ''
+        self.posts = {}
+        self.timeline_archives = []
+        self.monthly_archives = {}
+        self.yearly_archives = {}
+        self.tags = {}
+        self.archive_pages = []
+        self.page_signatures = {}
+        self.feed_items = {}
+        self.metadata_index = None
+        self.build_queue = BuildQueue()
+
+    def activate(self):
+        global active_site
+        if active_site is self:
+            return
+        module_globals = globals()
+        if active_site:
+            for name in self.state_names:
+                setattr(active_site, name, module_globals[name])
+        for name in self.state_names:
+            module_globals[name] = getattr(self, name)
+        active_site = self
+
+    def owns_log_record(self, record):
+        site = getattr(record, 'site', None)
+        return site is None or site == self.published_dir
+
+
+def _add_site_to_log_record(record):
+    record.site = active_site.published_dir if active_site else None
+    return True
+
+
+def run_build_task(sites):
+    """Run the next build task of the next site that has any. Sites take
+    turns, so that rebuilding a big site does not hold up the others.
+    """
+    for _ in range(len(sites)):
+        site = sites[0]
+        sites.rotate(-1)
+        if site.build_queue:
+            site.activate()
+            site.build_queue.run_next()
             return
-        published_dir = args[0]
-    published_dir = os.path.normpath(published_dir)
-    templates_dir = os.path.join(published_dir, 'templates')
 
-    logger.setLevel(options.log_level)
 
-    # Logging.
-    logging_formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s')
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(logging_formatter)
-    log_file = 'letterpress.log'
-    # file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(published_dir, 'letterpress.log'), when='D', interval=1, backupCount=7, utc=True)
-    file_handler = logging.handlers.RotatingFileHandler(os.path.join(
-        published_dir, log_file), maxBytes=64 * 1024, backupCount=3)
-    file_handler.setFormatter(logging_formatter)
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+def open_site(published_dir, options, jobs):
+    """Read the config of the site in published_dir and clean up its site
+    dir. Returns the Site, whose build_site() builds it and whose
+    event_handler keeps it up to date.
+    """
+    site = Site(published_dir)
+    site.activate()
+    templates_dir = os.path.join(published_dir, 'templates')
+    site.log_path = options.log_file or os.path.join(
+        published_dir, 'letterpress.log')
+    log_file = os.path.basename(site.log_path)
 
     # Letterpress config file parsing.
     def read_config():
@@ -517,39 +1656,115 @@ def main():
 
     read_config()
 
+    # Build metrics, written to a file and/or served on a local port.
+    site.metrics_file = config.get('metrics_file')
+    if site.metrics_file:
+        site.metrics_file = os.path.normpath(os.path.join(
+            published_dir, os.path.expanduser(site.metrics_file)))
+    if config.get('metrics_port'):
+        metrics.serve(int(config['metrics_port']), published_dir)
+
     site_dir = config['site_dir']
     if not os.path.isabs(site_dir):
         site_dir = os.path.join(published_dir, os.path.expanduser(site_dir))
     site_dir = os.path.normpath(site_dir)
 
-    # Clean up old files.
-    for rel_path in os.listdir(site_dir):
-        path = os.path.join(site_dir, rel_path)
-        if os.path.isdir(path):
-            shutil.rmtree(path, ignore_errors=True)
-        else:
-            try:
-                os.remove(path)
-            except:
-                logger.exception('Can not delete %s', path)
+    def is_metrics_file(path):
+        return bool(site.metrics_file) and os.path.normpath(
+            path).startswith(site.metrics_file)
+
+    # Post metadata persisted across runs, by default in the user's cache
+    # dir rather than in the watched press folder.
+    if config.get('metadata_index'):
+        metadata_index_path = os.path.join(published_dir, os.path.expanduser(
+            config['metadata_index']))
+    else:
+        metadata_index_path = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'letterpress',
+            hashlib.md5(os.path.abspath(published_dir).encode('utf-8')).hexdigest() + '.jsonl')
+        os.makedirs(os.path.dirname(metadata_index_path), exist_ok=True)
+    metadata_index_path = os.path.normpath(metadata_index_path)
+
+    def is_metadata_index_file(path):
+        # Or its .tmp.
+        return os.path.normpath(path).startswith(metadata_index_path)
+
+    # Templates archive_posts_per_page() warned about.
+    unpaginated_templates = set()
+
+    def archive_posts_per_page(template_name):
+        """Posts per page of the indices of template_name, or None for all on
+        one page: pagination is on only if archive_posts_per_page is set.
+        """
+        if not config.get('archive_posts_per_page'):
+            return None
+        template = read_template(templates_dir, template_name)
+        if '{{next_archive_url}}' not in template and template not in unpaginated_templates:
+            unpaginated_templates.add(template)
+            logger.warning('%s has no {{next_archive_url}}: its pages after the first can not be reached', template_name)
+        return int(config['archive_posts_per_page'])
+
+    # Files in site_dir written or kept by the last build, and since. The
+    # rest is removed when the build is done.
+    kept_files = set()
 
     # Initial complete site building.
-    def create_post(file_path):
+    @timed('post', lambda file_path, stat=None: {'file': file_path})
+    def create_post(file_path, stat=None):
+        if stat is None:
+            stat = os.stat(file_path)
         post = Post(file_path, base_url=config['base_url'], templates_dir=templates_dir, date_format=config[
                     'date_format'], math_delimiter=config.get('math_delimiter', '$'))
         if not post:
             return None
+        write_post(post)
+        metadata_index.add(post, stat)
+        return post
+
+    def load_post(file_path, stat):
+        # Post with its meta data only. render_post() it later.
+        post = metadata_index.lookup(file_path, stat)
+        if post:
+            return post
+        post = Post(file_path, base_url=config['base_url'], templates_dir=templates_dir, date_format=config[
+                    'date_format'], math_delimiter=config.get('math_delimiter', '$'), render=False)
+        if post:
+            metadata_index.add(post, stat)
+        return post
+
+    @timed('render', lambda post: {'file': post.file_path})
+    def render_post(post):
+        if posts.get(post.file_path) is not post:
+            # Updated or deleted in the meantime.
+            return
+        try:
+            post.render(None, templates_dir,
+                        config.get('math_delimiter', '$'))
+        except Exception:
+            metrics.add_post_error()
+            logger.exception('Can not render %s', post.file_name)
+            return
+        write_post(post)
+        metadata_index.set_rendered(post)
+
+    def render_posts(posts_to_render):
+        if jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                for _ in executor.map(render_post, posts_to_render):
+                    pass
+        else:
+            for post in posts_to_render:
+                render_post(post)
+
+    def write_post(post):
         output_file_path = os.path.join(site_dir, post.path)
-        output_dir = os.path.dirname(output_file_path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(post.html)
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        write_file(output_file_path, post.html)
         # html will never be used again. So let's get rid off it to spare some
         # memory.
         del post.html
-        return post
 
+    @timed('tags')
     def create_tags(posts):
         global tags
         tags.clear()
@@ -562,13 +1777,18 @@ def main():
                     posts_of_tag.append(post)
                 else:
                     posts_of_tags[tag_name] = [post]
+        posts_per_page = archive_posts_per_page("tag_archive.html")
+        page_paths = set()
         for tag_name, tag_posts in posts_of_tags.items():
-            tag = Tag(tag_name, tag_posts)
+            tag = Tag(tag_name, tag_posts, posts_per_page or len(tag_posts))
             tags[tag_name] = tag
-            create_tag_index(tag)
+            page_list = [None] + tag.pages + [None]
+            for next_page, page, prev_page in triplepwise(page_list):
+                create_tag_index(tag, page, prev_page, next_page)
+                page_paths.add(page.path)
+        remove_stale_pages('tags/', page_paths)
 
-        with codecs.open(os.path.join(templates_dir, "tags.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        template = read_template(templates_dir, "tags.html")
         tags_match = _tags_re.search(template)
         header_template = template[:tags_match.start()]
         header = format(header_template, site_title=config["title"])
@@ -583,18 +1803,86 @@ def main():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
+        write_file(output_file_path, index)
+
+    @timed('page', lambda tag, page, prev_page, next_page: {'path': page.path})
+    def create_tag_index(tag, page, prev_page, next_page):
+        signature = (page.signature, prev_page and prev_page.path,
+                     next_page and next_page.path)
+        if page_signatures.get(page.path) == signature:
+            # Nothing on this page changed.
+            return
+        index = tag.build_index(templates_dir, page, prev_page, next_page)
+        write_index(page.path, index)
+        page_signatures[page.path] = signature
 
-    def create_tag_index(tag):
-        index = tag.build_index(templates_dir)
-        output_dir = os.path.join(site_dir, tag.path)
+    def write_index(path, index):
+        output_dir = os.path.join(site_dir, path)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
-
+        write_file(output_file_path, index)
+
+    @timed('write', lambda output_file_path, text: {'file': output_file_path})
+    def write_file(output_file_path, text):
+        data = text.encode('utf-8')
+        with open(output_file_path, 'wb') as output_file:
+            output_file.write(data)
+        kept_files.add(output_file_path)
+        metrics.add_bytes(len(data))
+
+    @timed('assets', lambda src, dst, is_dir: {'file': src})
+    def copy_resource(src, dst, is_dir):
+        if is_dir:
+            try:
+                shutil.copytree(src, dst, copy_function=copy_file,
+                                dirs_exist_ok=True)
+            except Exception as e:
+                logger.exception('Can not copytree')
+        else:
+            try:
+                copy_file(src, dst)
+            except Exception as e:
+                logger.exception('Can not copyfile')
+
+    def copy_file(src, dst):
+        # Files copied before keep their mtime, which tells whether they
+        # need copying again.
+        kept_files.add(dst)
+        src_stat = os.stat(src)
+        try:
+            dst_stat = os.stat(dst)
+            if dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+                return dst
+        except FileNotFoundError:
+            pass
+        return shutil.copy2(src, dst)
+
+    def remove_unkept_files():
+        # Pages of posts deleted while Letterpress was not running, say.
+        if site_dir == published_dir or published_dir.startswith(site_dir + os.sep):
+            return
+        for dir_path, dir_names, file_names in os.walk(site_dir, topdown=False):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if path not in kept_files:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        logger.exception('Can not delete %s', path)
+            if dir_path != site_dir and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+    def remove_stale_pages(base_path, page_paths):
+        # Delete pages under base_path that were written before but are gone
+        # now, e.g. the last page of a shrunk tag.
+        for path in [path for path in page_signatures if path.startswith(base_path) and path not in page_paths]:
+            del page_signatures[path]
+            dst = os.path.join(site_dir, path)
+            if os.path.exists(dst):
+                shutil.rmtree(dst, ignore_errors=True)
+
+    @timed('timeline')
     def create_timeline_archives(posts):
         global timeline_archives
         del timeline_archives[:]
@@ -609,15 +1897,12 @@ def main():
         for next_archive, archive, prev_archive in triplepwise(archive_list):
             create_timeline_index(archive, prev_archive, next_archive)
 
+    @timed('page', lambda archive, prev_archive, next_archive: {'path': archive.path})
     def create_timeline_index(archive, prev_archive, next_archive):
         index = archive.build_index(templates_dir, prev_archive, next_archive)
-        output_dir = os.path.join(site_dir, archive.path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
+        write_index(archive.path, index)
 
+    @timed('monthly')
     def create_monthly_archives(posts):
         global monthly_archives
         monthly_archives.clear()
@@ -645,15 +1930,12 @@ def main():
         for prev_archive, archive, next_archive in triplepwise(archive_list):
             create_monthly_index(archive, prev_archive, next_archive)
 
+    @timed('page', lambda archive, prev_archive, next_archive: {'path': archive.path})
     def create_monthly_index(archive, prev_archive, next_archive):
         index = archive.build_index(templates_dir, prev_archive, next_archive)
-        output_dir = os.path.join(site_dir, archive.path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
+        write_index(archive.path, index)
 
+    @timed('yearly')
     def create_yearly_archives(monthly_archives):
         global yearly_archives
         yearly_archives.clear()
@@ -681,125 +1963,197 @@ def main():
         for prev_archive, archive, next_archive in triplepwise(archive_list):
             create_yearly_index(archive, prev_archive, next_archive)
 
+    @timed('page', lambda archive, prev_archive, next_archive: {'path': archive.path})
     def create_yearly_index(archive, prev_archive, next_archive):
         index = archive.build_index(templates_dir, prev_archive, next_archive)
-        output_dir = os.path.join(site_dir, archive.path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
+        write_index(archive.path, index)
 
+    @timed('archive')
     def create_complete_archive(monthly_archives):
-        with codecs.open(os.path.join(templates_dir, "archive.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        global archive_pages
+        del archive_pages[:]
+        # Posts, newest first, along with the monthly archive each belongs to.
+        archived_posts = [(post, monthly_archive) for monthly_archive in sorted(
+            monthly_archives.values(), reverse=True) for post in reversed(monthly_archive.posts)]
+        posts_per_page = archive_posts_per_page("archive.html")
+        page_list = [None]
+        for index, post_group in enumerate(grouper(posts_per_page or max(len(archived_posts), 1), archived_posts)):
+            page = ArchivePage('archive/', index, [
+                               item[0] for item in post_group if item], page_dir='page/')
+            page.monthly_archives = [(monthly_archive, [item[0] for item in items]) for monthly_archive, items in itertools.groupby(
+                (item for item in post_group if item), key=lambda item: item[1])]
+            archive_pages.append(page)
+            page_list.append(page)
+        page_list.append(None)
+        page_paths = set()
+        for next_page, page, prev_page in triplepwise(page_list):
+            create_complete_archive_index(page, prev_page, next_page)
+            page_paths.add(page.path)
+        remove_stale_pages('archive/page/', page_paths)
+
+    @timed('page', lambda page, prev_page, next_page: {'path': page.path})
+    def create_complete_archive_index(page, prev_page, next_page):
+        signature = (page.signature, prev_page and prev_page.path,
+                     next_page and next_page.path)
+        if page_signatures.get(page.path) == signature:
+            return
+        template = read_template(templates_dir, "archive.html")
         monthly_archives_match = _monthly_archives_re.search(template)
         header_template = template[:monthly_archives_match.start()]
         header = format(header_template, site_title=config["title"])
+        footer = format_page_nav(
+            template[monthly_archives_match.end():], prev_page, next_page)
         monthly_archive_template = monthly_archives_match.group(1)
         posts_match = _posts_re.search(monthly_archive_template)
         monthly_archive_header = monthly_archive_template[:posts_match.start()]
         post_template = posts_match.group(1)
         monthly_archive_footer = monthly_archive_template[posts_match.end():]
         monthly_archive_list = []
-        for monthly_archive in sorted(monthly_archives.values(), reverse=True):
+        for monthly_archive, posts_of_month in page.monthly_archives:
             post_list = []
-            for post in reversed(monthly_archive.posts):
-                post_list.append(format(post_template, title=post.title, date=post.date.strftime(
-                    '%Y-%m-%d'), pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
+            for post in posts_of_month:
+                post_list.append(format(post_template, title=post.title, date=post.iso_date, pretty_date=post.pretty_date, permalink=post.permalink, excerpt=post.excerpt))
             monthly_archive_list.append(format(monthly_archive_header, monthly_archive_title=monthly_archive.month.strftime(
                 '%B, %Y'), monthly_archive_url=monthly_archive.permalink) + ''.join(post_list) + monthly_archive_footer)
-        index = header + ''.join(monthly_archive_list) + \
-            template[monthly_archives_match.end():]
-        output_dir = os.path.join(site_dir, 'archive')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        output_file_path = os.path.join(output_dir, 'index.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(index)
+        index = header + ''.join(monthly_archive_list) + footer
+        write_index(page.path, index)
+        page_signatures[page.path] = signature
 
+    @timed('404')
     def create_404_page():
-        with codecs.open(os.path.join(templates_dir, "404.html"), 'r', 'utf-8') as f:
-            template = f.read()
+        template = read_template(templates_dir, "404.html")
         page = format(template, site_title=html.escape(config["title"]))
         output_file_path = os.path.join(site_dir, '404.html')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(page)
+        write_file(output_file_path, page)
 
+    @timed('feed')
     def create_rss_feed(posts):
-        with codecs.open(os.path.join(templates_dir, "feed.xml"), 'r', 'utf-8') as f:
-            template = f.read()
+        if build_queue:
+            # The build in progress writes the feed when it is done.
+            return
+        template = read_template(templates_dir, "feed.xml")
         items_match = _items_re.search(template)
         item_template = items_match.group(1)
         item_list = []
 
+        # Only the items of posts rendered anew since the last feed are made
+        # again: the others' content is the same as long as its span is.
+        items = {}
         sorted_posts = sorted(posts.values(), reverse=True)
         for post in sorted_posts:
-            item_list.append(format(item_template, title=post.title, date=email.utils.format_datetime(
-                post.date), permalink=post.permalink, content=post.content))
+            key = (item_template, post.title, post.date, post.permalink, post.content_span)
+            item = feed_items.get(post.file_path)
+            if item is None or item[0] != key:
+                item = (key, format(item_template, title=post.title, date=email.utils.format_datetime(
+                    post.date), permalink=post.permalink, content=post.load_content(site_dir)))
+            if post.is_rendered:
+                items[post.file_path] = item
+            item_list.append(item[1])
+        feed_items.clear()
+        feed_items.update(items)
         feed = format(template[:items_match.start()], site_title=html.escape(config["title"]), site_description=html.escape(
             config["description"]), site_link=config["base_url"]) + ''.join(item_list) + template[items_match.end():]
 
         output_file_path = os.path.join(site_dir, 'feed.xml')
-        with codecs.open(output_file_path, 'w', 'utf-8') as output_file:
-            output_file.write(feed)
+        write_file(output_file_path, feed)
 
-    def build_site():
+    @timed('build')
+    def build_site(once=False):
         logger.info('Build site')
+        started = time.time()
+        # Drop what is left of a previous build.
+        build_queue.clear()
         global common_head
         global common_header
-        with codecs.open(os.path.join(templates_dir, "common_head.html"), 'r', 'utf-8') as f:
-            common_head = f.read()
-        with codecs.open(os.path.join(templates_dir, "common_header.html"), 'r', 'utf-8') as f:
-            common_header = f.read()
+        global metadata_index
+        common_head = read_template(templates_dir, "common_head.html")
+        common_header = read_template(templates_dir, "common_header.html")
+        metadata_index = MetadataIndex(metadata_index_path, published_dir, {'version': 2, 'base_url': config[
+                                       'base_url'], 'date_format': config['date_format']}, render_signature(config, templates_dir))
+        metadata_index.load()
+        kept_files.clear()
         global posts
         posts.clear()
-        for rel_path in os.listdir(published_dir):
-            path = os.path.join(published_dir, rel_path)
-            basename = os.path.basename(path)
+        # Templates may have changed. Every page has to be written anew.
+        page_signatures.clear()
+        for entry in os.scandir(published_dir):
+            path = entry.path
+            basename = entry.name
             if os.path.splitext(basename)[1] == config['markdown_ext']:
                 # Post.
-                post = create_post(path)
+                try:
+                    post = load_post(path, entry.stat())
+                except Exception:
+                    metrics.add_post_error()
+                    logger.exception('Can not load %s', path)
+                    continue
                 if post:
                     posts[post.file_path] = post
+                else:
+                    metrics.add_post_error()
             elif basename == 'letterpress.config':
                 pass
             elif os.path.normpath(path) == templates_dir:
                 pass
             elif basename.startswith(log_file) or basename.startswith('.'):
                 pass
+            elif is_metrics_file(path) or is_metadata_index_file(path):
+                pass
             else:
                 # Resource.
                 if site_dir == published_dir:
                     continue
                 dst = os.path.join(site_dir, basename)
-                if os.path.isdir(path):
-                    if os.path.exists(dst):
-                        shutil.rmtree(dst, ignore_errors=True)
-                    try:
-                        shutil.copytree(path, dst)
-                    except Exception as e:
-                        logger.exception('Can not copytree')
-                else:
-                    try:
-                        shutil.copyfile(path, dst)
-                    except Exception as e:
-                        logger.exception('Can not copyfile')
-        create_tags(posts)
+                copy_resource(path, dst, entry.is_dir())
+        metadata_index.retain(posts)
+        metadata_index.save()
+
+        # Post pages written by an earlier run with the same templates and
+        # config are kept as they are.
+        sorted_posts = []
+        for post in sorted(posts.values(), reverse=True):
+            output_file_path = os.path.join(site_dir, post.path)
+            if post.is_rendered and os.path.exists(output_file_path):
+                kept_files.add(output_file_path)
+            else:
+                sorted_posts.append(post)
+
+        # The newest posts and the home page go first. Older posts and the
+        # other indices follow in the background, newest first, unless the
+        # watcher has events to process. A one-off build renders all posts
+        # up front, in parallel.
+        posts_per_page = len(sorted_posts) if once else int(
+            config.get('posts_per_page', '10'))
+        render_posts(sorted_posts[:posts_per_page])
         create_timeline_archives(posts)
-        create_monthly_archives(posts)
-        create_yearly_archives(monthly_archives)
-        create_complete_archive(monthly_archives)
         create_404_page()
+        logger.info('Published %d newest posts', min(posts_per_page, len(
+            sorted_posts)), extra={'stage': 'newest', 'duration': time.time() - started})
+        for post in sorted_posts[posts_per_page:]:
+            build_queue.add(render_post, post)
+        build_queue.add(create_tags, posts)
+        build_queue.add(create_monthly_archives, posts)
+        build_queue.add(create_yearly_archives, monthly_archives)
+        build_queue.add(create_complete_archive, monthly_archives)
+        build_queue.add(finish_build, started)
+
+    def finish_build(started):
         create_rss_feed(posts)
-
-    build_site()
+        remove_unkept_files()
+        metadata_index.flush()
+        logger.info('Site built', extra={
+                    'stage': 'build', 'duration': time.time() - started})
 
     # Continuous posts monitoring and site building.
     class ResourceChangeHandler(pyinotify.PrintAllEvents):
 
+        @timed('event', lambda handler, event: {'file': event.pathname, 'mask': event.maskname})
         def process_default(self, event):
-            if event.name.startswith(log_file):
+            site.activate()
+            if event.name.startswith(log_file) or is_metadata_index_file(event.pathname):
+                return
+            if is_metrics_file(event.pathname):
+                # Written by export_metrics(), with its .tmp.
                 return
             # super(ResourceChangeHandler, self).process_default(event)
             file_create_mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
@@ -818,16 +2172,20 @@ def main():
                     elif os.path.splitext(event.pathname)[1] == config['markdown_ext']:
                         if event.mask & file_create_mask:
                             # New post or post changed.
+                            started = time.time()
                             post = create_post(event.pathname)
                             if not post:
                                 return
+                            log_extra = {'stage': 'post', 'duration': time.time(
+                            ) - started, 'file': post.file_name}
                             if post.file_path in posts:
                                 logger.info('Update post: %s',
-                                            os.path.basename(event.pathname))
+                                            os.path.basename(event.pathname), extra=log_extra)
                             else:
                                 logger.info('New post: %s',
-                                            os.path.basename(event.pathname))
+                                            os.path.basename(event.pathname), extra=log_extra)
                             posts[post.file_path] = post
+                            metadata_index.flush()
                             create_tags(posts)
                             create_timeline_archives(posts)
                             create_monthly_archives(posts)
@@ -840,6 +2198,8 @@ def main():
                                         os.path.basename(event.pathname))
                             post = posts.pop(event.pathname, None)
                             if post:
+                                metadata_index.remove(post.file_path)
+                                metadata_index.flush()
                                 dst = os.path.join(site_dir, post.path)
                                 if os.path.exists(dst):
                                     try:
@@ -933,12 +2293,7 @@ def main():
             if event.dir:
                 if event.mask & dir_create_mask:
                     logger.info('New resource dir: %s', rel_path)
-                    if os.path.exists(dst):
-                        shutil.rmtree(dst, ignore_errors=True)
-                    try:
-                        shutil.copytree(event.pathname, dst)
-                    except Exception as e:
-                        logger.exception('Can not copytree')
+                    copy_resource(event.pathname, dst, True)
                 elif event.mask & delete_mask:
                     logger.info('Delete resource dir: %s', rel_path)
                     if os.path.exists(dst):
@@ -946,10 +2301,7 @@ def main():
             else:
                 if event.mask & file_create_mask:
                     logger.info('New resource file: %s', rel_path)
-                    try:
-                        shutil.copyfile(event.pathname, dst)
-                    except Exception as e:
-                        logger.exception('Can not copyfile')
+                    copy_resource(event.pathname, dst, False)
                 elif event.mask & delete_mask:
                     logger.info('Delete resource file: %s', rel_path)
                     if os.path.exists(dst):
@@ -958,12 +2310,197 @@ def main():
                         except:
                             logger.exception('Can not delete %s', dst)
 
-    wm = pyinotify.WatchManager()
-    mask = pyinotify.ALL_EVENTS
-    notifier = pyinotify.Notifier(wm)
-    wm.add_watch(published_dir, mask,
-                 proc_fun=ResourceChangeHandler(), rec=True, auto_add=True)
-    notifier.loop()
+    site.build_site = build_site
+    site.event_handler = ResourceChangeHandler()
+    return site
+
+
+def main():
+    # Command line arguments parsing
+    cmdln_desc = 'A markdown based blog system.'
+    if argparse:
+        usage = " %(prog)s PUBLISHED_DIR..."
+        version = "%(prog)s " + __version__
+        parser = argparse.ArgumentParser(
+            prog="letterpress", description=cmdln_desc, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument("published_dirs", metavar="PUBLISHED_DIR", nargs='+',
+                            help="press folder of a site; give several to host them all in one process")
+        parser.add_argument("-v", "--verbose", dest="log_level",
+                                  action="store_const", const=logging.DEBUG,
+                                  help="more verbose output")
+        parser.add_argument("--log-file", dest="log_file",
+                            help="log file path (default: PUBLISHED_DIR/letterpress.log)")
+        parser.add_argument("--log-format", dest="log_format", choices=('text', 'json'),
+                            help="log line format, json for JSON lines (default: text)")
+        parser.add_argument("--trace", dest="trace_file", metavar="FILE",
+                            help="write spans of every build stage to FILE in the Chrome trace event format")
+        parser.add_argument("--once", dest="once", action="store_true",
+                            help="build the whole site once and exit instead of watching PUBLISHED_DIR; the exit status is 1 if any post failed")
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                            help="posts rendered in parallel with --once (default: the number of CPUs)")
+        parser.add_argument("--watcher", dest="watcher", choices=('inotify', 'poll'),
+                            help="how to watch PUBLISHED_DIR, poll e.g. for network mounts (default: inotify)")
+        parser.add_argument("--version", action="version", version=version)
+        parser.set_defaults(log_level=logging.INFO, log_format='text',
+                            once=False, jobs=os.cpu_count(), watcher='inotify')
+        options = parser.parse_args()
+        published_dirs = options.published_dirs
+    else:
+        usage = " %prog PUBLISHED_DIR..."
+        version = "%prog " + __version__
+        parser = optparse.OptionParser(prog="letterpress", usage=usage,
+                                       version=version, description=cmdln_desc)
+        parser.add_option("-v", "--verbose", dest="log_level",
+                                action="store_const", const=logging.DEBUG,
+                                help="more verbose output")
+        parser.add_option("--log-file", dest="log_file",
+                          help="log file path (default: PUBLISHED_DIR/letterpress.log)")
+        parser.add_option("--log-format", dest="log_format", type="choice", choices=('text', 'json'),
+                          help="log line format, json for JSON lines (default: text)")
+        parser.add_option("--trace", dest="trace_file", metavar="FILE",
+                          help="write spans of every build stage to FILE in the Chrome trace event format")
+        parser.add_option("--once", dest="once", action="store_true",
+                          help="build the whole site once and exit instead of watching PUBLISHED_DIR; the exit status is 1 if any post failed")
+        parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                          help="posts rendered in parallel with --once (default: the number of CPUs)")
+        parser.add_option("--watcher", dest="watcher", type="choice", choices=('inotify', 'poll'),
+                          help="how to watch PUBLISHED_DIR, poll e.g. for network mounts (default: inotify)")
+        parser.set_defaults(log_level=logging.INFO, log_format='text',
+                            once=False, jobs=os.cpu_count(), watcher='inotify')
+        options, args = parser.parse_args()
+        if not args:
+            parser.print_help()
+            return
+        published_dirs = args
+
+    logger.setLevel(options.log_level)
+
+    # Logging. The handlers run on a listener thread so that writing logs
+    # does not hold up building. Each site logs into its own press folder
+    # unless there is a log file for all of them.
+    if options.log_format == 'json':
+        logging_formatter = JSONFormatter()
+    else:
+        logging_formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging_formatter)
+    log_handlers = [stream_handler]
+    log_queue = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.addFilter(_add_site_to_log_record)
+
+    # Build tracing.
+    if options.trace_file:
+        tracer.start(os.path.abspath(options.trace_file))
+        atexit.register(tracer.flush, last=True)
+
+    jobs = max(1, options.jobs or 1) if options.once else 1
+    sites = collections.deque()
+    for published_dir in published_dirs:
+        site = open_site(os.path.normpath(published_dir), options, jobs)
+        sites.append(site)
+        if not options.log_file:
+            # file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(published_dir, 'letterpress.log'), when='D', interval=1, backupCount=7, utc=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                site.log_path, maxBytes=64 * 1024, backupCount=3)
+            file_handler.addFilter(site.owns_log_record)
+            log_handlers.append(file_handler)
+    if options.log_file:
+        log_handlers.append(logging.handlers.RotatingFileHandler(
+            options.log_file, maxBytes=64 * 1024, backupCount=3))
+    for handler in log_handlers:
+        handler.setFormatter(logging_formatter)
+    log_listener = logging.handlers.QueueListener(
+        log_queue, *log_handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    # Render posts in a worker process within a time and memory budget. A
+    # one-off build renders with as many worker processes as jobs. The
+    # worker, the caches and the settings of both are shared by all sites;
+    # the settings come from the first site.
+    global renderer
+    global render_cache
+    sites[0].activate()
+    render_timeout = float(config.get('render_timeout', '30'))
+    render_memory_limit = int(
+        config.get('render_memory_limit', '0')) * 1024 * 1024
+    if jobs > 1:
+        renderer = RendererPool(
+            jobs, render_timeout or None, render_memory_limit)
+    elif render_timeout > 0:
+        renderer = Renderer(render_timeout, render_memory_limit)
+    render_cache = RenderCache(
+        int(config.get('render_cache_size', '32')) * 1024 * 1024)
+
+    def export_metrics():
+        for site in sites:
+            metrics.set_gauge('posts', len(site.posts), site.published_dir)
+            metrics.set_gauge('tags', len(site.tags), site.published_dir)
+        for site in sites:
+            if site.metrics_file:
+                metrics.write(site.metrics_file, site.published_dir)
+
+    if options.once:
+        started = time.time()
+        for site in sites:
+            site.activate()
+            site.build_site(once=True)
+            while site.build_queue:
+                site.build_queue.run_next()
+        export_metrics()
+        if renderer:
+            renderer.close()
+        print('Built {0} posts in {1:.2f} seconds with {2} post errors.'.format(
+            sum(len(site.posts) for site in sites), time.time() - started, metrics.post_errors))
+        print(metrics.summary())
+        return 1 if metrics.post_errors else 0
+
+    for site in sites:
+        site.activate()
+        site.build_site()
+
+    # Continuous posts monitoring and site building.
+    if options.watcher == 'poll':
+        sites[0].activate()
+        notifier = PollingWatcher(float(config.get('poll_interval', '1')), float(config.get(
+            'poll_max_interval', '30')), int(config.get('poll_max_entries', '10000')))
+        for site in sites:
+            notifier.add_watch(site.published_dir, site.event_handler)
+    else:
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.ALL_EVENTS
+        notifier = pyinotify.Notifier(wm)
+        for site in sites:
+            wm.add_watch(site.published_dir, mask,
+                         proc_fun=site.event_handler, rec=True, auto_add=True)
+    # Like notifier.loop(), but runs the background build tasks when there are
+    # no events.
+    flushed = time.monotonic()
+    while True:
+        try:
+            notifier.process_events()
+            building = any(site.build_queue for site in sites)
+            if not building or time.monotonic() - flushed > 5:
+                # Record the pages rendered so far, for a restart after a
+                # crash not to render them again.
+                for site in sites:
+                    site.activate()
+                    metadata_index.flush()
+                flushed = time.monotonic()
+            if not building:
+                # Idle until the next event.
+                export_metrics()
+                tracer.flush()
+            if notifier.check_events(timeout=0 if building else None):
+                notifier.read_events()
+            elif building:
+                run_build_task(sites)
+        except KeyboardInterrupt:
+            notifier.stop()
+            break
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -50,6 +50,10 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
   syntax highlighting.
 * footnotes: Support footnotes as in use on daringfireball.net and
   implemented in other Markdown processors (tho not in Markdown.pl v1.0.1).
+* fused-spans: Same output, but faster processing of the text in
+  paragraphs, headers, list items and table cells: steps with nothing to do
+  are skipped and some steps are done together. Does nothing with the
+  "smarty-pants" or "link-patterns" extras.
 * header-ids: Adds "id" attributes to headers. The id value is a slug of
   the header text.
 * html-classes: Takes a dict mapping html tag names (lowercase) to a
@@ -97,13 +101,11 @@ import sys
 from pprint import pprint, pformat
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
 import optparse
-from random import random, randint
+from random import random
+from bisect import bisect_left
 import codecs
+import copy
 
 
 #---- Python version compat
@@ -131,6 +133,7 @@ elif sys.version_info[0] >= 3:
     py3 = True
     unicode = str
     base_string_type = str
+    unichr = chr
 
 
 
@@ -142,13 +145,50 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
-
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Protected fragments (HTML blocks and spans, math spans, link-pattern links
+# and escaped characters) are swapped out of the text for placeholders while
+# the Markdown regexes run, and swapped back in at the end. A placeholder is
+# a few characters from the Unicode private use area: the placeholder id
+# written in base 4096 between an opening and a closing sentinel. They are
+# cheap to make, short, and no Markdown syntax matches them. The sentinels
+# do not survive in the text otherwise (see `Markdown._prepare_text()`), so
+# placeholders can not collide with the document.
+_PLACEHOLDER_OPEN = u'\ue000'
+_PLACEHOLDER_CLOSE = u'\ue001'
+_PLACEHOLDER_DIGIT_BASE = 0xe100
+_PLACEHOLDER_DIGITS = 0x1000
+_placeholder_re = re.compile(u'\ue000[\ue100-\uf0ff]+\ue001')
+
+def _placeholder_from_id(n):
+    digits = []
+    while True:
+        n, digit = divmod(n, _PLACEHOLDER_DIGITS)
+        digits.append(unichr(_PLACEHOLDER_DIGIT_BASE + digit))
+        if not n:
+            break
+    return _PLACEHOLDER_OPEN + ''.join(digits) + _PLACEHOLDER_CLOSE
+
+# Table of placeholders for escaped characters, and for the quotes that the
+# "smarty-pants" extra must leave alone:
+g_escape_table = dict([(ch, _placeholder_from_id(i))
+    for i, ch in enumerate('\\`*_{}[]()>#+-.!')])
+_smarty_escape_table = {'"': _placeholder_from_id(len(g_escape_table)),
+                        "'": _placeholder_from_id(len(g_escape_table) + 1)}
+# Stands for an opening sentinel in the document itself.
+_placeholder_open_placeholder = _placeholder_from_id(len(g_escape_table) + 2)
+# Marks the end of a block, see `Markdown._render_blocks()`.
+_block_end_placeholder = _placeholder_from_id(len(g_escape_table) + 3)
+# Stands for a closing sentinel in the document itself.
+_placeholder_close_placeholder = _placeholder_from_id(len(g_escape_table) + 4)
+_sentinel_placeholders = {_PLACEHOLDER_OPEN: _placeholder_open_placeholder,
+                          _PLACEHOLDER_CLOSE: _placeholder_close_placeholder}
+_sentinel_re = re.compile(u'[\ue000\ue001]')
+# The span regexes take a placeholder for a word, as if it were the text it
+# stands for, except one for a sentinel in the document.
+_placeholder_word_pat = u'(?!%s|%s)\ue000[\ue100-\uf0ff]+\ue001' % (
+    _placeholder_open_placeholder, _placeholder_close_placeholder)
+# Ids from here on are handed out per conversion.
+_FIRST_PLACEHOLDER_ID = 32
 
 
 
@@ -181,6 +221,218 @@ def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                     link_patterns=link_patterns,
                     use_file_vars=use_file_vars).convert(text)
 
+def convert_many(texts_or_paths, workers=None, paths=False, encoding="utf-8",
+                 chunksize=8, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                 safe_mode=None, extras=None, link_patterns=None,
+                 use_file_vars=False):
+    """Convert many documents with the same options, in `workers` processes
+    (one per CPU if None), and yield the HTML of each in the order given,
+    or a `MarkdownError` for one that could not be converted.
+
+    The documents are texts, or with `paths` true paths of files to read
+    with `encoding`. They are taken from `texts_or_paths`, which may be any
+    iterable, `chunksize` at a time for a process, and only a few chunks
+    per process are converted ahead of the HTML yielded. Each process
+    compiles the options once, see `MarkdownProfile`. With one worker the
+    documents are converted in this process.
+    """
+    options = (html4tags, tab_width, safe_mode, extras, link_patterns,
+               use_file_vars, paths, encoding)
+    chunks = _chunks(texts_or_paths, chunksize)
+    if workers is not None and workers <= 1:
+        compiled = _compile_convert_many_options(options)
+        for chunk in chunks:
+            for html in _convert_many_chunk(chunk, compiled):
+                yield html
+        return
+
+    import multiprocessing
+    from collections import deque
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _init_convert_many_worker,
+                                (options,))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_convert_many_chunk, (chunk,)))
+            if len(pending) > 2 * workers:
+                for html in pending.popleft().get():
+                    yield html
+        while pending:
+            for html in pending.popleft().get():
+                yield html
+    finally:
+        # Also if the caller stops early.
+        pool.terminate()
+        pool.join()
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _compile_convert_many_options(options):
+    (html4tags, tab_width, safe_mode, extras, link_patterns, use_file_vars,
+     paths, encoding) = options
+    profile = MarkdownProfile(tab_width, safe_mode, extras, link_patterns)
+    return profile, html4tags, use_file_vars, paths, encoding
+
+# The options a `convert_many()` process converts with, compiled.
+_convert_many_options = None
+
+def _init_convert_many_worker(options):
+    global _convert_many_options
+    _convert_many_options = _compile_convert_many_options(options)
+
+def _convert_many_chunk(chunk, compiled=None):
+    profile, html4tags, use_file_vars, paths, encoding = \
+        compiled or _convert_many_options
+    results = []
+    for item in chunk:
+        try:
+            if paths:
+                fp = codecs.open(item, 'r', encoding)
+                try:
+                    text = fp.read()
+                finally:
+                    fp.close()
+            else:
+                text = item
+            results.append(Markdown(html4tags=html4tags,
+                                    use_file_vars=use_file_vars,
+                                    profile=profile).convert(text))
+        except Exception:
+            _, ex, _ = sys.exc_info()
+            message = "%s: %s" % (ex.__class__.__name__, ex)
+            if paths:
+                message = "%s: %s" % (item, message)
+            results.append(MarkdownError(message))
+    return results
+
+class MarkdownProfile(object):
+    """A set of Markdown options in compiled form.
+
+    Setting up a `Markdown` object normalizes the options and compiles the
+    regexes that depend on them, e.g. on the tab width. A profile does that
+    once, and any number of conversions can then share it:
+
+        profile = MarkdownProfile(extras=["footnotes"])
+        for text in texts:
+            html = Markdown(profile=profile).convert(text)
+
+    `Markdown` objects made without a profile, and so `markdown()` and
+    `markdown_path()`, share a cached profile for equal options. A profile
+    is not changed after it is made, so threads can share it too.
+    """
+    def __init__(self, tab_width=DEFAULT_TAB_WIDTH, safe_mode=None,
+                 extras=None, link_patterns=None):
+        self.tab_width = tab_width
+
+        # For compatibility with earlier markdown2.py and with
+        # markdown.py's safe_mode being a boolean,
+        #   safe_mode == True -> "replace"
+        if safe_mode is True:
+            self.safe_mode = "replace"
+        else:
+            self.safe_mode = safe_mode
+
+        # Massaging and building the "extras" info.
+        self.extras = _extras_dict(extras)
+        if "toc" in self.extras and not "header-ids" in self.extras:
+            self.extras["header-ids"] = None   # "toc" implies "header-ids"
+
+        self.link_patterns = link_patterns
+
+        self._escape_table = g_escape_table.copy()
+        if "smarty-pants" in self.extras:
+            self._escape_table.update(_smarty_escape_table)
+        self._unescape_table = dict([(escape, ch)
+            for ch, escape in self._escape_table.items()])
+        self._unescape_table[_placeholder_open_placeholder] = _PLACEHOLDER_OPEN
+        self._unescape_table[_placeholder_close_placeholder] = _PLACEHOLDER_CLOSE
+
+        # The regexes that depend on the tab width.
+        less_than_tab = tab_width - 1
+        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+        self._link_def_re = re.compile(Markdown._link_def_re_base
+            % less_than_tab, re.X | re.M | re.U)
+        self._footnote_def_re = re.compile(Markdown._footnote_def_re_base
+            % (less_than_tab, tab_width, tab_width), re.X | re.M)
+        self._pyshell_block_re = re.compile(Markdown._pyshell_block_re_base
+            % less_than_tab, re.M | re.X)
+        self._table_re = re.compile(Markdown._table_re_base
+            % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        self._wiki_table_re = re.compile(Markdown._wiki_table_re_base
+            % less_than_tab, re.M | re.X)
+        self._code_block_re = re.compile(Markdown._code_block_re_base
+            % (tab_width, tab_width), re.M | re.X)
+        self._hr_tag_re = _hr_tag_re_from_tab_width(tab_width)
+        self._xml_oneliner_re = _xml_oneliner_re_from_tab_width(tab_width)
+        # (ul, ol) list regexes for lists and for sub-lists, which need
+        # not follow a blank line.
+        self._list_res = []
+        for prefix in (r"(?:(?<=\n\n)|\A\n?)", "^"):
+            self._list_res.append(tuple([
+                re.compile(prefix + Markdown._whole_list_re_base
+                           % (less_than_tab, marker_pat, marker_pat),
+                           re.X | re.M | re.S)
+                for marker_pat in (Markdown._marker_ul, Markdown._marker_ol)]))
+
+# The profiles of recently used options, see `_get_profile()`.
+_profile_from_options = {}
+_PROFILE_CACHE_SIZE = 64
+
+def _get_profile(tab_width, safe_mode, extras, link_patterns):
+    """Return a profile for the given options, a cached one if possible."""
+    try:
+        key = (tab_width, safe_mode, _frozen(extras), _frozen(link_patterns))
+        profile = _profile_from_options.get(key)
+    except TypeError:
+        # Unhashable extra arguments or link patterns; don't cache.
+        return MarkdownProfile(tab_width, safe_mode, extras, link_patterns)
+    if profile is None:
+        # Copy the extras so the caller changing them can not change what
+        # the cached profile does.
+        profile = MarkdownProfile(tab_width, safe_mode,
+                                  copy.deepcopy(extras), link_patterns)
+        if len(_profile_from_options) >= _PROFILE_CACHE_SIZE:
+            _profile_from_options.clear()
+        _profile_from_options[key] = profile
+    return profile
+
+class MarkdownDocument(object):
+    """A Markdown document parsed by `Markdown.parse()`, to be converted by
+    `Markdown.render_html()`.
+
+    `blocks` is the list of the document's top-level `MarkdownBlock`s. What
+    they share, e.g. the link definitions, is kept with them.
+    """
+    def __init__(self, blocks, state):
+        self.blocks = blocks
+        self._state = state
+
+class MarkdownBlock(object):
+    """A top-level block of a `MarkdownDocument`: one or more paragraphs,
+    headers, lists, etc. running on until the next block can start.
+
+    `text` is its Markdown, with HTML blocks, math spans and escapes
+    swapped out for placeholders, and `kind` what it starts with: one of
+    "paragraph", "header", "hr", "list", "code", "blockquote", "table" or
+    "html".
+    """
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+
+    def __repr__(self):
+        return "<MarkdownBlock %s: %r>" % (self.kind, self.text[:40])
+
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
     # extra name to argument for the extra. Most extras do not have an
@@ -201,46 +453,43 @@ class Markdown(object):
     # (see _ProcessListItems() for details):
     list_level = 0
 
+    # Counts what the block gamut does that depends on the blocks before,
+    # or on chance: header ids, footnote references and encoded email
+    # addresses (see `convert_incremental()`).
+    _effect_count = 0
+
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _line_ending_re = re.compile("\r\n|\r")
+    _file_var_extras_splitter = re.compile("[ ,]+")
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 profile=None):
+        """If a `MarkdownProfile` is given, it has all the options but
+        `html4tags` and `use_file_vars`: the other arguments, and the
+        "extras" of a subclass, are not used.
+        """
         if html4tags:
             self.empty_element_suffix = ">"
         else:
             self.empty_element_suffix = " />"
-        self.tab_width = tab_width
-
-        # For compatibility with earlier markdown2.py and with
-        # markdown.py's safe_mode being a boolean,
-        #   safe_mode == True -> "replace"
-        if safe_mode is True:
-            self.safe_mode = "replace"
-        else:
-            self.safe_mode = safe_mode
 
-        # Massaging and building the "extras" info.
-        if self.extras is None:
-            self.extras = {}
-        elif not isinstance(self.extras, dict):
-            self.extras = dict([(e, None) for e in self.extras])
-        if extras:
-            if not isinstance(extras, dict):
-                extras = dict([(e, None) for e in extras])
-            self.extras.update(extras)
-        assert isinstance(self.extras, dict)
-        if "toc" in self.extras and not "header-ids" in self.extras:
-            self.extras["header-ids"] = None   # "toc" implies "header-ids"
-        self._instance_extras = self.extras.copy()
-
-        self.link_patterns = link_patterns
+        if profile is None:
+            all_extras = _extras_dict(self.extras)
+            if extras:
+                all_extras.update(_extras_dict(extras))
+            profile = _get_profile(tab_width, safe_mode, all_extras,
+                                   link_patterns)
+        self._profile = profile
+        self.tab_width = profile.tab_width
+        self.safe_mode = profile.safe_mode
+        self.extras = profile.extras.copy()
+        self._instance_extras = profile.extras
+        self.link_patterns = profile.link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
-
-        self._escape_table = g_escape_table.copy()
-        if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+        self._outdent_re = profile._outdent_re
+        self._escape_table = profile._escape_table
+        self._unescape_table = profile._unescape_table
 
     def reset(self):
         self.urls = {}
@@ -248,7 +497,10 @@ class Markdown(object):
         self.html_blocks = {}
         self.html_spans = {}
         self.math_spans = {}
+        self._placeholder_count = _FIRST_PLACEHOLDER_ID
+        self._placeholder_from_text = {}
         self.list_level = 0
+        self._toc = None
         self.extras = self._instance_extras.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
@@ -259,6 +511,36 @@ class Markdown(object):
         if "metadata" in self.extras:
             self.metadata = {}
 
+    def _unhash(self, text, *tables):
+        """Swap the placeholders from the given tables in `text` back for
+        what they stand for, in one pass over the text. Placeholders in
+        what they stand for are swapped back too.
+        """
+        if _PLACEHOLDER_OPEN not in text:
+            return text
+        def _unhash_sub(match):
+            key = match.group(0)
+            for table in tables:
+                if key in table:
+                    value = table[key]
+                    if _PLACEHOLDER_OPEN in value:
+                        value = self._unhash(value, *tables)
+                    return value
+            return key
+        return _placeholder_re.sub(_unhash_sub, text)
+
+    def _hash_text(self, s):
+        """Return the placeholder for the protected fragment `s`. Equal
+        fragments get the same placeholder within a conversion.
+        """
+        try:
+            return self._placeholder_from_text[s]
+        except KeyError:
+            self._placeholder_count += 1
+            key = _placeholder_from_id(self._placeholder_count)
+            self._placeholder_from_text[s] = key
+            return key
+
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
     _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
@@ -269,7 +551,226 @@ class Markdown(object):
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
         # and <img> tags get encoded.
+        text = self._prepare_text(text)
+        text = self._run_block_gamut(text)
+        return self._finish_html(text)
 
+    def parse(self, text):
+        """Parse the given text into a `MarkdownDocument`.
+
+        The document's top-level blocks are found in one pass over the text,
+        after the steps of `convert()` that work on the document as a whole:
+        link and footnote definitions are taken out and HTML blocks, math
+        spans and escapes are swapped out for placeholders. `render_html()`
+        converts the document to the same HTML as `convert()` the text.
+        """
+        text = self._prepare_text(text)
+        blocks = [MarkdownBlock(self._block_kind(block_text), block_text)
+                  for block_text in self._split_blocks(text)]
+        return MarkdownDocument(blocks, dict([(name, getattr(self, name, None))
+                                              for name in self._document_attrs]))
+
+    def render_html(self, document):
+        """Convert a `MarkdownDocument` from `parse()` to HTML.
+
+        The document is not changed, so it can be converted again.
+        """
+        for name, value in document._state.items():
+            if isinstance(value, (dict, list)):
+                value = copy.copy(value)
+            setattr(self, name, value)
+        text = "\n\n".join(self._render_blocks(
+            [block.text for block in document.blocks]))
+        return self._finish_html(text)
+
+    # What `parse()` keeps of a conversion's state for `render_html()`.
+    _document_attrs = ("urls", "titles", "html_blocks", "html_spans",
+                       "math_spans", "_placeholder_count",
+                       "_placeholder_from_text", "list_level", "extras",
+                       "footnotes", "footnote_ids", "inline_footnote_id",
+                       "_count_from_header_id", "metadata", "_toc")
+
+    # The HTML of the top-level blocks `convert_incremental()` converted
+    # last, and the definitions and extras they were converted with.
+    _block_cache = None
+    _block_cache_context = None
+
+    def convert_incremental(self, text):
+        """Convert the given text to the same HTML as `convert()`, as a new
+        version of the document this method converted last.
+
+        The steps that work on the document as a whole are all done again,
+        but of its top-level blocks (see `parse()`) only the new and changed
+        ones are converted, as long as the link and footnote definitions
+        are the same. Blocks with header ids (the "header-ids" extra),
+        footnote references or email addresses in them depend on the blocks
+        before them and are always converted.
+        """
+        source = text
+        text = self._prepare_text(text)
+        context = (self.extras, self.urls, self.titles,
+                   sorted(getattr(self, "footnotes", None) or ()))
+        if self._block_cache is None or context != self._block_cache_context:
+            self._block_cache = {}
+            self._block_cache_context = context
+
+        texts = self._split_blocks(text)
+        keys = [self._block_key(block_text) for block_text in texts]
+        # A block's [html, open tags, closing tags, isolated], see below and
+        # `_hash_html_blocks()`.
+        # The HTML is None for a block of only newlines.
+        entries = [self._block_cache.get(key) for key in keys]
+        misses = [i for i, entry in enumerate(entries) if entry is None]
+
+        # The gamut over the new blocks, as over all of them in
+        # `_render_blocks()`: the others did nothing that counted in
+        # `_effect_count`, so they don't change what the new ones do.
+        effects = [False] * len(misses)
+        isolated = True
+        step_texts = self._run_block_steps([texts[i] for i in misses], effects)
+        hashed = []
+        for j, step_text in enumerate(step_texts):
+            open_tags = set()
+            effect_count = self._effect_count
+            hashed.append(self._hash_html_blocks(step_text,
+                                                 open_tags=open_tags))
+            if self._effect_count != effect_count:
+                effects[j] = True
+            close_tags = set(self._block_close_tag_line_re.findall(step_text))
+            entries[misses[j]] = [None, open_tags, close_tags,
+                                  step_text.endswith("\n\n")
+                                  and None not in open_tags]
+        for j, hashed_text in enumerate(hashed):
+            if not hashed_text.strip('\n'):
+                continue
+            effect_count = self._effect_count
+            html = self._form_paragraphs(hashed_text)
+            if self._effect_count != effect_count:
+                effects[j] = True
+            if _PLACEHOLDER_OPEN in html:
+                # Placeholders the gamut made are of this conversion only.
+                # One of an HTML block left in the HTML is what `convert()`
+                # would have made only if all blocks are converted.
+                placeholders = set(_placeholder_re.findall(texts[misses[j]]))
+                for key in _placeholder_re.findall(html):
+                    if (key not in placeholders
+                            and key not in self._unescape_table):
+                        effects[j] = True
+                        if key in self.html_blocks:
+                            isolated = False
+            entries[misses[j]][0] = html
+
+        # Each block must have come out of the gamut as it would have with
+        # the blocks after it: ending in a blank line, with no HTML block
+        # `_hash_html_blocks()` could have run on into any text after it
+        # (the "isolated" entry), nor one it left open that a closing tag
+        # in the blocks after it could have ended. If not, convert it all
+        # at once.
+        close_tags = set()
+        for i in range(len(entries) - 2, -1, -1):
+            if not isolated:
+                break
+            close_tags.update(entries[i + 1][2])
+            isolated = entries[i][3] and not entries[i][1] & close_tags
+        if not isolated:
+            text = self._prepare_text(source)
+            self._block_cache = {}
+            return self._finish_html("\n\n".join(
+                self._render_blocks(self._split_blocks(text))))
+
+        for j, i in enumerate(misses):
+            if effects[j]:
+                entries[i][3] = False
+        self._block_cache = dict([(key, entry)
+                                  for key, entry in zip(keys, entries)
+                                  if entry[3]])
+        html = [entry[0] for entry in entries if entry[0] is not None]
+        return self._finish_html(
+            "\n\n".join(html or [self._form_paragraphs('')]))
+
+    def _block_key(self, text):
+        """What the HTML of a top-level block with the given text depends
+        on, with the same link and footnote definitions: the text, and what
+        the placeholders in it stand for.
+        """
+        if _PLACEHOLDER_OPEN not in text:
+            return text
+        values = []
+        for key in _placeholder_re.findall(text):
+            for table in (self.html_blocks, self.math_spans, self.html_spans):
+                if key in table:
+                    values.append(table[key])
+                    break
+            else:
+                values.append(None)
+        return text, tuple(values)
+
+    # A line of a list item or block quote that could be a header's, which
+    # gets its id after the top-level headers do, see `iter_convert()`.
+    _nested_header_line_re = re.compile(
+        r"^[ ]*(?:(?:>|(?:[*+-]|\d+\.)[ ])[ >]*)*(?<=[ >])(?:#|(?:=+|-+)[ ]*$)",
+        re.M)
+
+    def iter_convert(self, text):
+        """Convert the given text to the same HTML as `convert()`, yielding
+        it a piece at a time: that of each top-level block (see `parse()`)
+        as soon as it is made, and the footnotes last. The last piece is a
+        `UnicodeWithAttrs`, with the "toc_html" and "metadata" of
+        `convert()`'s HTML.
+
+        The steps that work on the document as a whole are all done first,
+        but the HTML is never all kept at once, except that:
+
+        - Blocks that the HTML blocks of one (e.g. an unclosed "<div>") could
+          run on into are converted together, with all the blocks after.
+        - Headers in lists and block quotes get their ids (the "header-ids"
+          extra) after all the others, and footnote references their
+          numbers in the order the gamut makes them in if "smarty-pants"
+          keeps `_sort_footnotes()` from renumbering them. If so, the HTML
+          of all the blocks is made before the first piece.
+
+        `postprocess()` is called on each piece, and email addresses are
+        encoded at random in another order than by `convert()`. In the
+        edge cases where `convert()` leaves a placeholder of an HTML block
+        in the HTML, it's another one.
+        """
+        text = self._prepare_text(text)
+        texts = self._split_blocks(text)
+        if ("header-ids" in self.extras and (
+                self._nested_header_line_re.search(text)
+                or "markdown-in-html" in self.extras and "markdown=" in text)
+                or "footnotes" in self.extras and "smarty-pants" in self.extras
+                and self.footnotes):
+            groups = self._render_blocks(texts)
+        else:
+            groups = self._iter_render_blocks(texts)
+        del text, texts
+
+        footnote_ids = []
+        sep = ""
+        for html in groups:
+            if "footnotes" in self.extras:
+                gamut_footnote_ids = self.footnote_ids
+                html = self._sort_footnotes(html, footnote_ids)
+                self.footnote_ids = gamut_footnote_ids
+            yield sep + self._finish_html_piece(html)
+            sep = "\n\n"
+
+        html = ""
+        if "footnotes" in self.extras:
+            self.footnote_ids = footnote_ids
+            html = self._add_footnotes(html)
+        yield self._html_result(self._finish_html_piece(html) + "\n")
+
+    def convert_to(self, text, fp):
+        """Convert the given text to HTML, written to the file object `fp`
+        a piece at a time, see `iter_convert()`.
+        """
+        for html in self.iter_convert(text):
+            fp.write(html)
+
+    def _prepare_text(self, text):
+        """The steps of `convert()` before the block gamut."""
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
@@ -284,8 +785,8 @@ class Markdown(object):
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
             if "markdown-extras" in emacs_vars:
-                splitter = re.compile("[ ,]+")
-                for e in splitter.split(emacs_vars["markdown-extras"]):
+                for e in self._file_var_extras_splitter.split(
+                        emacs_vars["markdown-extras"]):
                     if '=' in e:
                         ename, earg = e.split('=', 1)
                         try:
@@ -296,8 +797,14 @@ class Markdown(object):
                         ename, earg = e, None
                     self.extras[ename] = earg
 
+        # Keep placeholders unique: a sentinel in the document gets a
+        # placeholder of its own.
+        if _PLACEHOLDER_OPEN in text or _PLACEHOLDER_CLOSE in text:
+            text = _sentinel_re.sub(
+                lambda m: _sentinel_placeholders[m.group(0)], text)
+
         # Standardize line endings:
-        text = re.sub("\r\n|\r", "\n", text)
+        text = self._line_ending_re.sub("\n", text)
 
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
@@ -340,28 +847,34 @@ class Markdown(object):
             text = self._strip_footnote_definitions(text)
             text = self._strip_inline_footnotes(text)
         text = self._strip_link_definitions(text)
+        return text
 
-        text = self._run_block_gamut(text)
-
+    def _finish_html(self, text):
+        """The steps of `convert()` after the block gamut."""
         if "footnotes" in self.extras:
             text = self._sort_footnotes(text)
             text = self._add_footnotes(text)
+        return self._html_result(self._finish_html_piece(text) + "\n")
 
+    def _finish_html_piece(self, text):
+        """The steps of `_finish_html()` that are done over each piece of
+        the HTML in `iter_convert()`.
+        """
         text = self.postprocess(text)
 
-        text = self._unescape_special_chars(text)
-
-        if self.safe_mode:
-            text = self._unhash_html_spans(text)
-
-        if self.extras.get("math_delimiter"):
-            text = self._unhash_math_spans(text)
+        # Swap back in all the special characters we've hidden, the raw
+        # HTML spans (safe mode) and the math spans, in one pass.
+        text = self._unhash(text, self._unescape_table, self.html_spans,
+                            self.math_spans)
 
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        return text
 
-        text += "\n"
-
+    def _html_result(self, text):
+        """Return the HTML `text` with the attributes of the extras that
+        have them set, see `UnicodeWithAttrs`.
+        """
         rv = UnicodeWithAttrs(text)
         if "toc" in self.extras:
             rv._toc = self._toc
@@ -600,18 +1113,18 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
-    def _hash_html_blocks(self, text, raw=False):
+    def _hash_html_blocks(self, text, raw=False, open_tags=None):
         """Hashify HTML blocks
 
         We only want to do this for block-level HTML tags, such as headers,
@@ -622,6 +1135,9 @@ class Markdown(object):
 
         @param raw {boolean} indicates if these are raw HTML blocks in
             the original source. It makes a difference in "safe" mode.
+        @param open_tags {set} if given, the names of the tags whose blocks
+            could end in text that followed this one are added to it, and
+            None if anything that followed could change what is hashed.
         """
         if '<' not in text:
             return text
@@ -641,15 +1157,20 @@ class Markdown(object):
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
         text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        if open_tags is not None:
+            open_tags.update([match.group(1) for match in
+                              self._block_tag_line_re.finditer(text)])
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
         text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        if open_tags is not None and ("<!--" in text
+                or self._liberal_tag_line_re.search(text)):
+            open_tags.add(None)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
         if "<hr" in text:
-            _hr_tag_re = _hr_tag_re_from_tab_width(self.tab_width)
-            text = _hr_tag_re.sub(hash_html_block_sub, text)
+            text = self._profile._hr_tag_re.sub(hash_html_block_sub, text)
 
         # Special case for standalone HTML comments:
         if "<!--" in text:
@@ -702,7 +1223,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -714,19 +1235,13 @@ class Markdown(object):
             #    <?foo bar?>
             #
             #    <xi:include xmlns:xi="http://www.w3.org/2001/XInclude" href="chapter_1.md"/>
-            _xml_oneliner_re = _xml_oneliner_re_from_tab_width(self.tab_width)
-            text = _xml_oneliner_re.sub(hash_html_block_sub, text)
+            text = self._profile._xml_oneliner_re.sub(hash_html_block_sub, text)
 
         return text
 
-    def _strip_link_definitions(self, text):
-        # Strips link definitions from text, stores the URLs and titles in
-        # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
+    # Link defs are in the form:
+    #   [id]: url "optional title"
+    _link_def_re_base = r"""
             ^[ ]{0,%d}\[(.+)\]: # id = \1
               [ \t]*
               \n?               # maybe *one* newline
@@ -743,8 +1258,12 @@ class Markdown(object):
                 [ \t]*
             )?  # title is optional
             (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
-        return _link_def_re.sub(self._extract_link_def_sub, text)
+            """
+
+    def _strip_link_definitions(self, text):
+        # Strips link definitions from text, stores the URLs and titles in
+        # hash references.
+        return self._profile._link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
         id, url, title = match.groups()
@@ -757,12 +1276,29 @@ class Markdown(object):
     def _extract_footnote_def_sub(self, match):
         id, text = match.groups()
         text = _dedent(text, skip_first_line=not text.startswith('\n')).strip()
-        normed_id = re.sub(r'\W', '-', id)
+        normed_id = self._footnote_id_re.sub('-', id)
         # Ensure footnote text ends with a couple newlines (for some
         # block gamut matches).
         self.footnotes[normed_id] = text + "\n\n"
         return ""
 
+    _footnote_id_re = re.compile(r'\W')
+
+    _footnote_def_re_base = r'''
+            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+            [ \t]*
+            (                       # footnote text = \2
+              # First line need not start with the spaces.
+              (?:\s*.*\n+)
+              (?:
+                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+                .*\n+
+              )*
+            )
+            # Lookahead for non-space at line-start, or end of doc.
+            (?:(?=^[ ]{0,%d}\S)|\Z)
+            '''
+
     def _strip_footnote_definitions(self, text):
         """A footnote definition looks like this:
 
@@ -778,23 +1314,8 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
-        return footnote_def_re.sub(self._extract_footnote_def_sub, text)
+        return self._profile._footnote_def_re.sub(
+            self._extract_footnote_def_sub, text)
 
     def _extract_inline_footnote_sub(self, match):
         text = match.group(1).strip()
@@ -805,56 +1326,262 @@ class Markdown(object):
         # Transform it into [^id] so that it can be processed as markdown footnote.
         return '[^%d]' % self.inline_footnote_id
 
+    # Need handle inline links: []()
+    _inline_footnote_re = re.compile(r'\(\^([^()]*?(?:(?:\([^()]*?\))*?[^()]*?)*?)\)')
+
     def _strip_inline_footnotes(self, text):
         """An inline footnote looks like this:
 
             main text(^inline footnote)
         """
-        # Need handle inline links: []()
-        _inline_footnote_re = re.compile(r'\(\^([^()]*?(?:(?:\([^()]*?\))*?[^()]*?)*?)\)')
-        return _inline_footnote_re.sub(self._extract_inline_footnote_sub, text)
+        return self._inline_footnote_re.sub(self._extract_inline_footnote_sub, text)
 
     _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
 
+    # Where a top-level block can start: at a line after a blank line that
+    # does not start with what carries on a block from before it, i.e. with
+    # indentation, the '>' of a block quote or a list item marker.
+    _block_start_re = re.compile(r"\n\n(?=[^\s>])(?![*+-][ \t]|\d+\.[ \t])")
+    _block_tag_line_re = re.compile(r"^<(%s)\b" % _block_tags_a, re.M)
+    _liberal_tag_line_re = re.compile(r"^<(%s)\b" % _block_tags_b, re.M)
+    _block_close_tag_line_re = re.compile(r"^</(%s)>" % _block_tags_a, re.M)
+    _block_close_tag_re = re.compile(r"</(%s)>" % _block_tags_a)
+    _list_marker_only_re = re.compile(r"[ ]*(?:[*+-]|\d+\.)$")
+
+    def _split_blocks(self, text):
+        """Split the text for the block gamut into the texts of its
+        top-level blocks. The block gamut of each of them, joined with blank
+        lines, is that of the whole text.
+        """
+        # The block gamut may still make one block of what goes on from
+        # a block-level HTML tag (closed by HTML it makes later on), of what
+        # goes on to a closing tag (of an HTML block it made before) or of
+        # a fenced code block. And `_hash_html_blocks()` stops looking for
+        # HTML comments of their own at the first one that isn't, so there
+        # are no blocks after a comment left in the text.
+        last_start = len(text)
+        no_split = []
+        if '<' in text:
+            comment_start = text.find("<!--")
+            if comment_start != -1:
+                last_start = comment_start
+            for match in self._block_tag_line_re.finditer(text, 0, last_start):
+                if not self.safe_mode:
+                    last_start = match.start()
+                    break
+                # Any other HTML is hashed by now: this is a fenced code
+                # block, which ends at its first closing tag.
+                no_split.append((match.start(), text.find(
+                    "</%s>" % match.group(1), match.end())))
+        if "fenced-code-blocks" in self.extras and "```" in text:
+            # The fenced code blocks are the first thing the gamut does.
+            for match in self._fenced_code_block_re.finditer(text):
+                no_split.append((text.find("```", match.start()),
+                                 match.end()))
+        no_split.sort()
+
+        starts = [0]
+        first_start = len(text) - len(text.lstrip('\n'))
+        if "\n</" in text:
+            for match in self._block_close_tag_line_re.finditer(text):
+                first_start = match.end()
+        next_no_split = 0
+        no_split_end = -1
+        next_lt = -1
+        for match in self._block_start_re.finditer(text):
+            start = match.end()
+            if start <= first_start:
+                continue
+            elif start > last_start:
+                break
+            while (next_no_split < len(no_split)
+                   and no_split[next_no_split][0] < start):
+                no_split_end = max(no_split_end, no_split[next_no_split][1])
+                next_no_split += 1
+            if start <= no_split_end:
+                continue
+            if next_lt < start:
+                next_lt = text.find('<', start)
+                if next_lt == -1:
+                    next_lt = len(text)
+            if text.startswith("</code>", next_lt):
+                # A code block before it would not be one, see the end of
+                # `_code_block_re_base`.
+                continue
+            line_end = match.start()
+            while line_end and text[line_end - 1] in " \t\n":
+                line_end -= 1
+            if self._list_marker_only_re.match(
+                    text, text.rfind('\n', 0, line_end) + 1, line_end):
+                # The list item it ends is empty: the text after the blank
+                # lines is the item's.
+                continue
+            starts.append(start)
+        starts.append(len(text))
+        return [text[starts[i]:starts[i+1]] for i in range(len(starts) - 1)]
+
+    _setext_underline_re = re.compile(r"(=+|-+)[ \t]*$")
+    _table_underline_re = re.compile(r"[ ]*\|?[ ]*:?-+:?[ ]*\|")
+    _list_marker_re = re.compile(r"[ ]*(?:[*+-]|\d+\.)[ \t]")
+
+    def _block_kind(self, text):
+        """Return what a block from `_split_blocks()` starts with, see
+        `MarkdownBlock`.
+        """
+        lines = text.lstrip('\n').split('\n', 2)
+        first_line = lines[0]
+        second_line = len(lines) > 1 and lines[1] or ''
+        if first_line in self.html_blocks:
+            return "html"
+        elif first_line.startswith('#') or (
+                first_line and self._setext_underline_re.match(second_line)):
+            return "header"
+        elif self._hr_re.match(first_line):
+            return "hr"
+        elif self._list_marker_re.match(first_line):
+            return "list"
+        elif "pyshell" in self.extras and first_line.lstrip().startswith(">>> "):
+            return "code"
+        elif ("wiki-tables" in self.extras and first_line.lstrip().startswith("||")
+              or "tables" in self.extras and '|' in first_line
+                 and self._table_underline_re.match(second_line)):
+            return "table"
+        elif first_line.startswith(' ' * self.tab_width):
+            return "code"
+        elif first_line.lstrip().startswith('>'):
+            return "blockquote"
+        return "paragraph"
+
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
+        text = self._run_block_steps([text])[0]
 
-        if "fenced-code-blocks" in self.extras:
-            text = self._do_fenced_code_blocks(text)
+        # We already ran _hash_html_blocks() before, in Markdown(), but that
+        # was to escape raw HTML in the original Markdown source. This time,
+        # we're escaping the markup we've just created, so that we don't wrap
+        # <p> tags around block-level tags.
+        text = self._hash_html_blocks(text)
 
-        text = self._do_headers(text)
+        text = self._form_paragraphs(text)
 
-        # Do Horizontal Rules:
-        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
-        # you wish, you may use spaces between the hyphens or asterisks."
-        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
-        # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+        return text
 
-        text = self._do_lists(text)
+    def _run_block_steps(self, texts, effects=None):
+        """Run the steps of the block gamut before the hashing of the HTML
+        blocks it made over the given texts, each step over all of them
+        before the next: it's the same as over the texts joined together.
 
+        If a list `effects` is given, `effects[i]` is set to True if the
+        steps over `texts[i]` counted in `_effect_count`.
+        """
+        steps = []
+        if "fenced-code-blocks" in self.extras:
+            steps.append(self._do_fenced_code_blocks)
+        steps.append(self._do_headers)
+        steps.append(self._do_hrs)
+        steps.append(self._do_lists)
         if "pyshell" in self.extras:
-            text = self._prepare_pyshell_blocks(text)
+            steps.append(self._prepare_pyshell_blocks)
         if "wiki-tables" in self.extras:
-            text = self._do_wiki_tables(text)
+            steps.append(self._do_wiki_tables)
         if "tables" in self.extras:
-            text = self._do_tables(text)
-
-        text = self._do_code_blocks(text)
-
-        text = self._do_block_quotes(text)
+            steps.append(self._do_tables)
+        steps.append(self._do_code_blocks)
+        steps.append(self._do_block_quotes)
+
+        texts = list(texts)
+        for step in steps:
+            for i, text in enumerate(texts):
+                if effects is None:
+                    texts[i] = step(text)
+                else:
+                    effect_count = self._effect_count
+                    texts[i] = step(text)
+                    if self._effect_count != effect_count:
+                        effects[i] = True
+        return texts
 
-        # We already ran _hash_html_blocks() before, in Markdown(), but that
-        # was to escape raw HTML in the original Markdown source. This time,
-        # we're escaping the markup we've just created, so that we don't wrap
-        # <p> tags around block-level tags.
-        text = self._hash_html_blocks(text)
+    def _do_hrs(self, text):
+        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
+        # you wish, you may use spaces between the hyphens or asterisks."
+        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
+        # hr chars to one or two. We'll reproduce that limit here.
+        return self._hr_re.sub("\n<hr"+self.empty_element_suffix+"\n", text)
 
-        text = self._form_paragraphs(text)
+    def _render_blocks(self, texts):
+        """Run the block gamut over the texts of consecutive blocks, see
+        `_split_blocks()`, and return the HTML for each group of them that
+        the HTML blocks made by the gamut don't run across. Joined with
+        blank lines, it's the block gamut of the texts joined together.
+        """
+        return self._render_stepped_blocks(self._run_block_steps(texts)) \
+            or [self._form_paragraphs('')]
 
-        return text
+    def _render_stepped_blocks(self, texts):
+        """The rest of `_render_blocks()`, over what `_run_block_steps()`
+        made of the texts. There are no groups if they are all empty.
+        """
+        # Hash the HTML blocks of all the texts at once, with a placeholder
+        # line after each text: one inside an HTML block is taken out of it
+        # again, the others are where the groups are split.
+        end = _block_end_placeholder + "\n\n"
+        first_id = self._placeholder_count + 1
+        text = self._hash_html_blocks(''.join(
+            [text.endswith("\n\n") and text + end or text for text in texts]))
+        for id in range(first_id, self._placeholder_count + 1):
+            key = _placeholder_from_id(id)
+            html = self.html_blocks.get(key)
+            if html is not None and _block_end_placeholder in html:
+                self.html_blocks[key] = html.replace(end, '')
+
+        return [self._form_paragraphs(group) for group in text.split(end)
+                if group.strip('\n')]
+
+    # The tags of the HTML blocks the steps of the block gamut end with a
+    # closing tag at the start of a line.
+    _step_close_tags = frozenset(["ul", "ol", "blockquote", "table"])
+
+    def _iter_render_blocks(self, texts):
+        """Yield what `_render_blocks()` returns for the texts, running the
+        gamut over one text at a time: the HTML of each is made as soon as
+        none of the HTML blocks in it could run on into the texts after. If
+        one could, the texts from it on are converted all at once.
+
+        The texts are taken out of the list as they are converted.
+        """
+        # The tags a closing tag at the start of a line could end after each
+        # text: of the closing tags in the texts after, or made of them by
+        # the steps.
+        later_close_tags = []
+        close_tags = set(self._step_close_tags)
+        for i in range(len(texts) - 1, -1, -1):
+            later_close_tags.append(close_tags)
+            found = self._block_close_tag_re.findall(texts[i])
+            if found:
+                close_tags = close_tags.union(found)
+        later_close_tags.reverse()
+
+        empty = True
+        for i in range(len(texts)):
+            text = self._run_block_steps([texts[i]])[0]
+            texts[i] = None
+            open_tags = set()
+            hashed = self._hash_html_blocks(text, open_tags=open_tags)
+            if i + 1 < len(texts) and not (
+                    text.endswith("\n\n") and None not in open_tags
+                    and not open_tags & later_close_tags[i]):
+                rest = [text] + self._run_block_steps(texts[i + 1:])
+                del texts[i + 1:]
+                for html in self._render_stepped_blocks(rest):
+                    empty = False
+                    yield html
+                break
+            if hashed.strip('\n'):
+                empty = False
+                yield self._form_paragraphs(hashed)
+        if empty:
+            yield self._form_paragraphs('')
 
     def _pyshell_block_sub(self, match):
         lines = match.group(0).splitlines(0)
@@ -865,6 +1592,12 @@ class Markdown(object):
              + '\n\n')
         return s
 
+    _pyshell_block_re_base = r"""
+            ^([ ]{0,%d})>>>[ ].*\n   # first line
+            ^(\1.*\S+.*\n)*         # any number of subsequent lines
+            ^\n                     # ends with a blank line
+            """
+
     def _prepare_pyshell_blocks(self, text):
         """Ensure that Python interactive shell sessions are put in
         code blocks -- even if not properly indented.
@@ -872,14 +1605,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
-        return _pyshell_block_re.sub(self._pyshell_block_sub, text)
+        return self._profile._pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _table_sub(self, match):
         head, underline, body = match.groups()
@@ -922,12 +1648,7 @@ class Markdown(object):
 
         return '\n'.join(hlines) + '\n'
 
-    def _do_tables(self, text):
-        """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
-        https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
-        """
-        less_than_tab = self.tab_width - 1
-        table_re = re.compile(r'''
+    _table_re_base = r'''
                 (?:(?<=\n\n)|\A\n?)             # leading blank line
 
                 ^[ ]{0,%d}                      # allowed whitespace
@@ -948,8 +1669,15 @@ class Markdown(object):
                         .*\|.*  \n
                     )+
                 )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
-        return table_re.sub(self._table_sub, text)
+            '''
+
+    def _do_tables(self, text):
+        """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
+        https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
+        """
+        return self._profile._table_re.sub(self._table_sub, text)
+
+    _wiki_table_cell_splitter = re.compile(r'(?<!\\)\|\|')
 
     def _wiki_table_sub(self, match):
         ttext = match.group(0).strip()
@@ -957,7 +1685,7 @@ class Markdown(object):
         rows = []
         for line in ttext.splitlines(0):
             line = line.strip()[2:-2].strip()
-            row = [c.strip() for c in re.split(r'(?<!\\)\|\|', line)]
+            row = [c.strip() for c in self._wiki_table_cell_splitter.split(line)]
             rows.append(row)
         #pprint(rows)
         hlines = ['<table%s>' % self._html_class_str_from_tag('table'), '<tbody>']
@@ -972,22 +1700,29 @@ class Markdown(object):
         hlines += ['</tbody>', '</table>']
         return '\n'.join(hlines) + '\n'
 
+    _wiki_table_re_base = r'''
+            (?:(?<=\n\n)|\A\n?)            # leading blank line
+            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+            '''
+
     def _do_wiki_tables(self, text):
         # Optimization.
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
-        return wiki_table_re.sub(self._wiki_table_sub, text)
+        return self._profile._wiki_table_re.sub(self._wiki_table_sub, text)
+
+    _break_on_newline_re = re.compile(r" *\n")
+    _hard_break_re = re.compile(r" {2,}\n")
 
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        if ("fused-spans" in self.extras
+                and "smarty-pants" not in self.extras
+                and "link-patterns" not in self.extras):
+            return self._run_fused_span_gamut(text)
 
         text = self._do_code_spans(text)
 
@@ -1013,12 +1748,86 @@ class Markdown(object):
 
         # Do hard breaks:
         if "break-on-newline" in self.extras:
-            text = re.sub(r" *\n", "<br%s\n" % self.empty_element_suffix, text)
+            text = self._break_on_newline_re.sub(
+                "<br%s\n" % self.empty_element_suffix, text)
         else:
-            text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
+            text = self._hard_break_re.sub(
+                " <br%s\n" % self.empty_element_suffix, text)
+
+        return text
+
+    # The auto-links, ampersands and angle brackets of `_run_span_gamut()`
+    # in one regex: the alternatives are those of `_auto_link_re`,
+    # `_auto_email_link_re`, `_ampersand_re`, `_naked_lt_re` and
+    # `_naked_gt_re`, in the order they are applied there.
+    _fused_span_re_base = r"""
+          <(?P<url>(?:https?|ftp):[^'">\s]+)>
+        | <(?:mailto:)?(?P<email>(?:[-.\w]|%s)+\@(?:[-\w]|%s)+
+                                (?:\.(?:[-\w]|%s)+)*\.[a-z]+)>
+        | &(?!\#?[xX]?(?:[0-9a-fA-F]+|\w+);)
+        | <(?![a-z/?\$!]|%s)
+        | (?:(?<![a-z0-9?!/'"%s-])|(?<=%s)|(?<=%s))>
+        """ % ((_placeholder_word_pat,) * 4 + (_PLACEHOLDER_CLOSE,
+               _placeholder_open_placeholder, _placeholder_close_placeholder))
+    _fused_span_re = re.compile(_fused_span_re_base, re.I | re.X | re.U)
+    # Hard breaks can go in too: " <br />\n" begins and ends like the
+    # spaces and newline it replaces, so emphasis finds the same delimiters
+    # around it. Not so for the "break-on-newline" extra's breaks.
+    _fused_span_hard_break_re = re.compile(
+        _fused_span_re_base + r"| [ ]{2,}\n", re.I | re.X | re.U)
+    _backslash_escape_re = re.compile(r"\\([\\`*_{}\[\]()>#+\-.!])")
+
+    def _run_fused_span_gamut(self, text):
+        """The "fused-spans" extra's `_run_span_gamut()`.
+
+        The output is the same, but a step is skipped if the characters it
+        works on are not in the span, backslash escapes are replaced in one
+        pass instead of one per escapable character, and auto-links,
+        ampersands, angle brackets and hard breaks are done in one pass.
+        """
+        if '`' in text:
+            text = self._do_code_spans(text)
+        if '<' in text:
+            text = self._escape_special_chars(text)
+        elif '\\' in text:
+            text = self._backslash_escape_re.sub(
+                lambda m: self._escape_table[m.group(1)], text)
+        if '[' in text:
+            text = self._do_links(text)
+
+        if "break-on-newline" in self.extras:
+            text = self._fused_span_re.sub(self._fused_span_sub, text)
+        else:
+            text = self._fused_span_hard_break_re.sub(
+                self._fused_span_sub, text)
+
+        if '*' in text or ('_' in text and "code-friendly" not in self.extras):
+            text = self._do_italics_and_bold(text)
 
+        if "break-on-newline" in self.extras:
+            text = self._break_on_newline_re.sub(
+                "<br%s\n" % self.empty_element_suffix, text)
         return text
 
+    def _fused_span_sub(self, match):
+        c = match.group()[0]
+        if c == '&':
+            return '&amp;'
+        elif c == '>':
+            return '&gt;'
+        elif c == ' ':
+            return " <br%s\n" % self.empty_element_suffix
+        url = match.group("url")
+        if url is not None:
+            # The URL's own ampersands and angle brackets are encoded
+            # after the link is made in `_run_span_gamut()`.
+            url = self._encode_amps_and_angles(url)
+            return '<a href="%s">%s</a>' % (url, url)
+        elif match.group("email") is not None:
+            return self._encode_email_address(
+                self._unescape_special_chars(match.group("email")))
+        return '&lt;'
+
     # "Sorta" because auto-links are identified as "tag" tokens.
     _sorta_html_tokenize_re = re.compile(r"""
         (
@@ -1051,9 +1860,7 @@ class Markdown(object):
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
                 # italics and strong.  We're replacing each such
-                # character with its corresponding MD5 checksum value;
-                # this is likely overkill, but it should prevent us from
-                # colliding with the escape values by accident.
+                # character with its corresponding placeholder.
                 escaped.append(token.replace('*', self._escape_table['*'])
                                     .replace('_', self._escape_table['_']))
             else:
@@ -1076,7 +1883,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1085,29 +1892,21 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, self.html_spans)
     
     def _math_span_sub(self, match):
         m = match.string[match.start():match.start(2)] + self._encode_code(match.group(2)) + match.string[match.end(2):match.end()]
-        key = _hash_text(m)
+        key = self._hash_text(m)
         self.math_spans[key] = m
         return key
 
     def _hash_math_spans(self, text):
-        _math_span_re = re.compile(r'''
-                (?<!\\)
-                (%s)    # \1 = Opening delimiter
-                (.+?)   # \2 = The math span
-                \1      # Matching closer
-            ''' % re.escape(self.extras['math_delimiter']), re.X)
+        _math_span_re = _math_span_re_from_delimiter(
+            self.extras['math_delimiter'])
         return _math_span_re.sub(self._math_span_sub, text)
 
     def _unhash_math_spans(self, text):
-        for key, sanitized in list(self.math_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, self.math_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1170,17 +1969,37 @@ class Markdown(object):
             i += 1
         return i
 
-    def _extract_url_and_title(self, text, start):
+    def _find_link_tail_end(self, text, start, balance):
+        """Returns the index after the ")" that ends the tail of a link at
+        text[start], its first non-whitespace character after the "(", or
+        None if the brackets in it don't balance out before the end of text.
+        """
+        if text[start] == "<":
+            start = balance.find(start+1, "<", ">")
+            if start is None:
+                return None
+            start += 1
+        end = balance.find(start, "(", ")")
+        if end is None:
+            return None
+        return end + 1
+
+    def _extract_url_and_title(self, text, start, balance=None):
         """Extracts the url and (optional) title from the tail of a link"""
         # text[start] equals the opening parenthesis
         idx = self._find_non_whitespace(text, start+1)
         if idx == len(text):
             return None, None, None
-        end_idx = idx
         has_anglebrackets = text[idx] == "<"
-        if has_anglebrackets:
-            end_idx = self._find_balanced(text, end_idx+1, "<", ">")
-        end_idx = self._find_balanced(text, end_idx, "(", ")")
+        if balance is None:
+            balance = _Balance(text)
+        end_idx = self._find_link_tail_end(text, idx, balance)
+        if end_idx is None:
+            # The tail is all the rest of the text, which has to end in ")"
+            # for it to be a link.
+            end_idx = len(text)
+            if not text.endswith(")") and not text.endswith(")\n"):
+                return None, None, None
         match = self._inline_link_title.search(text, idx, end_idx)
         if not match:
             return None, None, None
@@ -1189,6 +2008,17 @@ class Markdown(object):
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
 
+    def _rejoin_anchor_text(self, text, done, outer):
+        """Returns the rest of `text`, the text of an anchor in `_do_links()`,
+        with the rest of the `outer` texts it is in, as one text.
+        """
+        pieces = [text[done:]]
+        while outer:
+            text, done, balance = outer.pop()
+            pieces.append('</a>')
+            pieces.append(text[done:])
+        return ''.join(pieces)
+
     def _do_links(self, text):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
@@ -1200,10 +2030,26 @@ class Markdown(object):
         """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
+        # The text isn't rebuilt for each link. The output is put together
+        # from `chunks`, `text[done:]` being what is left to output, and the
+        # ']' or ')' that matches a '[' or '(' is looked up in `balance`
+        # rather than found by walking the text.
+        chunks = []
+        done = 0
+        balance = _Balance(text)
+
+        # The text of an anchor is searched for img links before what
+        # follows the anchor. While it is, `text` is the anchor text (as
+        # it is output) and `outer` a stack of `(text, done, balance)` for
+        # the texts it is in, each `done` being where its anchor ends.
+        outer = []
+
         # `anchor_allowed_pos` is used to support img links inside
         # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
+        # pos must be `>= anchor_allowed_pos`. It is a position in the
+        # output; `shift` is what to add to a position in `text` for that.
         anchor_allowed_pos = 0
+        shift = 0
 
         curr_pos = 0
         while True: # Handle the next link.
@@ -1222,158 +2068,194 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
-                break
-            text_length = len(text)
+            start_idx = text.find('[', curr_pos)
+            if start_idx == -1:
+                if not outer:
+                    break
+                # The end of an anchor text: go on after the anchor.
+                chunks.append(text[done:])
+                chunks.append('</a>')
+                anchor_end = len(text) + shift + len('</a>')
+                text, done, balance = outer.pop()
+                curr_pos = done
+                shift = anchor_end - done
+                continue
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = balance.find(start_idx+1, '[', ']')
+            if p is None or p - start_idx >= MAX_LINK_TEXT_SENTINEL:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
                 continue
             link_text = text[start_idx+1:p]
 
+            # The link, if it is one, replaces text[start_idx:end] with
+            # `result`. An anchor's `result_head` is output right away and
+            # its text is searched for more links.
+            result = result_head = None
+
             # Possibly a footnote ref?
             if "footnotes" in self.extras and link_text.startswith("^"):
-                normed_id = re.sub(r'\W', '-', link_text[1:])
+                normed_id = self._footnote_id_re.sub('-', link_text[1:])
                 if normed_id in self.footnotes:
+                    self._effect_count += 1
                     self.footnote_ids.append(normed_id)
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    end = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
-                continue
+                    continue
 
             # Now determine what this is by the remainder.
-            p += 1
-            if p == text_length:
-                return text
+            elif p+1 == len(text):
+                if not outer:
+                    break
+                # Anchor texts are followed by "</a>", which isn't the
+                # remainder of a link.
+                curr_pos = start_idx + 1
+                continue
 
             # Inline anchor or img?
-            if text[p] == '(': # attempt at perf improvement
-                url, title, url_end_idx = self._extract_url_and_title(text, p)
-                if url is not None:
-                    # Handle an inline anchor or img.
-                    is_img = start_idx > 0 and text[start_idx-1] == "!"
-                    if is_img:
-                        start_idx -= 1
-
-                    # We've got to encode these to avoid conflicting
-                    # with italics/bold.
-                    url = url.replace('*', self._escape_table['*']) \
-                             .replace('_', self._escape_table['_'])
-                    if title:
-                        title_str = ' title="%s"' % (
-                            _xml_escape_attr(title)
-                                .replace('*', self._escape_table['*'])
-                                .replace('_', self._escape_table['_']))
-                    else:
-                        title_str = ''
-                    if is_img:
-                        img_class_str = self._html_class_str_from_tag("img")
-                        result = '<img src="%s" alt="%s"%s%s%s' \
-                            % (url.replace('"', '&quot;'),
-                               _xml_escape_attr(link_text),
-                               title_str, img_class_str, self.empty_element_suffix)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
-                        result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    else:
-                        # Anchor not allowed here.
-                        curr_pos = start_idx + 1
+            elif text[p+1] == '(': # attempt at perf improvement
+                p += 1
+                is_img = start_idx > done and text[start_idx-1] == "!"
+                if not is_img and start_idx + shift < anchor_allowed_pos:
+                    # Anchor not allowed here.
+                    curr_pos = start_idx + 1
+                    continue
+                if outer:
+                    idx = self._find_non_whitespace(text, p+1)
+                    if (idx == len(text) or
+                        self._find_link_tail_end(text, idx, balance) is None):
+                        # The tail runs on past the end of the anchor text,
+                        # so join it up with what follows the anchor.
+                        text = self._rejoin_anchor_text(text, done, outer)
+                        balance = _Balance(text)
+                        shift += done
+                        curr_pos = start_idx - done
+                        done = 0
+                        continue
+                url, title, url_end_idx = \
+                    self._extract_url_and_title(text, p, balance)
+                if url is None:
+                    # It isn't markup.
+                    curr_pos = start_idx + 1
                     continue
 
+                # Handle an inline anchor or img.
+                if is_img:
+                    start_idx -= 1
+
+                # We've got to encode these to avoid conflicting
+                # with italics/bold.
+                url = url.replace('*', self._escape_table['*']) \
+                         .replace('_', self._escape_table['_'])
+                if title:
+                    title_str = ' title="%s"' % (
+                        _xml_escape_attr(title)
+                            .replace('*', self._escape_table['*'])
+                            .replace('_', self._escape_table['_']))
+                else:
+                    title_str = ''
+                if is_img:
+                    img_class_str = self._html_class_str_from_tag("img")
+                    result = '<img src="%s" alt="%s"%s%s%s' \
+                        % (url.replace('"', '&quot;'),
+                           _xml_escape_attr(link_text),
+                           title_str, img_class_str, self.empty_element_suffix)
+                else:
+                    result_head = '<a href="%s"%s>' % (url, title_str)
+                    result = '%s%s</a>' % (result_head, link_text)
+                if "smarty-pants" in self.extras:
+                    result = result.replace('"', self._escape_table['"'])
+                end = url_end_idx
+
             # Reference anchor or img?
             else:
-                match = self._tail_of_reference_link_re.match(text, p)
-                if match:
-                    # Handle a reference-style anchor or img.
-                    is_img = start_idx > 0 and text[start_idx-1] == "!"
-                    if is_img:
-                        start_idx -= 1
-                    link_id = match.group("id").lower()
-                    if not link_id:
-                        link_id = link_text.lower()  # for links like [this][]
-                    if link_id in self.urls:
-                        url = self.urls[link_id]
-                        # We've got to encode these to avoid conflicting
-                        # with italics/bold.
-                        url = url.replace('*', self._escape_table['*']) \
-                                 .replace('_', self._escape_table['_'])
-                        title = self.titles.get(link_id)
-                        if title:
-                            before = title
-                            title = _xml_escape_attr(title) \
-                                .replace('*', self._escape_table['*']) \
-                                .replace('_', self._escape_table['_'])
-                            title_str = ' title="%s"' % title
-                        else:
-                            title_str = ''
-                        if is_img:
-                            img_class_str = self._html_class_str_from_tag("img")
-                            result = '<img src="%s" alt="%s"%s%s%s' \
-                                % (url.replace('"', '&quot;'),
-                                   link_text.replace('"', '&quot;'),
-                                   title_str, img_class_str, self.empty_element_suffix)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
-                            result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        else:
-                            # Anchor not allowed here.
-                            curr_pos = start_idx + 1
-                    else:
-                        # This id isn't defined, leave the markup alone.
-                        curr_pos = match.end()
+                match = self._tail_of_reference_link_re.match(text, p+1)
+                if not match:
+                    # It isn't markup.
+                    curr_pos = start_idx + 1
                     continue
+                # Handle a reference-style anchor or img.
+                is_img = start_idx > done and text[start_idx-1] == "!"
+                if is_img:
+                    start_idx -= 1
+                link_id = match.group("id").lower()
+                if not link_id:
+                    link_id = link_text.lower()  # for links like [this][]
+                if link_id not in self.urls:
+                    # This id isn't defined, leave the markup alone.
+                    curr_pos = match.end()
+                    continue
+                if not is_img and start_idx + shift < anchor_allowed_pos:
+                    # Anchor not allowed here.
+                    curr_pos = start_idx + 1
+                    continue
+                url = self.urls[link_id]
+                # We've got to encode these to avoid conflicting
+                # with italics/bold.
+                url = url.replace('*', self._escape_table['*']) \
+                         .replace('_', self._escape_table['_'])
+                title = self.titles.get(link_id)
+                if title:
+                    title = _xml_escape_attr(title) \
+                        .replace('*', self._escape_table['*']) \
+                        .replace('_', self._escape_table['_'])
+                    title_str = ' title="%s"' % title
+                else:
+                    title_str = ''
+                if is_img:
+                    img_class_str = self._html_class_str_from_tag("img")
+                    result = '<img src="%s" alt="%s"%s%s%s' \
+                        % (url.replace('"', '&quot;'),
+                           link_text.replace('"', '&quot;'),
+                           title_str, img_class_str, self.empty_element_suffix)
+                else:
+                    result_head = '<a href="%s"%s>' % (url, title_str)
+                    result = '%s%s</a>' % (result_head, link_text)
+                if "smarty-pants" in self.extras:
+                    result = result.replace('"', self._escape_table['"'])
+                end = match.end()
+
+            chunks.append(text[done:start_idx])
+            if result_head is None:
+                # <img> allowed from after it on.
+                chunks.append(result)
+                shift += len(result) - (end - start_idx)
+                done = curr_pos = end
+                continue
 
-            # Otherwise, it isn't markup.
-            curr_pos = start_idx + 1
-
-        return text
+            # <img> allowed from the anchor text on, <a> from
+            # anchor_allowed_pos on. The anchor text starts a character
+            # early, as an img link at its start looks back for the "!".
+            chunks.append(result[:len(result_head)-1])
+            anchor_allowed_pos = start_idx + shift + len(result)
+            outer.append((text, end, balance))
+            shift += start_idx + len(result_head) - 1
+            text = result[len(result_head)-1:-len('</a>')]
+            done = 0
+            curr_pos = 1
+            if "smarty-pants" in self.extras:
+                # Escaping its quotes made the head longer, and the end of
+                # it is searched along with the anchor text. Brackets in
+                # it may match ones after the anchor text.
+                rest = result_head.replace('"', self._escape_table['"'])[
+                    len(result_head):]
+                if '[' in rest or ']' in rest:
+                    text = self._rejoin_anchor_text(text, done, outer)
+            balance = _Balance(text)
+
+        chunks.append(text[done:])
+        return ''.join(chunks)
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1437,6 +2319,7 @@ class Markdown(object):
             n = min(n + demote_headers, 6)
         header_id_attr = ""
         if "header-ids" in self.extras:
+            self._effect_count += 1
             header_id = self.header_id_from_text(header_group,
                 self.extras["header-ids"], n)
             if header_id:
@@ -1479,19 +2362,7 @@ class Markdown(object):
         else:
             return "<%s>\n%s</%s>\n\n" % (lst_type, result, lst_type)
 
-    def _do_lists(self, text):
-        # Form HTML ordered (numbered) and unordered (bulleted) lists.
-
-        # Iterate over each *non-overlapping* list match.
-        pos = 0
-        while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
+    _whole_list_re_base = r'''
                     (                   # \1 = whole list
                       (                 # \2
                         [ ]{0,%d}
@@ -1511,25 +2382,45 @@ class Markdown(object):
                           )
                       )
                     )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+                '''
+
+    def _do_lists(self, text):
+        # Form HTML ordered (numbered) and unordered (bulleted) lists.
+
+        # Iterate over each *non-overlapping* list match. The text itself is
+        # left alone: the output is put together from the text between the
+        # lists and the HTML of each list, so a text with many lists is not
+        # copied once per list. Searching on in the original text matches
+        # the same lists: the list regexes look back no further than the
+        # newlines ending the previous list, which its HTML ends with too.
+        list_res = self._profile._list_res[bool(self.list_level)]
+        # The next hit for either list style (ul or ol). We match ul and ol
+        # separately to avoid adjacent lists of different types running into
+        # each other (see issue #16).
+        hits = [list_re.search(text) for list_re in list_res]
+        chunks = []
+        pos = 0
+        while True:
+            # Take the *first* hit. A hit of the other style that starts
+            # after this list is still the next one of its style, so each
+            # regex scans the text only once.
+            match = None
+            for hit in hits:
+                if hit and (match is None or hit.start() < match.start()):
+                    match = hit
+            if match is None:
                 break
-            hits.sort()
-            match = hits[0][1]
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle) # start pos for next attempted match
-
-        return text
+            chunks.append(text[pos:start])
+            chunks.append(self._list_sub(match))
+            pos = end # start pos for next attempted match
+            for i, hit in enumerate(hits):
+                if hit and hit.start() < pos:
+                    hits[i] = list_res[i].search(text, pos)
+        if not chunks:
+            return text
+        chunks.append(text[pos:])
+        return ''.join(chunks)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1644,8 +2535,7 @@ class Markdown(object):
 
         if lexer_name:
             def unhash_code( codeblock ):
-                for key, sanitized in list(self.html_spans.items()):
-                    codeblock = codeblock.replace(key, sanitized)
+                codeblock = self._unhash_html_spans(codeblock)
                 replacements = [
                     ("&amp;", "&"),
                     ("&lt;", "<"),
@@ -1682,9 +2572,7 @@ class Markdown(object):
                 return ' class="%s"' % html_classes_from_tag[tag]
         return ""
 
-    def _do_code_blocks(self, text):
-        """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
+    _code_block_re_base = r'''
             (?:\n\n|\A\n?)
             (               # $1 = the code block -- one or more lines, starting with a space/tab
               (?:
@@ -1696,9 +2584,11 @@ class Markdown(object):
             # Lookahead to make sure this block isn't already in a code block.
             # Needed when syntax highlighting is being used.
             (?![^<]*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
-        return code_block_re.sub(self._code_block_sub, text)
+            '''
+
+    def _do_code_blocks(self, text):
+        """Process Markdown `<pre><code>` blocks."""
+        return self._profile._code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
         (?:\n\n|\A\n?)
@@ -1855,8 +2745,10 @@ class Markdown(object):
     _bq_one_level_re_spoiler = re.compile('^[ \t]*>[ \t]*?![ \t]?', re.M);
     _bq_all_lines_spoilers = re.compile(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
     _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _two_spaces_indent_re = re.compile(r'(?m)^  ')
+    _line_start_re = re.compile('(?m)^')
     def _dedent_two_spaces_sub(self, match):
-        return re.sub(r'(?m)^  ', '', match.group(1))
+        return self._two_spaces_indent_re.sub('', match.group(1))
 
     def _block_quote_sub(self, match):
         bq = match.group(1)
@@ -1870,7 +2762,7 @@ class Markdown(object):
         bq = self._ws_only_line_re.sub('', bq)
         bq = self._run_block_gamut(bq)          # recurse
 
-        bq = re.sub('(?m)^', '  ', bq)
+        bq = self._line_start_re.sub('  ', bq)
         # These leading spaces screw with <pre> content, so we need to fix that:
         bq = self._html_pre_block_re.sub(self._dedent_two_spaces_sub, bq)
 
@@ -1887,13 +2779,15 @@ class Markdown(object):
         else:
             return self._block_quote_re.sub(self._block_quote_sub, text)
 
+    _paragraph_splitter = re.compile(r"\n{2,}")
+
     def _form_paragraphs(self, text):
         # Strip leading and trailing lines:
         text = text.strip('\n')
 
         # Wrap <p> tags.
         grafs = []
-        for i, graf in enumerate(re.split(r"\n{2,}", text)):
+        for i, graf in enumerate(self._paragraph_splitter.split(text)):
             if graf in self.html_blocks:
                 # Unhashify HTML blocks
                 grafs.append(self.html_blocks[graf])
@@ -1924,11 +2818,17 @@ class Markdown(object):
 
         return "\n\n".join(grafs)
 
-    def _sort_footnotes(self, text):
+    _footnote_tag_re = re.compile(r'''<sup class="footnote-ref" id="fnref-([^"]+)"><a href="#fn-\1">(\d+)</a></sup>''')
+
+    def _sort_footnotes(self, text, footnote_ids=None):
         """Because _do_links is not applied to the text in text flow order, footnotes are not generated in proper order, we have to sort them before _add_footnotes.
+
+        If a list `footnote_ids` is given, the references in `text` are
+        numbered on from the ids in it, for the HTML in pieces.
         """
-        _footnote_tag_re = re.compile(r'''<sup class="footnote-ref" id="fnref-(.+)"><a href="#fn-\1">(\d+)</a></sup>''')
-        self.footnote_ids = []
+        if footnote_ids is None:
+            footnote_ids = []
+        self.footnote_ids = footnote_ids
         def _repl(match):
             id = match.group(1)
             num = match.group(2)
@@ -1937,7 +2837,7 @@ class Markdown(object):
                 return match.string[match.start(0):match.start(2)] + str(len(self.footnote_ids)) + match.string[match.end(2):match.end(0)]
             else:
                 return match.string[match.start():match.end()]
-        return _footnote_tag_re.sub(_repl, text)        
+        return self._footnote_tag_re.sub(_repl, text)        
     
     def _add_footnotes(self, text):
         if self.footnotes:
@@ -1970,8 +2870,12 @@ class Markdown(object):
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
     _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    # Neither before nor after a placeholder, but for a sentinel in the
+    # document.
+    _naked_lt_re = re.compile(r'<(?![a-z/?\$!]|%s)' % _placeholder_word_pat, re.I)
+    _naked_gt_re = re.compile(r'''(?:(?<![a-z0-9?!/'"%s-])|(?<=%s)|(?<=%s))>'''
+        % (_PLACEHOLDER_CLOSE, _placeholder_open_placeholder,
+           _placeholder_close_placeholder), re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -1997,16 +2901,17 @@ class Markdown(object):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (g1, g1)
 
+    # The placeholders are of the escaped '_'s in the address.
     _auto_email_link_re = re.compile(r"""
           <
            (?:mailto:)?
           (
-              [-.\w]+
+              (?:[-.\w]|%s)+
               \@
-              [-\w]+(\.[-\w]+)*\.[a-z]+
+              (?:[-\w]|%s)+(\.(?:[-\w]|%s)+)*\.[a-z]+
           )
           >
-        """, re.I | re.X | re.U)
+        """ % ((_placeholder_word_pat,) * 3), re.I | re.X | re.U)
     def _auto_email_link_sub(self, match):
         return self._encode_email_address(
             self._unescape_special_chars(match.group(1)))
@@ -2029,6 +2934,7 @@ class Markdown(object):
         #
         #  Based on a filter by Matthew Wickline, posted to the BBEdit-Talk
         #  mailing list: <http://tinyurl.com/yu7ue>
+        self._effect_count += 1
         chars = [_xml_encode_email_char_at_random(ch)
                  for ch in "mailto:" + addr]
         # Strip the mailto: from the visible part.
@@ -2060,18 +2966,14 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return self._unhash(text, link_from_hash)
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        return self._unhash(text, self._unescape_table)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2153,6 +3055,29 @@ def _slugify(value):
 ## end of http://code.activestate.com/recipes/577257/ }}}
 
 
+def _extras_dict(extras):
+    """Return a new dict of the given extras, which may also be a list of
+    extra names.
+    """
+    if extras is None:
+        return {}
+    elif isinstance(extras, dict):
+        return extras.copy()
+    else:
+        return dict([(e, None) for e in extras])
+
+def _frozen(value):
+    """Return a hashable equivalent of a structure of dicts and lists, for
+    use as a cache key. Raises TypeError if there is none.
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted([(k, _frozen(v))
+                                    for k, v in value.items()])))
+    elif isinstance(value, (list, tuple)):
+        return (list, tuple([_frozen(v) for v in value]))
+    hash(value)
+    return value
+
 # From http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/52549
 def _curry(*args, **kwargs):
     function, args = args[0], args[1:]
@@ -2343,6 +3268,53 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _math_span_re_from_delimiter(delimiter):
+    return re.compile(r'''
+            (?<!\\)
+            (%s)    # \1 = Opening delimiter
+            (.+?)   # \2 = The math span
+            \1      # Matching closer
+        ''' % re.escape(delimiter), re.X)
+_math_span_re_from_delimiter = _memoized(_math_span_re_from_delimiter)
+
+class _Balance(object):
+    """Where brackets balance out in a text, looked up rather than walked.
+
+    `find(start, "(", ")")` returns the index of the first ")" at or after
+    `start` that closes more "(" than were opened since `start`, i.e. where
+    `Markdown._find_balanced()` stops, or None if the text ends first. The
+    first lookup for a pair of brackets takes one pass over the text, every
+    one after that a binary search.
+    """
+    def __init__(self, text):
+        self.text = text
+        self._tables = {}
+
+    def find(self, start, open_c, close_c):
+        try:
+            positions, closes = self._tables[open_c, close_c]
+        except KeyError:
+            positions, closes = self._tables[open_c, close_c] \
+                = self._table(open_c, close_c)
+        return closes[bisect_left(positions, start)]
+
+    def _table(self, open_c, close_c):
+        text = self.text
+        positions = [match.start() for match in
+                     re.finditer("[%s]" % re.escape(open_c + close_c), text)]
+        # `balance[k]` is the index in `positions` of where a walk starting
+        # at `positions[k]` balances out. A walk starting at an open
+        # bracket first goes through to the one closing it, which is where
+        # a walk starting right after it balances out, and on from there.
+        balance = [None] * (len(positions) + 1)
+        for k in range(len(positions) - 1, -1, -1):
+            if text[positions[k]] == close_c:
+                balance[k] = k
+            elif balance[k+1] is not None:
+                balance[k] = balance[balance[k+1] + 1]
+        return positions, [None if k is None else positions[k]
+                           for k in balance]
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -2421,9 +3393,16 @@ def main(argv=None):
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      help="convert several PATHS with N processes "
+                           "(0 for one per CPU, default 1)")
+    parser.add_option("-o", "--output-dir", metavar="DIR",
+                      help="write each PATH to DIR/<name>.html instead "
+                           "of stdout")
     parser.set_defaults(log_level=logging.INFO, compare=False,
-                        encoding="utf-8", safe_mode=None, use_file_vars=False)
-    opts, paths = parser.parse_args()
+                        encoding="utf-8", safe_mode=None, use_file_vars=False,
+                        jobs=1, output_dir=None)
+    opts, paths = parser.parse_args(argv[1:])
     log.setLevel(opts.log_level)
 
     if opts.self_test:
@@ -2470,6 +3449,26 @@ def main(argv=None):
                        "Markdown.pl")
     if not paths:
         paths = ['-']
+    if opts.output_dir:
+        if '-' in paths:
+            parser.error("cannot use stdin with --output-dir")
+        paths_from_html_path = {}
+        for path in paths:
+            html_path = _html_path_from_path(path, opts.output_dir)
+            if html_path in paths_from_html_path:
+                parser.error("`%s' and `%s' would both be written to `%s'"
+                             % (paths_from_html_path[html_path], path,
+                                html_path))
+            paths_from_html_path[html_path] = path
+        if not os.path.isdir(opts.output_dir):
+            try:
+                os.makedirs(opts.output_dir)
+            except OSError:
+                _, ex, _ = sys.exc_info()
+                parser.error("cannot create output dir: %s" % ex)
+    if ((len(paths) > 1 or opts.output_dir) and '-' not in paths
+            and not opts.compare):
+        return _convert_paths(paths, opts, extras, link_patterns)
     for path in paths:
         if path == '-':
             text = sys.stdin.read()
@@ -2515,6 +3514,47 @@ def main(argv=None):
                 norm_perl_html = perl_html
             print("==== match? %r ====" % (norm_perl_html == norm_html))
 
+def _convert_paths(paths, opts, extras, link_patterns):
+    """Convert the `main()` PATHS with `convert_many()`.
+
+    Returns 1 if any of them failed, else None.
+    """
+    htmls = convert_many(paths, workers=opts.jobs or None, paths=True,
+        encoding=opts.encoding, html4tags=opts.html4tags,
+        safe_mode=opts.safe_mode, extras=extras,
+        link_patterns=link_patterns, use_file_vars=opts.use_file_vars)
+    failed = False
+    for path, html in zip(paths, htmls):
+        if isinstance(html, MarkdownError):
+            log.error(html)
+            failed = True
+        elif opts.output_dir:
+            html_path = _html_path_from_path(path, opts.output_dir)
+            try:
+                fp = codecs.open(html_path, 'w', "utf-8")
+                try:
+                    fp.write(html)
+                finally:
+                    fp.close()
+            except EnvironmentError:
+                _, ex, _ = sys.exc_info()
+                log.error("%s: %s", path, ex)
+                failed = True
+            else:
+                log.debug("wrote `%s'", html_path)
+        elif py3:
+            sys.stdout.write(html)
+        else:
+            sys.stdout.write(html.encode(
+                sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
+    if failed:
+        return 1
+
+def _html_path_from_path(path, output_dir):
+    """Where `main()` writes the HTML of `path` with --output-dir."""
+    from os.path import basename, join, splitext
+    return join(output_dir, splitext(basename(path))[0] + ".html")
+
 
 if __name__ == "__main__":
     sys.exit( main(sys.argv) )
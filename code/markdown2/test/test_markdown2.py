@@ -171,6 +171,55 @@ class _MarkdownTestCase(unittest.TestCase):
         if metadata:
             self.assertEqual(python_html.metadata, metadata)
 
+    def _assertMarkdownWaysPath(self, text_path, encoding="utf-8", opts=None):
+        """Assert that the other ways to convert a text with markdown2.py
+        produce the same HTML as `convert()`: `render_html(parse())`,
+        `convert_incremental()` after a changed version, `iter_convert()`,
+        and the "fused-spans" extra (with some more extras too).
+        """
+        import random
+        text = codecs.open(text_path, 'r', encoding=encoding).read()
+        opts = dict(opts or {})
+        opts.pop("use_file_vars", None)
+        random.seed(0)  # for the email address encoding
+        expected = markdown2.Markdown(**opts).convert(text)
+
+        def assertConverted(html, how):
+            self.assertEqual(html, expected, "%s of %s" % (how, text_path))
+            self.assertEqual(getattr(html, "toc_html", None),
+                             getattr(expected, "toc_html", None))
+
+        md = markdown2.Markdown(**opts)
+        document = md.parse(text)
+        for i in range(2):
+            random.seed(0)
+            assertConverted(md.render_html(document), "render_html()")
+
+        md = markdown2.Markdown(**opts)
+        paras = text.split("\n\n")
+        paras[len(paras) // 2] += " changed"
+        md.convert_incremental("\n\n".join(paras))
+        random.seed(0)
+        assertConverted(md.convert_incremental(text), "convert_incremental()")
+
+        random.seed(0)
+        pieces = list(markdown2.Markdown(**opts).iter_convert(text))
+        self.assertEqual(''.join(pieces), expected,
+                         "iter_convert() of %s" % text_path)
+        self.assertEqual(getattr(pieces[-1], "toc_html", None),
+                         getattr(expected, "toc_html", None))
+
+        for extras in (opts.get("extras"), ["code-friendly"],
+                       ["break-on-newline", "footnotes"]):
+            random.seed(0)
+            html = markdown2.markdown(text, **dict(opts, extras=extras))
+            extras = markdown2._extras_dict(extras)
+            extras["fused-spans"] = None
+            random.seed(0)
+            self.assertEqual(
+                markdown2.markdown(text, **dict(opts, extras=extras)), html,
+                "\"fused-spans\" of %s" % text_path)
+
     def generate_tests(cls):
         """Add test methods to this class for each test file in
         `cls.cases_dir'.
@@ -202,8 +251,8 @@ class _MarkdownTestCase(unittest.TestCase):
                                          metadata_path=m)
 
             tags_path = splitext(text_path)[0] + ".tags"
+            tags = []
             if exists(tags_path):
-                tags = []
                 for line in open(tags_path):
                     if '#' in line: # allow comments in .tags files
                         line = line[:line.index('#')]
@@ -216,6 +265,14 @@ class _MarkdownTestCase(unittest.TestCase):
             name = re.sub("[(),]", "", name)
             test_name = "test_%s" % name
             setattr(cls, test_name, test_func)
+
+            # Code coloring has nothing to do with the other ways to convert.
+            if "pygments" not in tags:
+                ways_func = lambda self, t=text_path, o=opts: \
+                    self._assertMarkdownWaysPath(t, opts=o)
+                ways_func.tags = tags + ["parse", "incremental", "streaming",
+                                         "fused-spans"]
+                setattr(cls, test_name + "_ways", ways_func)
     generate_tests = classmethod(generate_tests)
 
 class TMTestCase(_MarkdownTestCase):
@@ -297,6 +354,304 @@ versions of markdown2.py this was pathologically slow:</p>
             '<h2>%s</h2>\n' % ko)
     test_russian.tags = ["unicode", "issue3"]
 
+    def test_private_use_chars(self):
+        # Placeholders are made of private use characters; the same
+        # characters in the text must come through untouched.
+        placeholder = '\ue000\ue100\ue001'
+        self._assertMarkdown(
+            'a %s b \ue000 \\* <b>%s</b> $x\ue000$' % (placeholder, placeholder),
+            '<p>a %s b \ue000 * &lt;b&gt;%s&lt;/b&gt; $x\ue000$</p>\n'
+                % (placeholder, placeholder),
+            opts={"safe_mode": "escape", "extras": {"math_delimiter": "$"}})
+        # Nor may they work as placeholders in the span regexes.
+        for extras in ([], ["fused-spans"]):
+            self._assertMarkdown("3 \ue001> 2 \ue000> 1 <a\ue100b@x.com>",
+                                 "<p>3 \ue001&gt; 2 \ue000&gt; 1 "
+                                 "<a\ue100b@x.com></p>\n",
+                                 opts={"extras": extras})
+    test_private_use_chars.tags = ["unicode", "safe_mode"]
+
+    def test_many_html_spans(self):
+        import time
+        text = "Some <b>bold</b>, <i>italic</i> and $math$ \\*.\n\n" * 2000
+        start = time.time()
+        html = markdown2.markdown(text, safe_mode="escape",
+                                  extras={"math_delimiter": "$"})
+        delta = time.time() - start
+        self.assertEqual(html.count("&lt;b&gt;bold&lt;/b&gt;"), 2000)
+        self.assertTrue(delta < 2.0, "It took more than 2s to convert "
+            "2000 paragraphs of HTML spans. It took %.2fs. Too slow!" % delta)
+    test_many_html_spans.tags = ["perf", "safe_mode"]
+
+    def test_many_math_spans(self):
+        import time
+        text = " ".join("$x_%d$ \\_" % i for i in range(20000))
+        start = time.time()
+        html = markdown2.markdown(text, extras={"math_delimiter": "$"})
+        delta = time.time() - start
+        self.assertEqual(html, "<p>%s</p>\n"
+            % " ".join("$x_%d$ _" % i for i in range(20000)))
+        self.assertTrue(delta < 2.0, "It took more than 2s to convert "
+            "20000 math spans. It took %.2fs. Too slow!" % delta)
+    test_many_math_spans.tags = ["perf", "math"]
+
+    def _convert_time(self, text, **opts):
+        import time
+        best = None
+        for i in range(3):
+            start = time.time()
+            html = markdown2.markdown(text, **opts)
+            delta = time.time() - start
+            if best is None or delta < best:
+                best = delta
+        return html, best
+
+    def _assertLinear(self, make_text, tags, **opts):
+        # Ten times the items should take about ten times as long, not a
+        # hundred times.
+        html, small = self._convert_time(make_text(1000), **opts)
+        html, large = self._convert_time(make_text(10000), **opts)
+        for tag, count in tags.items():
+            self.assertEqual(html.count(tag), count)
+        self.assertTrue(large < 30 * max(small, 0.005),
+            "Converting 10000 items took %.2fs, 1000 took %.3fs. "
+            "Not linear!" % (large, small))
+
+    def test_many_list_items(self):
+        self._assertLinear(
+            lambda n: "".join("- item %d\n" % i for i in range(n)),
+            {"<ul>": 1, "<li>": 10000})
+    test_many_list_items.tags = ["perf"]
+
+    def test_many_lists(self):
+        self._assertLinear(
+            lambda n: "".join(("%d. one\n\npara\n\n" if i % 3 else
+                               "- two %d\n\npara\n\n") % i
+                              for i in range(n)),
+            {"<ul>": 3334, "<ol>": 6666, "<li>": 10000})
+    test_many_lists.tags = ["perf"]
+
+    def test_many_nested_lists(self):
+        self._assertLinear(
+            lambda n: "".join("- item %d\n    1. sub\n\ntext\n\n" % i
+                              for i in range(n // 2)),
+            {"<ul>": 5000, "<ol>": 5000, "<li>": 10000},
+            extras=["cuddled-lists"])
+    test_many_nested_lists.tags = ["perf"]
+
+    def test_many_brackets(self):
+        self._assertLinear(
+            lambda n: " ".join("a[%d] = f(x[%d]) and [b](c)" % (i, i)
+                               for i in range(n)),
+            {"<a href": 10000, "x[9999]": 1})
+    test_many_brackets.tags = ["perf", "links"]
+
+    def test_many_footnote_refs(self):
+        self._assertLinear(
+            lambda n: " ".join("[a](b) ![c](d) [e][f] [^1]" for i in range(n))
+                      + "\n\n[f]: g\n[^1]: Note.",
+            {'<a href="b">': 10000, '<img src="d"': 10000,
+             '<a href="g">': 10000, 'id="fnref-1"': 10000},
+            extras=["footnotes"])
+    test_many_footnote_refs.tags = ["perf", "links", "footnotes"]
+
+    def test_links_in_link_text(self):
+        self._assertMarkdown(
+            '[![img](i.png "t")](http://x) and [see [1]](u)',
+            '<p><a href="http://x"><img src="i.png" alt="img" title="t" /></a>'
+            ' and <a href="u">see [1]</a></p>\n')
+        self._assertMarkdown(
+            '[![a][r] ![b](c)](d) [a [b](c](d)\n\n[r]: e',
+            '<p><a href="d"><img src="e" alt="a" /> <img src="c" alt="b" /></a>'
+            ' <a href="d">a [b](c</a></p>\n')
+    test_links_in_link_text.tags = ["links"]
+
+    def test_fused_spans(self):
+        # See also `_assertMarkdownWaysPath()`.
+        self._assertMarkdown(
+            "a & b <http://x?a&b> **c  \nd**\n<y@z.com>",
+            '<p>a &amp; b <a href="http://x?a&amp;b">http://x?a&amp;b</a>'
+            ' <strong>c <br />\nd</strong>\n<a href="mailto:y@z.com">'
+            'y@z.com</a></p>\n',
+            opts={"extras": ["fused-spans"]})
+    test_fused_spans.tags = ["extras", "fused-spans"]
+
+    def test_parse_blocks(self):
+        md = markdown2.Markdown(extras=["tables"])
+        text = ("# Title\n\nSome *text*.\nMore.\n\n    code\n\n---\n\n"
+                "<div>\nx\n</div>\n\na | b\n--|--\n1 | 2\n")
+        document = md.parse(text)
+        self.assertEqual([block.kind for block in document.blocks],
+                         ["header", "paragraph", "hr", "html", "table"])
+        self.assertEqual(md.render_html(document), md.convert(text))
+        # Indented lines, list items and quotes may belong to the block
+        # before them, so they start a block only at the top.
+        for text, kind in (("- a\n\n- b\n", "list"), ("    code\n", "code"),
+                           ("> quote\n\n> more\n", "blockquote"),
+                           ("Title\n=====\n", "header"),
+                           # What follows an empty list item is the item's.
+                           ("- \n\ncarrots", "list"), ("1. \n\none", "list"),
+                           (" - \n\n# Head", "list")):
+            document = md.parse(text)
+            self.assertEqual([block.kind for block in document.blocks],
+                             [kind])
+            self.assertEqual(md.render_html(document), md.convert(text))
+        # The "</pre>" ends the "<pre>" the code block is made into.
+        text = "    code\n\n---\n</pre>\n\nAfter.\n"
+        document = md.parse(text)
+        self.assertEqual([block.kind for block in document.blocks],
+                         ["code", "paragraph"])
+        self.assertEqual(md.render_html(document), md.convert(text))
+    test_parse_blocks.tags = ["parse"]
+
+    def test_convert_incremental_blocks(self):
+        class CountingMarkdown(markdown2.Markdown):
+            converted = 0
+            def _run_block_steps(self, texts, effects=None):
+                if effects is not None:
+                    self.converted += len(texts)
+                return markdown2.Markdown._run_block_steps(self, texts,
+                                                           effects)
+        text = ("# Title\n\nA [link][1] and a note[^n].\n\n- a\n- b\n\n"
+                "    code\n\nThe end.\n\n[1]: /one\n[^n]: The note.\n")
+        md = CountingMarkdown(extras=["footnotes", "header-ids", "toc"])
+        versions = [
+            text,
+            text.replace("The end.", "The very end."),
+            text.replace("- b", "- b\n- c"),
+            text.replace("[1]: /one", "[1]: /two"),
+            text.replace("# Title", "# Title\n\n## Title"),
+        ]
+        for version in versions:
+            md.converted = 0
+            html = md.convert_incremental(version)
+            expected = markdown2.Markdown(
+                extras=["footnotes", "header-ids", "toc"]).convert(version)
+            self.assertEqual(html, expected)
+            self.assertEqual(html.toc_html, expected.toc_html)
+            if version is versions[1]:
+                # The changed paragraph, and the ones with a header id and
+                # a footnote reference.
+                self.assertEqual(md.converted, 3)
+    test_convert_incremental_blocks.tags = ["incremental"]
+
+    def test_convert_to(self):
+        import io
+        text = ("# Title\n\nA note[^2].\n\n- a\n- b\n\n<div>\nraw\n</div>\n\n"
+                "Another note[^1].\n\n[^1]: One.\n[^2]: Two.\n")
+        extras = ["footnotes", "toc"]
+        expected = markdown2.Markdown(extras=extras).convert(text)
+        pieces = list(markdown2.Markdown(extras=extras).iter_convert(text))
+        self.assertEqual(pieces[:4], [
+            '<h1 id="title">Title</h1>',
+            '\n\n<p>A note<sup class="footnote-ref" id="fnref-2">'
+            '<a href="#fn-2">1</a></sup>.</p>\n\n'
+            '<ul>\n<li>a</li>\n<li>b</li>\n</ul>',
+            '\n\n<div>\nraw\n</div>',
+            '\n\n<p>Another note<sup class="footnote-ref" id="fnref-1">'
+            '<a href="#fn-1">2</a></sup>.</p>',
+        ])
+        self.assertEqual(''.join(pieces), expected)
+        self.assertEqual(pieces[-1].toc_html, expected.toc_html)
+
+        fp = io.StringIO()
+        markdown2.Markdown(extras=extras).convert_to(text, fp)
+        self.assertEqual(fp.getvalue(), expected)
+
+        # The gamut leaves "<ol>" and "<p>" lines of this list unhashed:
+        # the blocks from it on are converted all at once.
+        text = ("- a\n    - b\n\n    c\n- d\n    2. e\n        - f\n- g\n\n"
+                "After.\n\n- h\n\nEnd.")
+        self.assertEqual(''.join(markdown2.Markdown().iter_convert(text)),
+                         markdown2.markdown(text))
+    test_convert_to.tags = ["streaming"]
+
+    def test_convert_many(self):
+        import io
+        texts = ["# Title %d\n\nSome *text* %d.\n" % (i, i)
+                 for i in range(20)]
+        expected = [markdown2.markdown(t, extras=["toc"]) for t in texts]
+        for workers in (1, 2):
+            htmls = list(markdown2.convert_many(iter(texts), workers=workers,
+                                                chunksize=3, extras=["toc"]))
+            self.assertEqual(htmls, expected)
+            self.assertEqual(htmls[5].toc_html, expected[5].toc_html)
+
+        import tempfile, shutil
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name in ("one.md", "two.text"):
+                path = join(tmp_dir, name)
+                fp = codecs.open(path, 'w', 'utf-8')
+                fp.write("*%s*\n" % name)
+                fp.close()
+                paths.append(path)
+            missing = join(tmp_dir, "missing.md")
+            htmls = list(markdown2.convert_many(
+                [paths[0], missing, paths[1]], workers=2, paths=True))
+            self.assertEqual(htmls[0], "<p><em>one.md</em></p>\n")
+            self.assertTrue(isinstance(htmls[1], markdown2.MarkdownError))
+            self.assertTrue(str(htmls[1]).startswith(missing + ": "))
+            self.assertEqual(htmls[2], "<p><em>two.text</em></p>\n")
+
+            # The output dir is made as needed.
+            html_dir = join(tmp_dir, "html", "all")
+            self.assertEqual(markdown2.main(
+                ["markdown2", "-j", "2", "-o", html_dir] + paths), None)
+            self.assertEqual(sorted(os.listdir(html_dir)),
+                             ["one.html", "two.html"])
+            fp = codecs.open(join(html_dir, "two.html"), 'r', 'utf-8')
+            self.assertEqual(fp.read(), htmls[2])
+            fp.close()
+
+            # Files with the same name in different dirs are an error, found
+            # before anything is converted.
+            os.mkdir(join(tmp_dir, "sub"))
+            other = join(tmp_dir, "sub", "one.md")
+            fp = codecs.open(other, 'w', 'utf-8')
+            fp.write("*other*\n")
+            fp.close()
+            html_dir = join(tmp_dir, "html", "clash")
+            stderr = sys.stderr
+            sys.stderr = io.StringIO()
+            try:
+                self.assertRaises(SystemExit, markdown2.main,
+                    ["markdown2", "-o", html_dir, paths[0], other])
+            finally:
+                sys.stderr = stderr
+            self.assertFalse(exists(html_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+    test_convert_many.tags = ["convert_many"]
+
+    def test_profile(self):
+        text = "A note[^1] and *more*.\n\n    code\n\n[^1]: The note."
+        profile = markdown2.MarkdownProfile(tab_width=2,
+                                            extras={"footnotes": None})
+        expected = markdown2.markdown(text, tab_width=2, extras=["footnotes"])
+        for i in range(3):
+            self.assertEqual(markdown2.Markdown(profile=profile).convert(text),
+                             expected)
+        self.assertEqual(markdown2.Markdown(profile=profile).tab_width, 2)
+    test_profile.tags = ["profile"]
+
+    def test_profile_cache(self):
+        pre_classes = {"pre": "prettyprint"}
+        first = markdown2.Markdown(extras={"html-classes": pre_classes})
+        second = markdown2.Markdown(extras={"html-classes": {"pre": "prettyprint"}})
+        self.assertTrue(first._profile is second._profile)
+        # Changing the options must not change what the cached profile does.
+        pre_classes["pre"] = "other"
+        self.assertEqual(
+            markdown2.markdown("    code", extras={"html-classes": {"pre": "prettyprint"}}),
+            '<pre class="prettyprint"><code>code\n</code></pre>\n')
+        third = markdown2.Markdown(extras={"html-classes": pre_classes})
+        self.assertTrue(third._profile is not first._profile)
+        # Unhashable options are fine, just not cached.
+        markdown2.markdown("*x*", extras={"html-classes": {"pre": set(["a"])}})
+    test_profile_cache.tags = ["profile"]
+
 
 class DocTestsTestCase(unittest.TestCase):
     def test_api(self):
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""Benchmark full and incremental builds of Letterpress on a generated press
+folder.
+
+Letterpress runs as it does in production, watching the press folder, and a
+build counts as done when its metrics file is rewritten and then stays put.
+The scenarios are:
+
+    cold_build        first build, no site and no metadata index
+    single_post_edit  one post changed
+    post_delete       one post removed
+    template_edit     the post template changed, rebuilding the whole site
+    bulk_import       many new posts moved into the press folder at once
+    warm_restart      restart with the site and the metadata index in place
+
+Results go to stdout, or --output, as JSON. With --compare the results are
+checked against an earlier JSON file and the exit status is 1 if any scenario
+got slower than --threshold allows.
+
+Example:
+    python3 bench_build.py -n 2000 -o baseline.json
+    python3 bench_build.py -n 2000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import gen_press
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+LETTERPRESS = os.path.join(CODE_DIR, 'letterpress.py')
+MARKDOWN2_LIB = os.path.join(CODE_DIR, 'markdown2', 'lib')
+
+SCENARIOS = ('cold_build', 'single_post_edit', 'post_delete',
+             'template_edit', 'bulk_import', 'warm_restart')
+
+_stage_seconds_re = re.compile(
+    r'^letterpress_stage_seconds_total\{(?:site="(?:[^"\\]|\\.)*",)?stage="([^"]+)"\} (\S+)$', re.M)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Site(object):
+    """A generated press folder and the Letterpress process watching it."""
+
+    def __init__(self, work_dir, options):
+        self.options = options
+        self.press_dir = os.path.join(work_dir, 'press')
+        self.site_dir = os.path.join(work_dir, 'site')
+        self.metrics_path = os.path.join(work_dir, 'letterpress.prom')
+        self.log_path = os.path.join(work_dir, 'letterpress.log')
+        self.staging_dir = os.path.join(work_dir, 'staging')
+        self.process = None
+
+    def generate(self):
+        gen_press.generate_press(self.press_dir, self.site_dir, self.options.posts,
+                                 self.options.seed, self.options.assets,
+                                 config_extra={'metrics_file': self.metrics_path})
+
+    def start(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [MARKDOWN2_LIB, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            [sys.executable, self.options.letterpress, self.press_dir,
+             '--log-file', self.log_path], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        if not self.process:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def metrics_state(self):
+        try:
+            stat = os.stat(self.metrics_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def stage_seconds(self):
+        try:
+            with open(self.metrics_path, encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return {}
+        return {stage: float(value) for stage, value in _stage_seconds_re.findall(text)}
+
+    def wait_idle(self, previous_state):
+        """Wait until the metrics file has been rewritten since previous_state
+        and then left alone for the settle time. Return when it was last
+        written, in time.time_ns() nanoseconds.
+        """
+        deadline = time.monotonic() + self.options.timeout
+        state = previous_state
+        changed_at = None
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise BenchmarkError('Letterpress exited with status {0}, see {1}'.format(
+                    self.process.returncode, self.log_path))
+            current = self.metrics_state()
+            if current != state:
+                state = current
+                changed_at = time.monotonic()
+            elif changed_at is not None and time.monotonic() - changed_at >= self.options.settle:
+                return state[1]
+            time.sleep(0.005)
+        raise BenchmarkError('Timed out waiting for the build to finish')
+
+
+def measure(site, action):
+    """Run action and return the seconds until Letterpress is idle again and
+    the seconds each build stage took meanwhile.
+    """
+    state = site.metrics_state()
+    stages = site.stage_seconds()
+    started = time.time_ns()
+    action()
+    finished = site.wait_idle(state)
+    stage_deltas = {stage: round(seconds - stages.get(stage, 0.0), 6)
+                    for stage, seconds in site.stage_seconds().items()
+                    if seconds != stages.get(stage, 0.0)}
+    return max(0, finished - started) / 1e9, stage_deltas
+
+
+def run_once(work_dir, options):
+    """Run every scenario on a freshly generated site."""
+    site = Site(work_dir, options)
+    site.generate()
+    results = {}
+    try:
+        results['cold_build'] = measure(site, site.start)
+
+        post_path = os.path.join(
+            site.press_dir, 'post-{0:05d}.md'.format(options.posts // 2))
+
+        def edit_post():
+            with open(post_path, 'a', encoding='utf-8') as f:
+                f.write('\nOne more paragraph.\n')
+        results['single_post_edit'] = measure(site, edit_post)
+
+        results['post_delete'] = measure(site, lambda: os.remove(post_path))
+
+        def edit_template():
+            with open(os.path.join(site.press_dir, 'templates', 'post.html'), 'a', encoding='utf-8') as f:
+                f.write('<!-- edited -->\n')
+        results['template_edit'] = measure(site, edit_template)
+
+        os.makedirs(site.staging_dir)
+        new_posts = gen_press.write_posts(
+            site.staging_dir, options.import_posts, options.seed, start=options.posts)
+
+        def import_posts():
+            for path in new_posts:
+                os.rename(path, os.path.join(
+                    site.press_dir, os.path.basename(path)))
+        results['bulk_import'] = measure(site, import_posts)
+
+        site.stop()
+        os.remove(site.metrics_path)
+        results['warm_restart'] = measure(site, site.start)
+    finally:
+        site.stop()
+    return results
+
+
+def run(options):
+    runs = []
+    for _ in range(options.repeat):
+        work_dir = tempfile.mkdtemp(prefix='letterpress-bench-')
+        try:
+            runs.append(run_once(work_dir, options))
+        finally:
+            if options.keep:
+                print('Kept', work_dir, file=sys.stderr)
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    scenarios = {}
+    for name in SCENARIOS:
+        seconds = [one_run[name][0] for one_run in runs]
+        median = statistics.median(seconds)
+        # Stages of the run closest to the median.
+        stages = min(runs, key=lambda one_run: abs(
+            one_run[name][0] - median))[name][1]
+        scenarios[name] = {'seconds': round(median, 6),
+                           'runs': [round(s, 6) for s in seconds],
+                           'stages': stages}
+    return {
+        'version': 1,
+        'parameters': {'posts': options.posts, 'assets': options.assets,
+                       'import_posts': options.import_posts,
+                       'seed': options.seed, 'repeat': options.repeat,
+                       'settle': options.settle},
+        'environment': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'scenarios': scenarios,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print how each scenario changed against baseline. Return whether all
+    of them are within threshold, a fraction.
+    """
+    if results['parameters'] != baseline.get('parameters'):
+        print('Warning: the baseline was run with different parameters',
+              file=sys.stderr)
+    ok = True
+    print('{0:<18} {1:>10} {2:>10} {3:>8}'.format(
+        'scenario', 'baseline', 'current', 'change'))
+    for name in SCENARIOS:
+        current = results['scenarios'][name]['seconds']
+        before = baseline['scenarios'].get(name, {}).get('seconds')
+        if not before:
+            print('{0:<18} {1:>10} {2:>10.3f}'.format(name, '-', current))
+            continue
+        change = current / before - 1
+        regressed = change > threshold
+        ok = ok and not regressed
+        print('{0:<18} {1:>10.3f} {2:>10.3f} {3:>+7.1%}{4}'.format(
+            name, before, current, change, ' REGRESSED' if regressed else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Letterpress builds on a generated press folder.')
+    parser.add_argument('-n', '--posts', type=int, default=1000)
+    parser.add_argument('--assets', type=int, default=100)
+    parser.add_argument('--import-posts', type=int, default=100,
+                        help='posts moved in at once by bulk_import')
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per scenario, the median is reported')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds without a metrics update that count as idle')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for one scenario')
+    parser.add_argument('--letterpress', default=LETTERPRESS,
+                        help='letterpress.py to benchmark')
+    parser.add_argument('-o', '--output', help='write the JSON results here')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with the JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown against the baseline that fails --compare')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated folders')
+    options = parser.parse_args()
+
+    try:
+        results = run(options)
+    except BenchmarkError as e:
+        print(e, file=sys.stderr)
+        return 2
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    elif not options.compare:
+        print(text)
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
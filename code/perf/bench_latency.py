@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""Benchmark the edit-to-publish latency of the Letterpress watcher.
+
+Letterpress watches a generated press folder while posts are saved the way
+Dropbox saves them, to a hidden temp file that is then renamed over the post.
+Each save carries a unique marker in the post title, and its latency is the
+time from the rename to the last write of the outputs that show the marker:
+the post page and, for posts new enough to be there, the home page. The
+workloads are:
+
+    save    one save at a time, waiting for each to be published
+    resave  bursts of quick saves of the same post; the latency of a burst
+            is from its last save
+    bulk    many new posts dropped in at once
+
+Per-workload percentiles go to stdout, or --output, as JSON.
+
+Example:
+    python3 bench_latency.py -n 2000 --saves 50 --bursts 20 --bulk 100
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import gen_press
+from bench_build import LETTERPRESS, BenchmarkError, Site
+
+
+class PendingSave(object):
+    """A saved post waiting for its marker to show up in the site."""
+
+    def __init__(self, site, file_name, marker, date, on_home_page):
+        self.file_name = file_name
+        self.marker = marker
+        base_name = os.path.splitext(file_name)[0]
+        self.outputs = [os.path.join(site.site_dir, '{0:04}/{1:02}/{2}.html'.format(
+            date.year, date.month, base_name))]
+        if on_home_page:
+            self.outputs.append(os.path.join(site.site_dir, 'index.html'))
+        self.temp_path = None
+        self.saved_at = None
+        # output -> mtime_ns of the write that showed the marker
+        self.published = {}
+
+
+class Watcher(object):
+    """Polls the outputs of pending saves, reading a file only when its stat
+    changed, so that polling does not steal much time from Letterpress.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.stats = {}
+        self.texts = {}
+
+    def read(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return '', 0
+        key = stat.st_ino, stat.st_mtime_ns, stat.st_size
+        if self.stats.get(path) != key:
+            self.stats[path] = key
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.texts[path] = (f.read(), stat.st_mtime_ns)
+            except FileNotFoundError:
+                self.texts[path] = ('', 0)
+        return self.texts[path]
+
+    def wait(self, pending_saves):
+        """Wait for all pending_saves to be published and return their
+        latencies in seconds.
+        """
+        deadline = time.monotonic() + self.timeout
+        waiting = list(pending_saves)
+        while waiting:
+            if time.monotonic() > deadline:
+                raise BenchmarkError(
+                    '{0} saves were not published in time'.format(len(waiting)))
+            for pending in waiting:
+                for output in pending.outputs:
+                    if output not in pending.published:
+                        text, mtime_ns = self.read(output)
+                        if pending.marker in text:
+                            pending.published[output] = mtime_ns
+            waiting = [pending for pending in waiting if len(
+                pending.published) < len(pending.outputs)]
+            time.sleep(0.002)
+        return [max(0, max(pending.published.values()) - pending.saved_at) / 1e9
+                for pending in pending_saves]
+
+
+class Writer(object):
+    """Saves posts into the press folder like Dropbox does."""
+
+    def __init__(self, site):
+        self.site = site
+        self.count = 0
+
+    def post_text(self, marker, date):
+        return 'title: Latency {0}\ndate: {1}\ntags: latency\n\n{2}\n'.format(
+            marker, date.strftime(gen_press.DATE_FORMAT),
+            ' '.join(gen_press.WORDS[self.count % 50:][:80]))
+
+    def prepare(self, file_name, date, on_home_page=True, temp_dir=None):
+        """Write a new version of file_name to a hidden temp file. Call
+        publish() to rename it over the post.
+        """
+        self.count += 1
+        marker = 'm{0}x{1}'.format(self.count, os.getpid())
+        pending = PendingSave(self.site, file_name, marker, date, on_home_page)
+        pending.temp_path = os.path.join(
+            temp_dir or self.site.press_dir, '.' + file_name + '.tmp')
+        with open(pending.temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.post_text(marker, date))
+        return pending
+
+    def publish(self, pending):
+        os.rename(pending.temp_path, os.path.join(
+            self.site.press_dir, pending.file_name))
+        pending.saved_at = time.time_ns()
+
+    def save(self, file_name, date, on_home_page=True):
+        pending = self.prepare(file_name, date, on_home_page)
+        self.publish(pending)
+        return pending
+
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+
+    def nearest_rank(percent):
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+    return {'count': len(ordered),
+            'p50': round(nearest_rank(50), 6),
+            'p95': round(nearest_rank(95), 6),
+            'p99': round(nearest_rank(99), 6),
+            'max': round(ordered[-1], 6),
+            'mean': round(statistics.mean(ordered), 6)}
+
+
+def run(work_dir, options):
+    site = Site(work_dir, options)
+    site.generate()
+    os.makedirs(site.staging_dir)
+    watcher = Watcher(options.timeout)
+    writer = Writer(site)
+    latest_date = gen_press.END_DATE + datetime.timedelta(days=1)
+    results = {}
+    try:
+        site.start()
+        site.wait_idle(None)
+
+        latencies = []
+        for index in range(options.saves):
+            pending = writer.save('latency-{0}.md'.format(index %
+                                  options.files), latest_date)
+            latencies.extend(watcher.wait([pending]))
+            time.sleep(options.pause)
+        if latencies:
+            results['save'] = percentiles(latencies)
+
+        latencies = []
+        for index in range(options.bursts):
+            for _ in range(options.burst_size):
+                pending = writer.save('latency-{0}.md'.format(index %
+                                      options.files), latest_date)
+                time.sleep(options.burst_gap)
+            latencies.extend(watcher.wait([pending]))
+            time.sleep(options.pause)
+        if latencies:
+            results['resave'] = percentiles(latencies)
+
+        if options.bulk:
+            # Newer than the posts saved above, and the newest first, so the
+            # first of them go on the home page, which shows posts_per_page
+            # posts in the bundled letterpress.config.
+            posts_per_page = 10
+            pending_saves = [writer.prepare('bulk-{0}.md'.format(index),
+                                            latest_date +
+                                            datetime.timedelta(
+                                                days=options.bulk - index),
+                                            index < posts_per_page, site.staging_dir)
+                             for index in range(options.bulk)]
+            for pending in pending_saves:
+                writer.publish(pending)
+            results['bulk'] = percentiles(watcher.wait(pending_saves))
+    finally:
+        site.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the edit-to-publish latency of the Letterpress watcher.')
+    parser.add_argument('-n', '--posts', type=int, default=1000)
+    parser.add_argument('--assets', type=int, default=0)
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--saves', type=int, default=50,
+                        help='single saves, one at a time')
+    parser.add_argument('--files', type=int, default=3,
+                        help='posts the saves and bursts go round')
+    parser.add_argument('--pause', type=float, default=0.2,
+                        help='seconds between saves or bursts')
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--burst-size', type=int, default=5)
+    parser.add_argument('--burst-gap', type=float, default=0.02,
+                        help='seconds between the saves of a burst')
+    parser.add_argument('--bulk', type=int, default=100,
+                        help='new posts dropped in at once')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds without a metrics update that count as idle')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for a startup or a publish')
+    parser.add_argument('--letterpress', default=LETTERPRESS,
+                        help='letterpress.py to benchmark')
+    parser.add_argument('-o', '--output', help='write the JSON results here')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated folders')
+    options = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='letterpress-latency-')
+    try:
+        workloads = run(work_dir, options)
+    except BenchmarkError as e:
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        if options.keep:
+            print('Kept', work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        'version': 1,
+        'parameters': {name: getattr(options, name) for name in
+                       ('posts', 'assets', 'seed', 'saves', 'files', 'pause', 'bursts',
+                        'burst_size', 'burst_gap', 'bulk')},
+        'environment': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'workloads': workloads,
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""Generate a reproducible press folder for benchmarking Letterpress.
+
+The posts are a mix of what real blogs have: tags drawn from a long tailed
+distribution, dates spread over several years, fenced and indented code
+blocks, math, footnotes, lists and quotes, plus a tree of binary assets.
+The same seed always generates the same files.
+
+Example:
+    python3 gen_press.py -n 2000 --assets 300 /tmp/press
+"""
+
+import argparse
+import datetime
+import os
+import random
+import shutil
+
+# The press folder shipped with Letterpress, for the templates and styles.
+PRESS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, os.pardir, 'press')
+
+WORDS = '''a able about above across after again against all almost alone
+along already also although always among an and another any anyone anything
+are around as ask at away back be because become been before began begin
+behind being below best better between big both bring build but by call came
+can cannot case change child city close code come could country cut data day
+did different do does done down during each early end enough even ever every
+eye face fact far feel few file find first follow for found four from full
+general get give go good got great group hand hard has have he head help her
+here high him his home house how however idea if important in into is it its
+just keep kind know large last later learn least leave left less let life
+light like line little live long look made make man many may mean might more
+most move much must my name need never new next night no not nothing now
+number of off often old on once one only open or order other our out over own
+part people place plan point possible post power present problem program
+public put question quite rather read real really right room run said same
+saw say school see seem server set several shall she should show side since
+small so some something sometimes soon start state still story such system
+take tell than that the their them then there these they thing think this
+those though thought three through time to today together too took toward
+turn two under until up upon us use very want was water way we well went
+were what when where which while who whole why will with without word work
+world would write year yet you young your'''.split()
+
+CHINESE = '的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自可'
+
+CODE_SNIPPETS = {
+    'python': '''def fib(n):
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+print([fib(i) for i in range(10)])''',
+    'javascript': '''function debounce(fn, wait) {
+  let timer;
+  return (...args) => {
+    clearTimeout(timer);
+    timer = setTimeout(() => fn(...args), wait);
+  };
+}''',
+    'c': '''#include <stdio.h>
+
+int main(void) {
+    for (int i = 0; i < 10; i++)
+        printf("%d\\n", i * i);
+    return 0;
+}''',
+    'sh': '''for f in *.md; do
+  wc -w "$f"
+done | sort -n | tail''',
+}
+
+MATH_INLINE = ['$E=m*c^2$', '$a^2 + b^2 = c^2$',
+               r'$\sum_{i=1}^n i = \frac{n(n+1)}{2}$', r'$e^{i\pi} + 1 = 0$']
+MATH_DISPLAY = [r'$$\int_0^\infty e^{-x^2} dx = \frac{\sqrt{\pi}}{2}$$',
+                r'$$f(x) = \sum_{n=0}^\infty \frac{f^{(n)}(a)}{n!} (x-a)^n$$']
+
+DATE_FORMAT = '%m/%d/%Y'
+END_DATE = datetime.date(2020, 12, 31)
+
+
+def _tag_names(count):
+    return ['tag{0}'.format(i) for i in range(count)]
+
+
+def _sentence(rng, words=None):
+    words = words or rng.randint(6, 20)
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def _paragraph(rng, footnotes):
+    sentences = []
+    for _ in range(rng.randint(2, 6)):
+        sentence = _sentence(rng)
+        roll = rng.random()
+        if roll < 0.15:
+            word = rng.choice(WORDS)
+            sentence = sentence.replace(
+                ' ' + word + ' ', ' *' + word + '* ', 1)
+        elif roll < 0.25:
+            word = rng.choice(WORDS)
+            sentence = sentence.replace(
+                ' ' + word + ' ', ' [' + word + '](http://example.com/' + word + ') ', 1)
+        elif roll < 0.3:
+            word = rng.choice(WORDS)
+            sentence = sentence.replace(
+                ' ' + word + ' ', ' `' + word + '()` ', 1)
+        elif roll < 0.35 and footnotes is not None:
+            footnotes.append(_sentence(rng, 8))
+            sentence = sentence[:-1] + '[^{0}].'.format(len(footnotes))
+        sentences.append(sentence)
+    return ' '.join(sentences)
+
+
+def _chinese_paragraph(rng):
+    return ''.join(rng.choice(CHINESE) for _ in range(rng.randint(40, 200))) + '。'
+
+
+def make_post(rng, index, tag_names, years=8):
+    """Return the file name and the text of a random post."""
+    date = END_DATE - datetime.timedelta(days=rng.randrange(365 * years))
+    tag_weights = [1.0 / (rank + 1) for rank in range(len(tag_names))]
+    post_tags = set()
+    for _ in range(rng.randint(1, 4)):
+        post_tags.add(rng.choices(tag_names, tag_weights)[0])
+    is_math = rng.random() < 0.1
+    if is_math:
+        post_tags.add('math')
+    is_chinese = rng.random() < 0.1
+    title = _sentence(rng, rng.randint(2, 7))[:-1]
+    lines = ['title: {0} {1}'.format(title, index),
+             'date: ' + date.strftime(DATE_FORMAT),
+             'tags: ' + ', '.join(sorted(post_tags))]
+    if rng.random() < 0.5:
+        lines.append('excerpt: ' + _sentence(rng))
+    if is_chinese:
+        lines.append('lang: 中文')
+    lines.append('')
+
+    footnotes = [] if rng.random() < 0.2 else None
+    for _ in range(rng.randint(3, 15)):
+        roll = rng.random()
+        if is_chinese and roll < 0.5:
+            lines.append(_chinese_paragraph(rng))
+        elif roll < 0.08:
+            lines.append('### ' + _sentence(rng, 4)[:-1])
+        elif roll < 0.16:
+            lines.extend('- ' + _sentence(rng, 6)
+                         for _ in range(rng.randint(2, 8)))
+        elif roll < 0.2:
+            lines.append('> ' + _sentence(rng))
+        elif roll < 0.28:
+            lang = rng.choice(sorted(CODE_SNIPPETS))
+            lines.extend(['```' + lang, CODE_SNIPPETS[lang], '```'])
+        elif roll < 0.32:
+            lang = rng.choice(sorted(CODE_SNIPPETS))
+            lines.extend('    ' + line
+                         for line in CODE_SNIPPETS[lang].splitlines())
+        elif roll < 0.4 and is_math:
+            lines.append(_sentence(rng) + ' ' + rng.choice(MATH_INLINE))
+            lines.append('')
+            lines.append(rng.choice(MATH_DISPLAY))
+        else:
+            lines.append(_paragraph(rng, footnotes))
+        lines.append('')
+    for number, note in enumerate(footnotes or [], 1):
+        lines.append('[^{0}]: {1}'.format(number, note))
+
+    file_name = 'post-{0:05d}.md'.format(index)
+    return file_name, '\n'.join(lines) + '\n'
+
+
+def write_posts(press_dir, count, seed, start=0, tags=60, years=8):
+    """Write count posts numbered from start to press_dir and return their
+    paths. Each post only depends on the seed and its number.
+    """
+    tag_names = _tag_names(tags)
+    paths = []
+    for index in range(start, start + count):
+        rng = random.Random('{0}-{1}'.format(seed, index))
+        file_name, text = make_post(rng, index, tag_names, years)
+        path = os.path.join(press_dir, file_name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        paths.append(path)
+    return paths
+
+
+def write_assets(press_dir, count, seed):
+    """Write count binary assets spread over nested folders."""
+    rng = random.Random('{0}-assets'.format(seed))
+    for index in range(count):
+        folder = os.path.join(press_dir, 'img', str(2013 + index % 8),
+                              '{0:02d}'.format(index % 12 + 1))
+        os.makedirs(folder, exist_ok=True)
+        size = int(rng.lognormvariate(10, 1.2)) + 64
+        with open(os.path.join(folder, 'asset-{0:05d}.png'.format(index)), 'wb') as f:
+            f.write(rng.getrandbits(8 * size).to_bytes(size, 'little'))
+
+
+def generate_press(press_dir, site_dir, posts, seed=0, assets=0, tags=60,
+                   years=8, config_extra=None):
+    """Create press_dir from the bundled press folder with generated posts
+    and assets, publishing to site_dir.
+    """
+    if os.path.exists(press_dir):
+        shutil.rmtree(press_dir)
+    shutil.copytree(PRESS_DIR, press_dir,
+                    ignore=shutil.ignore_patterns('*.md'))
+    config_path = os.path.join(press_dir, 'letterpress.config')
+    with open(config_path, encoding='utf-8') as f:
+        config_lines = f.read().splitlines()
+    config_lines = ['site_dir: ' + os.path.abspath(site_dir) if line.startswith('site_dir:') else line
+                    for line in config_lines]
+    for key, value in sorted((config_extra or {}).items()):
+        config_lines.append('{0}: {1}'.format(key, value))
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(config_lines) + '\n')
+    os.makedirs(site_dir, exist_ok=True)
+    write_posts(press_dir, posts, seed, tags=tags, years=years)
+    write_assets(press_dir, assets, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a reproducible press folder for benchmarks.')
+    parser.add_argument('press_dir', metavar='PRESS_DIR')
+    parser.add_argument('--site-dir',
+                        help='where the site is published, PRESS_DIR.site by default')
+    parser.add_argument('-n', '--posts', type=int, default=1000)
+    parser.add_argument('--assets', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=60)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--seed', default='0')
+    options = parser.parse_args()
+    press_dir = os.path.normpath(options.press_dir)
+    generate_press(press_dir, options.site_dir or press_dir + '.site',
+                   options.posts, options.seed, options.assets, options.tags,
+                   options.years)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests of Letterpress. Run them with `python3 test_letterpress.py`."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown2', 'lib'))
+
+import markdown2
+import letterpress
+
+
+class MetadataIndexTestCase(unittest.TestCase):
+    settings = {'version': 2, 'base_url': 'http://x', 'date_format': '%m/%d/%Y'}
+
+    def setUp(self):
+        self.press_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.press_dir, 'index.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.press_dir)
+
+    def index(self, settings=None, signature='s1'):
+        index = letterpress.MetadataIndex(self.index_path, self.press_dir, settings or self.settings, signature)
+        index.load()
+        return index
+
+    def post(self, name, text='text', content_span=None):
+        """Write a post file and return its post and stat."""
+        file_path = os.path.join(self.press_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(text)
+        record = {'title': name, 'date': '2013-01-31 00:00:00', 'pretty_date': 'Jan 31, 2013',
+                  'iso_date': '2013-01-31T00:00:00', 'excerpt': '', 'tags': ['t'], 'lang': 'English',
+                  'path': name + '.html', 'permalink': '/' + name + '.html', 'content_span': content_span}
+        return letterpress.Post.from_record(file_path, record), os.stat(file_path)
+
+    def line_count(self):
+        with open(self.index_path) as f:
+            return len(f.readlines())
+
+    def test_journal_replay(self):
+        index = self.index()
+        a, a_stat = self.post('a.md', content_span=(1, 2))
+        b, b_stat = self.post('b.md')
+        index.add(a, a_stat)
+        index.add(b, b_stat)
+        index.save()
+        # The changes after the snapshot are appended, and replayed in order.
+        b.content_span = (3, 4)
+        index.set_rendered(b)
+        c, c_stat = self.post('c.md')
+        index.add(c, c_stat)
+        index.remove(a.file_path)
+        index.flush()
+        self.assertEqual(self.line_count(), 1 + 2 + 3)
+
+        index = self.index()
+        self.assertEqual(sorted(index.entries), ['b.md', 'c.md'])
+        self.assertIsNone(index.lookup(a.file_path, a_stat))
+        self.assertEqual(index.lookup(b.file_path, b_stat).content_span, (3, 4))
+        self.assertEqual(index.lookup(c.file_path, c_stat).title, 'c.md')
+        # A changed post is not taken from the index.
+        b, b_stat = self.post('b.md', 'changed text')
+        self.assertIsNone(index.lookup(b.file_path, b_stat))
+
+    def test_render_signature_and_settings(self):
+        index = self.index()
+        a, a_stat = self.post('a.md', content_span=(1, 2))
+        index.add(a, a_stat)
+        index.save()
+        self.assertEqual(self.index().lookup(a.file_path, a_stat).content_span, (1, 2))
+        # Rendered with other templates, config or code: render it again.
+        post = self.index(signature='s2').lookup(a.file_path, a_stat)
+        self.assertIsNone(post.content_span)
+        # Other settings: read it again.
+        self.assertEqual(self.index(dict(self.settings, base_url='http://y')).entries, {})
+
+    def test_torn_journal_line(self):
+        index = self.index()
+        a, a_stat = self.post('a.md')
+        b, b_stat = self.post('b.md')
+        index.add(a, a_stat)
+        index.save()
+        index.add(b, b_stat)
+        index.flush()
+        # A crash while flushing leaves a partial line.
+        with open(self.index_path, 'a') as f:
+            f.write('{"name": "c.md", "ti')
+        with self.assertLogs('Letterpress', 'WARNING'):
+            index = self.index()
+        self.assertEqual(sorted(index.entries), ['a.md', 'b.md'])
+        self.assertEqual(self.line_count(), 1 + 2)
+        # What is appended afterwards is read back.
+        c, c_stat = self.post('c.md')
+        index.add(c, c_stat)
+        index.flush()
+        self.assertEqual(sorted(self.index().entries), ['a.md', 'b.md', 'c.md'])
+
+    def test_bad_record(self):
+        index = self.index()
+        a, a_stat = self.post('a.md')
+        index.add(a, a_stat)
+        index.save()
+        with open(self.index_path, 'a') as f:
+            f.write('not json\n{"name": "b.md", "deleted": true}\n')
+        with self.assertLogs('Letterpress', 'ERROR'):
+            index = self.index()
+        # Everything is read again, and the index starts over.
+        self.assertEqual(index.entries, {})
+        self.assertEqual(self.line_count(), 1)
+
+    def test_compaction(self):
+        index = self.index()
+        a, a_stat = self.post('a.md')
+        index.add(a, a_stat)
+        index.save()
+        for i in range(600):
+            a.content_span = (i, i + 1)
+            index.set_rendered(a)
+            index.flush()
+        self.assertEqual(self.line_count(), 1 + 1 + 600)
+        # Once the journal outgrows the snapshot, the index is rewritten.
+        for i in range(600):
+            a.content_span = (i, i + 2)
+            index.set_rendered(a)
+            index.flush()
+        self.assertLess(self.line_count(), 1 + 1 + 1200)
+        self.assertEqual(self.index().lookup(a.file_path, a_stat).content_span, (599, 601))
+        self.assertFalse(os.path.exists(self.index_path + '.tmp'))
+
+    def test_restart_after_delete_and_rename(self):
+        index = self.index()
+        posts = dict((name, self.post(name, content_span=(1, 2))) for name in ('a.md', 'b.md', 'c.md'))
+        for post, stat in posts.values():
+            index.add(post, stat)
+        index.save()
+        # While Letterpress is not running, b.md is deleted and c.md renamed.
+        os.remove(posts['b.md'][0].file_path)
+        d_path = os.path.join(self.press_dir, 'd.md')
+        os.rename(posts['c.md'][0].file_path, d_path)
+
+        # What the site build does on restart.
+        index = self.index()
+        found = {}
+        for name in ('a.md', 'd.md'):
+            file_path = os.path.join(self.press_dir, name)
+            found[file_path] = index.lookup(file_path, os.stat(file_path))
+        self.assertEqual(found[posts['a.md'][0].file_path].content_span, (1, 2))
+        self.assertIsNone(found[d_path])
+        d, d_stat = self.post('d.md')
+        index.add(d, d_stat)
+        index.retain(found)
+        index.save()
+
+        index = self.index()
+        self.assertEqual(sorted(index.entries), ['a.md', 'd.md'])
+        self.assertEqual(self.line_count(), 1 + 2)
+
+
+class RenderSignatureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.templates_dir = os.path.join(self.temp_dir, 'templates')
+        os.mkdir(self.templates_dir)
+        with open(os.path.join(self.templates_dir, 'post.html'), 'w') as f:
+            f.write('{{content}}')
+        self.config = {'base_url': 'http://x'}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def signature(self):
+        return letterpress.render_signature(self.config, self.templates_dir)
+
+    def test_changes(self):
+        signature = self.signature()
+        self.assertEqual(self.signature(), signature)
+        with open(os.path.join(self.templates_dir, 'post.html'), 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(self.signature(), signature)
+        signature = self.signature()
+        self.config['base_url'] = 'http://y'
+        self.assertNotEqual(self.signature(), signature)
+
+    def test_code_changes(self):
+        # A changed markdown2.py renders differently, whatever its version.
+        signature = self.signature()
+        module_path = os.path.join(self.temp_dir, 'markdown2.py')
+        with open(markdown2.__file__, 'rb') as f:
+            source = f.read()
+        with open(module_path, 'wb') as f:
+            f.write(source + b'\n# changed\n')
+        original_path = markdown2.__file__
+        markdown2.__file__ = module_path
+        try:
+            self.assertNotEqual(self.signature(), signature)
+        finally:
+            markdown2.__file__ = original_path
+        self.assertEqual(self.signature(), signature)
+
+
+if __name__ == '__main__':
+    unittest.main()